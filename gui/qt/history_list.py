@@ -72,8 +72,9 @@ class HistoryList(MyTreeWidget):
         self.update_headers(headers)
 
     def get_domain(self):
-        '''Replaced in address_dialog.py'''
-        return self.wallet.get_addresses()
+        '''Replaced in address_dialog.py. None means the whole wallet, for
+        which wallet.get_history() has a cache.'''
+        return None
 
     @rate_limited(1.0, classlevel=True, ts_after=True) # We rate limit the history list refresh no more than once every second, app-wide
     def update(self):
@@ -169,16 +169,15 @@ class ScanBeyondGap(WindowModalDialog, PrintError):
         if recv_end > -1: total += recv_end - len(wallet.get_receiving_addresses()) + 1
         if change_end > -1: total += change_end - len(wallet.get_change_addresses()) + 1
         self.progress_sig.emit(0, added, total, None)  # progress bar indicator reset to base for stage2
-        while len(wallet.get_receiving_addresses()) < recv_end + 1:
-            if self.stop_flag: return
-            wallet.create_new_address(for_change=False)
-            added += 1
-            self.progress_sig.emit(added*100//total, added, total, None)
-        while len(wallet.get_change_addresses()) < change_end + 1:
-            if self.stop_flag: return
-            wallet.create_new_address(for_change=True)
-            added += 1
-            self.progress_sig.emit(added*100//total, added, total, None)
+        for for_change, end in ((False, recv_end), (True, change_end)):
+            addr_list = wallet.get_change_addresses() if for_change else wallet.get_receiving_addresses()
+            while len(addr_list) < end + 1:
+                if self.stop_flag: return
+                # derive in batches so that the progress bar still moves
+                n = min(end + 1 - len(addr_list), 100)
+                wallet.create_new_addresses(for_change=for_change, count=n)
+                added += n
+                self.progress_sig.emit(added*100//total, added, total, None)
         return added
 
     def _addr_has_history(self, address, network):
@@ -192,8 +192,7 @@ def get_history(domain : list = None, statusImagesOverride : list = None, forceN
     if wallet is None or daemon is None:
         utils.NSLog("get_history: wallet and/or daemon was None, returning early")
         return ret
-    h = wallet.get_history(domain)
-    h.reverse()
+    h = list(wallet.get_history(domain, reverse=True))
     ret.set_hitems(h)
     return ret
 
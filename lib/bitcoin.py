@@ -33,7 +33,10 @@ import json
 import ecdsa
 import pyaes
 
+from ctypes import byref, c_size_t, create_string_buffer, memmove
+
 from . import networks
+from . import secp256k1
 from .util import (bfh, bh2u, to_string, print_error, InvalidPassword,
                    assert_bytes, to_bytes, inv_dict, profiler)
 from . import version
@@ -166,6 +169,11 @@ def rev_hex(s):
 
 def int_to_hex(i, length=1):
     assert isinstance(i, int)
+    try:
+        return i.to_bytes(length, 'little').hex()
+    except OverflowError:
+        # doesn't fit in length bytes (or negative): legacy behaviour
+        pass
     s = hex(i)[2:].rstrip('L')
     s = "0"*(2*length - len(s)) + s
     return rev_hex(s)
@@ -799,6 +807,41 @@ def _CKD_pub(cK, c, s):
     cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
+def CKD_pub_range(cK, c, start, count):
+    """ Returns the compressed public keys of children start .. start+count-1
+    of the non-hardened parent (cK, c).  Equivalent to calling CKD_pub for
+    each index, but the parent point is decoded once and, when
+    libsecp256k1 is available, each child is a single tweak-add of it. """
+    if start < 0 or start + count > BIP32_PRIME: raise
+    lib = secp256k1.secp256k1
+    if lib:
+        parent = create_string_buffer(64)
+        if not lib.secp256k1_ec_pubkey_parse(lib.ctx, parent, cK, len(cK)):
+            raise ValueError('invalid public key')
+        child = create_string_buffer(64)
+        out = create_string_buffer(33)
+        out_size = c_size_t(33)
+    else:
+        K = ser_to_point(cK)
+        G = generator_secp256k1
+    pubkeys = []
+    for n in range(start, start + count):
+        I = hmac.new(c, cK + n.to_bytes(4, 'big'), hashlib.sha512).digest()
+        if lib:
+            memmove(child, parent, 64)
+            if not lib.secp256k1_ec_pubkey_tweak_add(lib.ctx, child, I[0:32]):
+                # I_L out of range; let the reference code deal with it
+                pubkeys.append(CKD_pub(cK, c, n)[0])
+                continue
+            out_size.value = 33
+            lib.secp256k1_ec_pubkey_serialize(lib.ctx, out, byref(out_size), child,
+                                              secp256k1.SECP256K1_EC_COMPRESSED)
+            pubkeys.append(out.raw)
+        else:
+            P = string_to_number(I[0:32]) * G + K
+            pubkeys.append(point_to_ser(P, True))
+    return pubkeys
+
 
 def xprv_header(xtype, *, net=None):
     if net is None: net = networks.net
@@ -21,9 +21,11 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import mmap
 import os
 import sys
 import threading
+from collections import OrderedDict
 
 
 from . import util
@@ -80,6 +82,13 @@ MAX_TARGET = bits_to_target(MAX_BITS)
 NULL_HEADER = bytes([0]) * HEADER_SIZE
 NULL_HASH_BYTES = bytes([0]) * 32
 NULL_HASH_HEX = NULL_HASH_BYTES.hex()
+# number of parsed headers each Blockchain keeps in memory
+HEADER_CACHE_SIZE = 10000
+# leading headers needed to compute the bits of the first header in a chunk:
+# the 144 block DAA window plus the median-of-3 taken at its start
+DAA_WINDOW = 144 + 3
+# median time past at which the Nov 2017 DAA activated
+DAA_ACTIVATION_MTP = 1510600000
 
 def serialize_header(res):
     s = int_to_hex(res.get('version'), 4) \
@@ -101,6 +110,14 @@ def deserialize_header(s, height):
     h['block_height'] = height
     return h
 
+def daa_bits(cumulative_work, elapsed_time):
+    ''' The Nov 2017 DAA: the bits for a block given the work done and the
+    time taken over the preceding window. '''
+    elapsed_time = min(max(elapsed_time, 43200), 172800)
+    daa_Wn = (cumulative_work * 600) // elapsed_time
+    daa_target = (1 << 256) // daa_Wn - 1
+    return int(target_to_bits(daa_target))
+
 def hash_header_hex(header_hex):
     return hash_encode(Hash(bfh(header_hex)))
 
@@ -144,17 +161,11 @@ def can_connect(header):
 def verify_proven_chunk(chunk_base_height, chunk_data):
     chunk = HeaderChunk(chunk_base_height, chunk_data)
 
-    header_count = len(chunk_data) // HEADER_SIZE
-    prev_header = None
-    prev_header_hash = None
-    for i in range(header_count):
-        header = chunk.get_header_at_index(i)
-        # Check the chain of hashes for all headers preceding the proven one.
-        this_header_hash = hash_header(header)
-        if i > 0:
-            if prev_header_hash != header.get('prev_block_hash'):
-                raise VerifyError("prev hash mismatch: %s vs %s" % (prev_header_hash, header.get('prev_block_hash')))
-        prev_header_hash = this_header_hash
+    # Check the chain of hashes for all headers preceding the proven one.
+    hashes = chunk.get_hashes()
+    for i in range(1, chunk.get_count()):
+        if hashes[i - 1] != chunk.raw[i][4:36]:
+            raise VerifyError("prev hash mismatch: %s vs %s" % (hash_encode(hashes[i - 1]), hash_encode(chunk.raw[i][4:36])))
 
 # Copied from electrumx
 def root_from_proof(hash, branch, index):
@@ -173,9 +184,12 @@ class HeaderChunk:
     def __init__(self, base_height, data):
         self.base_height = base_height
         self.header_count = len(data) // HEADER_SIZE
-        self.headers = [deserialize_header(data[i * HEADER_SIZE : (i + 1) * HEADER_SIZE],
-                                           base_height + i)
-                        for i in range(self.header_count)]
+        self.raw = [bytes(data[i * HEADER_SIZE : (i + 1) * HEADER_SIZE])
+                    for i in range(self.header_count)]
+        self.timestamps = [int.from_bytes(h[68:72], 'little') for h in self.raw]
+        self.bits = [int.from_bytes(h[72:76], 'little') for h in self.raw]
+        # header dicts are only built when asked for
+        self.headers = [None] * self.header_count
 
     def __repr__(self):
         return "HeaderChunk(base_height={}, header_count={})".format(self.base_height, self.header_count)
@@ -191,7 +205,34 @@ class HeaderChunk:
         return self.get_header_at_index(height - self.base_height)
 
     def get_header_at_index(self, index):
-        return self.headers[index]
+        header = self.headers[index]
+        if header is None:
+            header = self.headers[index] = deserialize_header(self.raw[index], self.base_height + index)
+        return header
+
+    def get_hashes(self):
+        ''' Returns the double-SHA256 of every header, in internal byte order. '''
+        return [Hash(h) for h in self.raw]
+
+    def get_cumulative_work(self):
+        ''' Returns a list whose element i is the total work of the first i
+        headers, so the work of headers a..b inclusive is w[b + 1] - w[a]. '''
+        work = [0]
+        for bits in self.bits:
+            work.append(work[-1] + bits_to_work(bits))
+        return work
+
+    def get_suitable_index(self, index):
+        ''' Index-based Blockchain.get_suitable_block_height(). '''
+        ts = self.timestamps
+        blocks2, blocks1, blocks = index, index - 1, index - 2
+        if ts[blocks] > ts[blocks2]:
+            blocks, blocks2 = blocks2, blocks
+        if ts[blocks] > ts[blocks1]:
+            blocks, blocks1 = blocks1, blocks
+        if ts[blocks1] > ts[blocks2]:
+            blocks1, blocks2 = blocks2, blocks1
+        return blocks1
 
 class Blockchain(util.PrintError):
     """
@@ -205,6 +246,8 @@ class Blockchain(util.PrintError):
         self.parent_base_height = parent_base_height
 
         self.lock = threading.Lock()
+        self._mmap = None
+        self._header_cache = OrderedDict()
         with self.lock:
             self.update_size()
 
@@ -251,8 +294,34 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
+        ''' Re-reads the size of our headers file. Must be called with
+        self.lock held, after the file was changed. '''
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        self.close_mmap()
+        self._header_cache.clear()
+
+    def close_mmap(self):
+        ''' Drops the read-only map of our headers file. Must be called with
+        self.lock held before the file is truncated, replaced or renamed.
+        The file is mapped again on the next read. '''
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _read_raw(self, delta, count):
+        ''' Returns the raw bytes of `count` headers starting `delta` headers
+        into our file. Must be called with self.lock held. '''
+        offset, length = delta * HEADER_SIZE, count * HEADER_SIZE
+        if self._mmap is None or offset + length > len(self._mmap):
+            self.close_mmap()
+            try:
+                with open(self.path(), 'rb') as f:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # missing or empty file
+                return b''
+        return self._mmap[offset:offset + length]
 
     def verify_header(self, header, prev_header, bits=None):
         prev_header_hash = hash_header(prev_header)
@@ -273,19 +342,56 @@ class Blockchain(util.PrintError):
                 raise VerifyError("insufficient proof of work: %s vs target %s" % (int('0x' + this_header_hash, 16), target))
 
     def verify_chunk(self, chunk_base_height, chunk_data):
-        chunk = HeaderChunk(chunk_base_height, chunk_data)
-
-        prev_header = None
-        if chunk_base_height != 0:
-            prev_header = self.read_header(chunk_base_height - 1)
-
-        header_count = len(chunk_data) // HEADER_SIZE
-        for i in range(header_count):
-            header = chunk.get_header_at_index(i)
-            # Check the chain of hashes and the difficulty.
-            bits = self.get_bits(header, chunk)
-            self.verify_header(header, prev_header, bits)
-            prev_header = header
+        ''' Verifies the hash chain, the difficulty and the proof of work of
+        every header in chunk_data in a single pass. The DAA windows are
+        computed from per-chunk arrays of timestamps, bits and cumulative
+        work; only headers without the whole window in memory, or from before
+        the DAA, go through the generic get_bits(). '''
+        # Prepend the stored headers the difficulty calculation looks back at,
+        # so that it never has to go to disk while walking the chunk.
+        prefix = self.read_headers(chunk_base_height - DAA_WINDOW, DAA_WINDOW)
+        chunk = HeaderChunk(chunk_base_height - len(prefix) // HEADER_SIZE, prefix + chunk_data)
+        first = chunk_base_height - chunk.base_height
+        hashes = chunk.get_hashes()
+        timestamps = chunk.timestamps
+        work = None
+
+        fork_height = networks.net.BITCOIN_CASH_FORK_BLOCK_HEIGHT
+        for i in range(first, chunk.get_count()):
+            height = chunk.base_height + i
+            raw = chunk.raw[i]
+            # Check the chain of hashes.
+            if i > 0:
+                prev_hash = hash_encode(hashes[i - 1])
+            else:
+                prev_hash = hash_header(self.read_header(height - 1))
+            if hash_encode(raw[4:36]) != prev_hash:
+                raise VerifyError("prev hash mismatch: %s vs %s" % (prev_hash, hash_encode(raw[4:36])))
+
+            # Check the difficulty.
+            if i >= DAA_WINDOW and sorted(timestamps[i - 11:i])[5] >= DAA_ACTIVATION_MTP:
+                if networks.net.TESTNET and timestamps[i] - timestamps[i - 1] > 20*60:
+                    bits = MAX_BITS
+                else:
+                    if work is None:
+                        work = chunk.get_cumulative_work()
+                    start = chunk.get_suitable_index(i - 1 - 144)
+                    end = chunk.get_suitable_index(i - 1)
+                    bits = daa_bits(work[end + 1] - work[start + 1], timestamps[end] - timestamps[start])
+            else:
+                bits = self.get_bits(chunk.get_header_at_index(i), chunk)
+            header_bits = chunk.bits[i]
+            if bits != header_bits:
+                raise VerifyError("bits mismatch: %s vs %s" % (bits, header_bits))
+
+            # Check the proof of work.
+            if height == fork_height and hash_encode(hashes[i]) != networks.net.BITCOIN_CASH_FORK_BLOCK_HASH:
+                err_str = "block at height %i is not cash chain fork block. hash %s" % (height, hash_encode(hashes[i]))
+                raise VerifyError(err_str)
+            target = bits_to_target(bits)
+            pow_value = int.from_bytes(hashes[i], 'little')
+            if pow_value > target:
+                raise VerifyError("insufficient proof of work: %s vs target %s" % (pow_value, target))
 
     def path(self):
         d = util.get_headers_dir(self.config)
@@ -324,10 +430,13 @@ class Blockchain(util.PrintError):
         # store file path
         for b in blockchains.values():
             b.old_path = b.path()
+            with b.lock:
+                b.close_mmap()
         # swap parameters
         self.parent_base_height = parent.parent_base_height; parent.parent_base_height = parent_base_height
         self.base_height = parent.base_height; parent.base_height = base_height
         self._size = parent._size; parent._size = parent_branch_size
+        self._header_cache.clear(); parent._header_cache.clear()
         # move files
         for b in blockchains.values():
             if b in [self, parent]: continue
@@ -341,6 +450,7 @@ class Blockchain(util.PrintError):
     def write(self, data, offset, truncate=True):
         filename = self.path()
         with self.lock:
+            self.close_mmap()
             with open(filename, 'rb+') as f:
                 if truncate and offset != self._size*HEADER_SIZE:
                     f.seek(offset)
@@ -371,16 +481,50 @@ class Blockchain(util.PrintError):
             return self.parent().read_header(height)
         if height > self.height():
             return
-        delta = height - self.base_height
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * HEADER_SIZE)
-                h = f.read(HEADER_SIZE)
-            # Is it a pre-checkpoint header that has never been requested?
-            if h == NULL_HEADER:
-                return None
-            return deserialize_header(h, height)
+        with self.lock:
+            header = self._header_cache.get(height)
+            if header is not None:
+                self._header_cache.move_to_end(height)
+            else:
+                h = self._read_raw(height - self.base_height, 1)
+                # Is it a pre-checkpoint header that has never been requested?
+                if len(h) != HEADER_SIZE or h == NULL_HEADER:
+                    return None
+                header = deserialize_header(h, height)
+                self._header_cache[height] = header
+                if len(self._header_cache) > HEADER_CACHE_SIZE:
+                    self._header_cache.popitem(last=False)
+        # callers are free to modify what they get back
+        return dict(header)
+
+    def read_headers(self, start_height, count):
+        ''' Returns the raw serialized headers from `start_height` up to
+        `count` headers on, clamped to the headers we have.  The result is
+        cut after the last missing (pre-checkpoint) header in the range, so
+        it is always a run of consecutive headers ending at
+        start_height + count - 1 (or at our tip), suitable for HeaderChunk.
+        '''
+        if start_height < 0:
+            count += start_height
+            start_height = 0
+        count = min(count, self.height() + 1 - start_height)
+        if count <= 0:
+            return b''
+        if start_height < self.base_height:
+            n = min(count, self.base_height - start_height)
+            rest = self.read_headers(self.base_height, count - n)
+            if len(rest) != (count - n) * HEADER_SIZE or self.parent().height() < self.base_height - 1:
+                return rest
+            return self.parent().read_headers(start_height, n) + rest
+        with self.lock:
+            data = self._read_raw(start_height - self.base_height, count)
+        # keep only the headers after the last null one
+        i = data.rfind(NULL_HEADER)
+        while i > 0 and i % HEADER_SIZE:
+            i = data.rfind(NULL_HEADER, 0, i + HEADER_SIZE - 1)
+        if i >= 0:
+            data = data[i + HEADER_SIZE:]
+        return data
 
     def get_hash(self, height):
         if height == -1:
@@ -439,7 +583,7 @@ class Blockchain(util.PrintError):
         daa_mtp = self.get_median_time_past(prevheight, chunk)
 
         #if (daa_mtp >= 1509559291):  #leave this here for testing
-        if (daa_mtp >= 1510600000):
+        if (daa_mtp >= DAA_ACTIVATION_MTP):
 
             if networks.net.TESTNET:
                 # testnet 20 minute rule
@@ -458,21 +602,10 @@ class Blockchain(util.PrintError):
                 daa_work_for_a_block = bits_to_work(daa_bits_for_a_block)
                 daa_cumulative_work += daa_work_for_a_block
 
-            # calculate and sanitize elapsed time
+            # calculate and return new target
             daa_starting_timestamp = self.read_header(daa_starting_height, chunk)['timestamp']
             daa_ending_timestamp = self.read_header(daa_ending_height, chunk)['timestamp']
-            daa_elapsed_time = daa_ending_timestamp - daa_starting_timestamp
-            if (daa_elapsed_time>172800):
-                daa_elapsed_time=172800
-            if (daa_elapsed_time<43200):
-                daa_elapsed_time=43200
-
-            # calculate and return new target
-            daa_Wn = (daa_cumulative_work*600) // daa_elapsed_time
-            daa_target = (1 << 256) // daa_Wn - 1
-            daa_retval = target_to_bits(daa_target)
-            daa_retval = int(daa_retval)
-            return daa_retval
+            return daa_bits(daa_cumulative_work, daa_ending_timestamp - daa_starting_timestamp)
 
         #END OF NOV-2017 DAA
 
@@ -22,7 +22,9 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+from bisect import bisect_left
 from collections import defaultdict, namedtuple
+from itertools import accumulate
 from math import floor, log10
 
 from .bitcoin import sha256, COIN, TYPE_ADDRESS
@@ -90,9 +92,20 @@ class CoinChooserBase(PrintError):
         for key, coin in zip(keys, coins):
             buckets[key].append(coin)
 
+        # Building the dummy input script is slow, and most wallets only
+        # have one or two kinds of input
+        sizes = {}
+        def input_size(coin):
+            key = Transaction.estimated_input_size_key(coin, sign_schnorr)
+            size = sizes.get(key) if key is not None else None
+            if size is None:
+                size = Transaction.estimated_input_size(coin, sign_schnorr=sign_schnorr)
+                if key is not None:
+                    sizes[key] = size
+            return size
+
         def make_Bucket(desc, coins):
-            size = sum(Transaction.estimated_input_size(coin, sign_schnorr=sign_schnorr)
-                       for coin in coins)
+            size = sum(input_size(coin) for coin in coins)
             value = sum(coin['value'] for coin in coins)
             return Bucket(desc, size, value, coins)
 
@@ -284,8 +297,143 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+class CoinChooserBranchAndBound(CoinChooserBase):
+    '''Scales to wallets with very many coins.  Like CoinChooserPrivacy,
+    all coins of an address are spent together.  First, it searches
+    for a set of buckets that pays for the transaction with change
+    below the dust threshold, so that no change output is needed
+    (branch-and-bound over the buckets sorted by value, pruned with
+    suffix sums).  Failing that, it spends the smallest bucket that
+    pays for the transaction with change, or else the fewest largest
+    buckets that do.'''
+
+    # Search steps before settling for a transaction with change
+    MAX_TRIES = 100000
+
+    def keys(self, coins):
+        return [coin['address'] for coin in coins]
+
+    def make_tx(self, coins, outputs, change_addrs, fee_estimator,
+                dust_threshold, sign_schnorr=False):
+        tx = Transaction.from_io([], outputs, sign_schnorr=sign_schnorr)
+        self.spent_amount = tx.output_value()
+        self.base_size = tx.estimated_size()
+        self.fee_estimator = fee_estimator
+        self.dust_threshold = dust_threshold
+        return super().make_tx(coins, outputs, change_addrs, fee_estimator,
+                               dust_threshold, sign_schnorr=sign_schnorr)
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+        fee_estimator = self.fee_estimator
+        # Effective values, the value of a bucket less the fee to spend it,
+        # are kept in millisatoshis so they are exact integers.  A fixed fee
+        # has no rate, and only the fallback applies.
+        fee_per_kb = fee_estimator(1000)
+        linear = fee_estimator(0) == 0 and fee_estimator(2000) == 2 * fee_per_kb
+        rate = fee_per_kb if linear else 0
+        # Ties are broken by outpoint so the result does not depend on the
+        # order of the coins
+        buckets = sorted(buckets, key=lambda b: (
+            rate * b.size - 1000 * b.value,
+            min((c['prevout_hash'], c['prevout_n']) for c in b.coins)))
+        values = [1000 * b.value - rate * b.size for b in buckets]
+
+        def enough(value, size, extra=0):
+            return value >= (self.spent_amount + extra
+                             + fee_estimator(self.base_size + size + (34 if extra else 0)))
+
+        winner = None
+        if linear:
+            target = 1000 * self.spent_amount + rate * self.base_size
+            window = max(0, 1000 * (self.dust_threshold - 2) + rate * 34)
+            # Buckets worth more than target + window can't be part of an
+            # exact match, and those worth nothing only add fees
+            neg = [-v for v in values]
+            start = bisect_left(neg, -(target + window))
+            end = bisect_left(neg, 0)
+            selection = self.branch_and_bound(values[start:end], target, window)
+            if selection is not None:
+                winner = [buckets[start + i] for i in selection]
+                self.print_error("Exact match with", len(winner), "buckets")
+
+        if winner is None:
+            # The smallest bucket that pays with change of at least dust
+            extra = self.dust_threshold
+            for b in reversed(buckets):
+                if enough(b.value, b.size, extra):
+                    winner = [b]
+                    break
+
+        if winner is None:
+            # As few of the largest buckets as will do
+            value_sums = list(accumulate(b.value for b in buckets))
+            size_sums = list(accumulate(b.size for b in buckets))
+            for n in range(len(buckets)):
+                if enough(value_sums[n], size_sums[n]):
+                    winner = buckets[:n + 1]
+                    break
+
+        if winner is None or not sufficient_funds(winner):
+            raise NotEnoughFunds()
+        self.print_error("Bucket sets:", len(buckets))
+        return winner
+
+    def branch_and_bound(self, values, target, window):
+        '''Returns the indices of a subset of values, sorted in descending
+        order, whose sum is in [target, target + window], preferring the
+        smallest sum.  Returns None if there is none, or none was found
+        within MAX_TRIES steps.'''
+        n = len(values)
+        # remaining[i] is the most still to be had from values[i:]
+        remaining = [0] * (n + 1)
+        for i in reversed(range(n)):
+            remaining[i] = remaining[i + 1] + values[i]
+        if remaining[0] < target:
+            return None
+        best, best_excess = None, None
+        selection = []
+        total = 0
+        i = 0
+        for tries in range(self.MAX_TRIES):
+            if total + remaining[i] < target or total > target + window:
+                backtrack = True
+            elif total >= target:
+                if best is None or total - target < best_excess:
+                    best, best_excess = list(selection), total - target
+                    if best_excess == 0:
+                        break
+                backtrack = True
+            else:
+                backtrack = False
+            if backtrack:
+                if not selection:
+                    break
+                # Try leaving out the last value taken
+                i = selection.pop()
+                total -= values[i]
+                i += 1
+            else:
+                # Taking a value equal to the one just left out would
+                # only repeat the search
+                if (not selection or selection[-1] == i - 1
+                        or values[i] != values[i - 1]):
+                    selection.append(i)
+                    total += values[i]
+                i += 1
+        return best
+
+
+COIN_CHOOSERS = {
+    'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBranchAndBound,
+}
+
 def get_name(config):
     kind = config.get('coin_chooser')
     if not kind in COIN_CHOOSERS:
-        kind = 'Priority'
+        kind = 'Privacy'
     return kind
+
+def get_coin_chooser(config):
+    klass = COIN_CHOOSERS[get_name(config)]
+    return klass()
@@ -47,7 +47,9 @@ known_commands = {}
 
 def satoshis(amount):
     # satoshi conversion must not be performed by the parser
-    return int(COIN*PyDecimal(amount)) if amount not in ['!', None] else amount
+    # JSON-RPC clients send numbers as floats: go through their shortest
+    # repr, or 0.29 would become 28999999 satoshis
+    return int(COIN*PyDecimal(str(amount))) if amount not in ['!', None] else amount
 
 
 class Command:
@@ -177,6 +179,17 @@ class Commands:
         self.wallet.storage.write()
         return {'password':self.wallet.has_password()}
 
+    @command('w')
+    def setwalletformat(self, walletformat):
+        """Convert the wallet file to the given format: 'json' (readable by
+        all versions) or 'sqlite' (saves only what changed, faster for big
+        wallets, not readable by older versions). """
+        if walletformat not in ('json', 'sqlite'):
+            raise BaseException("walletformat must be 'json' or 'sqlite'")
+        self.wallet.storage.set_db_format(walletformat == 'sqlite')
+        self.wallet.storage.write()
+        return True
+
     @command('w')
     def get(self, key):
         """Return item from wallet storage"""
@@ -276,9 +289,10 @@ class Commands:
         return tx.as_dict()
 
     @command('wp')
-    def signtransaction(self, tx, privkey=None, password=None):
+    def signtransaction(self, tx, privkey=None, password=None, workers=1):
         """Sign a transaction. The wallet keys will be used unless a private key is provided."""
         tx = Transaction(tx, sign_schnorr=self.wallet and self.wallet.is_schnorr_enabled())
+        tx.set_sign_workers(workers)
         if privkey:
             txin_type, privkey2, compressed = bitcoin.deserialize_privkey(privkey)
             pubkey = bitcoin.public_key_from_private_key(privkey2, compressed)
@@ -375,6 +389,20 @@ class Commands:
         out["unconfirmed"] =  str(PyDecimal(out["unconfirmed"])/COIN)
         return out
 
+    @command('n')
+    def getaddressbalances(self, addresses):
+        """Return the balances of a list of addresses, as a dict of address to
+        balance. The queries are sent to the server together. Note: This is a
+        walletless server query, results are not checked by SPV.
+        """
+        requests = [('blockchain.scripthash.get_balance',
+                     [Address.from_string(address).to_scripthash_hex()])
+                    for address in addresses]
+        results = self.network.synchronous_get_many(requests)
+        return {address: {"confirmed": str(PyDecimal(r["confirmed"])/COIN),
+                          "unconfirmed": str(PyDecimal(r["unconfirmed"])/COIN)}
+                for address, r in zip(addresses, results)}
+
     @command('n')
     def getmerkle(self, txid, height):
         """Get Merkle branch of a transaction included in a block. Electron Cash
@@ -624,9 +652,8 @@ class Commands:
     #    pass
 
     @command('w')
-    def listrequests(self, pending=False, expired=False, paid=False):
+    def listrequests(self, pending=False, expired=False, paid=False, offset=0, limit=None):
         """List the payment requests you made."""
-        out = self.wallet.get_sorted_requests(self.config)
         if pending:
             f = PR_UNPAID
         elif expired:
@@ -635,8 +662,13 @@ class Commands:
             f = PR_PAID
         else:
             f = None
-        if f is not None:
-            out = list(filter(lambda x: x.get('status')==f, out))
+        offset = offset or 0
+        if not isinstance(offset, int) or offset < 0:
+            raise BaseException("offset must be a non-negative integer")
+        if limit is not None and (not isinstance(limit, int) or limit < 0):
+            raise BaseException("limit must be a non-negative integer")
+        out = self.wallet.get_sorted_requests(self.config, status=f,
+                                              offset=offset, count=limit)
         return list(map(self._format_request, out))
 
     @command('w')
@@ -644,6 +676,12 @@ class Commands:
         """Create a new receiving address, beyond the gap limit of the wallet"""
         return self.wallet.create_new_address(False).to_ui_string()
 
+    @command('w')
+    def createnewaddresses(self, count):
+        """Create count new receiving addresses, beyond the gap limit of the wallet"""
+        return [addr.to_ui_string()
+                for addr in self.wallet.create_new_addresses(False, count)]
+
     @command('w')
     def getunusedaddress(self):
         """Returns the first unused address of the wallet, or None if all addresses are used.
@@ -668,6 +706,29 @@ class Commands:
         out = self.wallet.get_payment_request(addr, self.config)
         return self._format_request(out)
 
+    @command('w')
+    def addrequests(self, requests, force=False):
+        """Create several payment requests, each on its own unused address.
+        Requests is a list of {"amount": ..., "memo": ..., "expiration": ...},
+        where memo and expiration are optional. If there are not enough
+        unused addresses nothing is created and False is returned, unless
+        force is set."""
+        wallet = self.wallet
+        with wallet.lock:
+            addrs = wallet.get_unused_addresses()[:len(requests)]
+            if len(addrs) < len(requests):
+                if not force:
+                    return False
+                addrs += wallet.create_new_addresses(False, len(requests) - len(addrs))
+            reqs = []
+            for addr, r in zip(addrs, requests):
+                expiration = int(r['expiration']) if r.get('expiration') else None
+                reqs.append(wallet.make_payment_request(addr, satoshis(r['amount']),
+                                                        r.get('memo', ''), expiration))
+            wallet.add_payment_requests(reqs, self.config)
+            return [self._format_request(wallet.get_payment_request(req['address'], self.config))
+                    for req in reqs]
+
     @command('wp')
     def signrequest(self, address, password=None):
         "Sign payment request with an OpenAlias"
@@ -742,6 +803,10 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in BCH).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'addresses': 'list of Bitcoin Cash addresses',
+    'count': 'Number of addresses',
+    'requests': 'list of {"amount": amount, "memo": "description", "expiration": seconds}',
+    'walletformat': "'json' or 'sqlite'",
 }
 
 command_options = {
@@ -776,6 +841,9 @@ command_options = {
     'show_addresses': (None, "Show input and output addresses"),
     'show_fiat':   (None, "Show fiat value of transactions"),
     'year':        (None, "Show history for a given year"),
+    'workers':     (None, "Number of threads to sign with (for transactions with many inputs)"),
+    'offset':      (None, "Skip this many results"),
+    'limit':       (None, "Return at most this many results"),
 }
 
 
@@ -796,6 +864,12 @@ arg_types = {
     'fee': lambda x: str(PyDecimal(x)) if x is not None else None,
     'amount': lambda x: str(PyDecimal(x)) if x != '!' else '!',
     'locktime': int,
+    'workers': int,
+    'count': int,
+    'offset': int,
+    'limit': int,
+    'addresses': json_loads,
+    'requests': json_loads,
 }
 
 config_variables = {
@@ -24,8 +24,10 @@
 # SOFTWARE.
 import ast
 import os
+import threading
 import time
 import sys
+from collections import defaultdict
 
 # from jsonrpc import JSONRPCResponseManager
 import jsonrpclib
@@ -38,6 +40,7 @@ from .util import (json_decode, DaemonThread, print_error, to_string,
 from .wallet import Wallet
 from .storage import WalletStorage
 from .commands import known_commands, Commands
+from .events import WalletEvents
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
 
@@ -151,6 +154,13 @@ class Daemon(DaemonThread):
             self.network.add_jobs([self.fx])
         self.gui = None
         self.wallets = {}
+        # RPC requests run on several threads. The lock guards self.wallets
+        # and the default wallet, and stop_wallet waits on it until the
+        # commands running on the wallet are done.
+        self.wallets_lock = threading.Condition(threading.RLock())
+        self.wallets_in_use = defaultdict(int)
+        # the wallet last loaded with 'daemon load_wallet'
+        self.default_wallet = None
         # Setup JSONRPC server
         self.init_server(config, fd, is_gui)
 
@@ -158,10 +168,15 @@ class Daemon(DaemonThread):
         host = config.get('rpchost', '127.0.0.1')
         port = config.get('rpcport', 0)
 
+        # requests are handled concurrently by this many threads, 0 handles
+        # them one at a time in the daemon thread
+        workers = config.get('rpcworkers', 8)
+
         rpc_user, rpc_password = get_rpc_credentials(config)
         try:
             server = VerifyingJSONRPCServer((host, port), logRequests=False,
-                                            rpc_user=rpc_user, rpc_password=rpc_password)
+                                            rpc_user=rpc_user, rpc_password=rpc_password,
+                                            workers=workers)
         except Exception as e:
             self.print_error('Warning: cannot initialize RPC server on host', host, e)
             self.server = None
@@ -174,10 +189,81 @@ class Daemon(DaemonThread):
         server.register_function(self.ping, 'ping')
         server.register_function(self.run_gui, 'gui')
         server.register_function(self.run_daemon, 'daemon')
-        self.cmd_runner = Commands(self.config, None, self.network)
         for cmdname in known_commands:
-            server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
+            server.register_function(self._rpc_command(cmdname), cmdname)
         server.register_function(self.run_cmdline, 'run_cmdline')
+        # long-polls hold a worker each, leave the others for everything else
+        self.events = WalletEvents(self.network, max_waiters=workers // 2)
+        self.events.start()
+        server.register_function(self.subscribe_events, 'subscribe_events')
+        server.register_function(self.get_events, 'get_events')
+        server.register_function(self.unsubscribe_events, 'unsubscribe_events')
+
+    def _rpc_command(self, cmdname):
+        def run(*args, wallet=None, **kwargs):
+            return self.run_rpc_command(cmdname, args, kwargs, wallet)
+        run.__name__ = cmdname
+        return run
+
+    def run_rpc_command(self, cmdname, args, kwargs, wallet_path=None):
+        ''' Runs a command received over JSON-RPC. Requests may name the
+        wallet to run it on with a 'wallet' keyword parameter, either the path
+        of a loaded wallet or its file name in the wallets directory. Without
+        it, the wallet last loaded with 'daemon load_wallet' is used. '''
+        with self.wallets_lock:
+            if wallet_path is None:
+                wallet = self.default_wallet
+            else:
+                wallet = self._find_wallet(wallet_path)
+            self._acquire_wallet(wallet)
+        try:
+            cmd_runner = Commands(self.config, wallet, self.network)
+            return getattr(cmd_runner, cmdname)(*args, **kwargs)
+        finally:
+            self._release_wallet(wallet)
+
+    def _acquire_wallet(self, wallet):
+        ''' Marks a wallet as in use by a command, so that stop_wallet waits
+        for the command to finish. Call with wallets_lock held. '''
+        if wallet is not None:
+            self.wallets_in_use[wallet] += 1
+
+    def _release_wallet(self, wallet):
+        if wallet is None:
+            return
+        with self.wallets_lock:
+            self.wallets_in_use[wallet] -= 1
+            if not self.wallets_in_use[wallet]:
+                del self.wallets_in_use[wallet]
+                self.wallets_lock.notify_all()
+
+    def _find_wallet(self, wallet_path):
+        wallet = self.get_wallet(standardize_path(wallet_path))
+        if wallet is None:
+            wallet = self.get_wallet(standardize_path(
+                os.path.join(self.config.path, 'wallets', wallet_path)))
+        if wallet is None:
+            raise Exception('Wallet "%s" is not loaded' % wallet_path)
+        return wallet
+
+    def subscribe_events(self, wallets=None):
+        ''' Subscribes to the events of the given wallets (paths or names as
+        for the 'wallet' parameter of commands), or of all wallets. Returns
+        the subscription id to pass to get_events. '''
+        paths = None
+        if wallets is not None:
+            paths = [self._find_wallet(w).storage.path for w in wallets]
+        return self.events.subscribe(paths)
+
+    def get_events(self, subscription, timeout=0):
+        ''' Returns the events queued for a subscription, waiting up to
+        timeout seconds for one to arrive. If the result has 'retry_after',
+        the poll could not wait and the client must wait that many seconds
+        before polling again. '''
+        return self.events.get_events(subscription, timeout)
+
+    def unsubscribe_events(self, subscription):
+        return self.events.unsubscribe(subscription)
 
     def ping(self):
         return True
@@ -190,16 +276,13 @@ class Daemon(DaemonThread):
             response = "Daemon already running"
         elif sub == 'load_wallet':
             path = config.get_wallet_path()
-            wallet = self.load_wallet(path, config.get('password'))
-            self.cmd_runner.wallet = wallet
+            with self.wallets_lock:
+                wallet = self.load_wallet(path, config.get('password'))
+                self.default_wallet = wallet
             response = True
         elif sub == 'close_wallet':
             path = config.get_wallet_path()
-            if path in self.wallets:
-                self.stop_wallet(path)
-                response = True
-            else:
-                response = False
+            response = self.stop_wallet(path)
         elif sub == 'status':
             if self.network:
                 p = self.network.get_parameters()
@@ -213,7 +296,7 @@ class Daemon(DaemonThread):
                     'auto_connect': p[4],
                     'version': PACKAGE_VERSION,
                     'wallets': {k: w.is_up_to_date()
-                                for k, w in self.wallets.items()},
+                                for k, w in list(self.wallets.items())},
                     'fee_per_kb': self.config.fee_per_kb(),
                 }
             else:
@@ -238,6 +321,10 @@ class Daemon(DaemonThread):
         return response
 
     def load_wallet(self, path, password):
+        with self.wallets_lock:
+            return self._load_wallet(path, password)
+
+    def _load_wallet(self, path, password):
         path = standardize_path(path)
         # wizard will be launched if we return
         if path in self.wallets:
@@ -263,23 +350,35 @@ class Daemon(DaemonThread):
 
     def add_wallet(self, wallet):
         path = wallet.storage.path
-        self.wallets[path] = wallet
+        with self.wallets_lock:
+            self.wallets[path] = wallet
 
     def get_wallet(self, path):
         return self.wallets.get(path)
 
     def delete_wallet(self, path):
-        self.stop_wallet(path)
-        if os.path.exists(path):
-            os.unlink(path)
-            return True
-        return False
+        with self.wallets_lock:
+            self.stop_wallet(path)
+            if os.path.exists(path):
+                os.unlink(path)
+                return True
+            return False
 
     def stop_wallet(self, path):
-        # Issue #659 wallet may already be stopped.
-        if path in self.wallets:
-            wallet = self.wallets.pop(path)
+        ''' Stops the wallet once the commands running on it are done.
+        Returns False if it was not loaded. '''
+        with self.wallets_lock:
+            # Issue #659 wallet may already be stopped.
+            wallet = self.wallets.pop(path, None)
+            if wallet is None:
+                return False
+            if self.default_wallet is wallet:
+                self.default_wallet = None
+            self.wallets_lock.wait_for(lambda: wallet not in self.wallets_in_use)
             wallet.stop_threads()
+            if self.server:
+                self.events.remove_wallet(wallet)
+            return True
 
     def run_cmdline(self, config_options):
         password = config_options.get('password')
@@ -288,13 +387,21 @@ class Daemon(DaemonThread):
         config.fee_estimates = self.network.config.fee_estimates.copy()
         cmdname = config.get('cmd')
         cmd = known_commands[cmdname]
-        if cmd.requires_wallet:
-            path = config.get_wallet_path()
-            wallet = self.wallets.get(path)
-            if wallet is None:
-                return {'error': 'Wallet "%s" is not loaded. Use "electron-cash daemon load_wallet"'%os.path.basename(path) }
-        else:
-            wallet = None
+        with self.wallets_lock:
+            if cmd.requires_wallet:
+                path = config.get_wallet_path()
+                wallet = self.wallets.get(path)
+                if wallet is None:
+                    return {'error': 'Wallet "%s" is not loaded. Use "electron-cash daemon load_wallet"'%os.path.basename(path) }
+            else:
+                wallet = None
+            self._acquire_wallet(wallet)
+        try:
+            return self._run_cmdline(config, config_options, cmd, wallet)
+        finally:
+            self._release_wallet(wallet)
+
+    def _run_cmdline(self, config, config_options, cmd, wallet):
         # arguments passed to function
         args = map(lambda x: config.get(x), cmd.params)
         # decode json arguments
@@ -314,6 +421,10 @@ class Daemon(DaemonThread):
     def run(self):
         while self.is_running():
             self.server.handle_request() if self.server else time.sleep(0.1)
+        if self.server:
+            self.events.stop()
+            # lets the commands in progress finish before the wallets stop
+            self.server.server_close()
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
         if self.network:
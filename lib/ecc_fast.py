@@ -137,4 +137,33 @@ def is_using_fast_ecc():
     return _patched_functions.monkey_patching_active
 
 
+def sign_digest(privkey, msg_hash, compressed=True):
+    ''' ECDSA-signs the 32 byte msg_hash with the 32 byte privkey entirely in
+    libsecp256k1, and checks the signature. Returns (pubkey, sig), with the
+    serialized public key and the DER encoded signature, or None for sig if
+    the check failed. The signature is low-S and RFC6979 deterministic, i.e.
+    the same one python-ecdsa's sign_digest_deterministic() makes. ctypes
+    releases the GIL for every call into the library, so threads calling
+    this sign in parallel. Raises ValueError if privkey is not a valid key.
+    Only call this if is_using_fast_ecc(). '''
+    lib, ctx = secp256k1.secp256k1, secp256k1.secp256k1.ctx
+    pubkey = create_string_buffer(64)
+    if not lib.secp256k1_ec_pubkey_create(ctx, pubkey, privkey):
+        raise ValueError('invalid private key')
+    pubkey_ser = create_string_buffer(65)
+    size = c_size_t(65)
+    lib.secp256k1_ec_pubkey_serialize(
+        ctx, pubkey_ser, byref(size), pubkey,
+        secp256k1.SECP256K1_EC_COMPRESSED if compressed else secp256k1.SECP256K1_EC_UNCOMPRESSED)
+    pubkey_bytes = pubkey_ser.raw[:size.value]
+    sig = create_string_buffer(64)
+    if (not lib.secp256k1_ecdsa_sign(ctx, sig, msg_hash, privkey, None, None)
+            or lib.secp256k1_ecdsa_verify(ctx, sig, msg_hash, pubkey) != 1):
+        return pubkey_bytes, None
+    der = create_string_buffer(72)
+    size = c_size_t(72)
+    lib.secp256k1_ecdsa_signature_serialize_der(ctx, der, byref(size), sig)
+    return pubkey_bytes, der.raw[:size.value]
+
+
 _prepare_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
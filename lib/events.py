@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# Electron Cash - A Bitcoin Cash SPV Wallet
+# License: MIT License
+#
+''' Push-style wallet notifications for the daemon's JSON-RPC server.
+
+Clients subscribe once and then long-poll for events, instead of polling
+getbalance / history / listrequests. Events are fed straight from the network
+callbacks:
+
+    {'event': 'new_transaction', 'wallet': path, 'txid': txid, 'height': h}
+    {'event': 'verified', 'wallet': path, 'txid': txid, 'height': h,
+     'timestamp': t}
+    {'event': 'verifications_undone', 'wallet': path, 'txids': [...]}
+    {'event': 'request_paid', 'wallet': path, 'address': addr, 'id': id,
+     'amount': sats, 'confirmations': conf}
+    {'event': 'wallet_updated', 'wallet': path}
+
+Only so many polls may wait at once, as each one ties up an RPC worker. A
+poll that would have to wait beyond that returns at once with 'retry_after',
+the seconds the client must wait before polling again. Polls that come
+sooner return at once without waiting, unless there are events to return.
+
+Each subscription has a bounded queue. The network thread never blocks on a
+slow client: once a queue is full the oldest events are dropped, and the next
+poll reports how many were lost so the client knows to resync.
+'''
+import os
+import threading
+import time
+from collections import deque
+
+from .address import Address
+from .paymentrequest import PR_PAID, PR_UNKNOWN
+from .util import PrintError
+
+
+class Subscription:
+    __slots__ = ('wallets', 'events', 'dropped', 'last_poll', 'retry_at')
+
+    def __init__(self, wallets, maxlen):
+        self.wallets = wallets  # set of wallet paths, or None for all
+        self.events = deque(maxlen=maxlen)
+        self.dropped = 0
+        self.last_poll = time.time()
+        self.retry_at = 0  # no waiting polls before this time
+
+    def put(self, event):
+        if (event['event'] == 'wallet_updated' and self.events
+                and self.events[-1] == event):
+            # these come in bursts, one is enough
+            return
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+
+
+class WalletEvents(PrintError):
+    ''' Fans wallet-related network callbacks out to subscribers. '''
+
+    CALLBACKS = ('new_transaction', 'verified2', 'verifications_undone',
+                 'wallet_updated')
+    MAX_QUEUE = 1000  # events kept per subscription
+    MAX_EVENTS = 500  # events returned per poll
+    MAX_TIMEOUT = 60  # longest a poll may wait, in seconds
+    EXPIRY = 600  # subscriptions not polled for this long are removed
+    BUSY_RETRY = 5  # retry_after when all waiters are taken, in seconds
+
+    def __init__(self, network, max_waiters=0):
+        self.network = network
+        # how many polls may block at once; each one ties up an RPC worker
+        self.max_waiters = max_waiters
+        self.waiters = 0
+        self.subscriptions = {}
+        # request addresses that received coins but were not paid in full
+        # (yet, or as far as we know before the wallet is up to date),
+        # keyed by wallet
+        self.pending_requests = {}
+        self.cond = threading.Condition()
+
+    def start(self):
+        if self.network:
+            self.network.register_callback(self.on_event, self.CALLBACKS)
+
+    def stop(self):
+        if self.network:
+            self.network.unregister_callback(self.on_event)
+        with self.cond:
+            self.subscriptions.clear()
+            self.cond.notify_all()
+
+    def remove_wallet(self, wallet):
+        ''' Forgets what is kept about a wallet, once it is stopped. '''
+        self.pending_requests.pop(wallet, None)
+
+    def subscribe(self, wallet_paths=None):
+        ''' Returns the id of a new subscription to events of the wallets with
+        the given paths, or of all wallets if None. '''
+        sub_id = os.urandom(16).hex()
+        with self.cond:
+            self._expire()
+            self.subscriptions[sub_id] = Subscription(
+                None if wallet_paths is None else set(wallet_paths),
+                self.MAX_QUEUE)
+        return sub_id
+
+    def unsubscribe(self, sub_id):
+        with self.cond:
+            found = self.subscriptions.pop(sub_id, None) is not None
+            self.cond.notify_all()
+        return found
+
+    def get_events(self, sub_id, timeout=0):
+        ''' Returns {'events': [...], 'dropped': n}, waiting up to timeout
+        seconds for the first event. 'dropped' counts the events lost to a
+        full queue since the previous poll.
+
+        If the poll should wait but may not, because max_waiters polls are
+        waiting already or the client ignored an earlier 'retry_after', the
+        result has 'retry_after': the seconds to wait before polling
+        again. '''
+        timeout = min(max(0, timeout), self.MAX_TIMEOUT)
+        retry_after = None
+        with self.cond:
+            self._expire()
+            sub = self._get_subscription(sub_id)
+            now = time.time()
+            if not sub.events and timeout:
+                if now < sub.retry_at:
+                    retry_after = sub.retry_at - now
+                elif self.waiters >= self.max_waiters:
+                    retry_after = min(timeout, self.BUSY_RETRY)
+                    sub.retry_at = now + retry_after
+                else:
+                    self.waiters += 1
+                    try:
+                        self.cond.wait_for(
+                            lambda: sub.events or self.subscriptions.get(sub_id) is not sub,
+                            timeout)
+                    finally:
+                        self.waiters -= 1
+                    sub = self._get_subscription(sub_id)
+            n = min(len(sub.events), self.MAX_EVENTS)
+            events = [sub.events.popleft() for i in range(n)]
+            dropped, sub.dropped = sub.dropped, 0
+            sub.last_poll = time.time()
+        result = {'events': events, 'dropped': dropped}
+        if retry_after is not None:
+            result['retry_after'] = retry_after
+        return result
+
+    def _get_subscription(self, sub_id):
+        sub = self.subscriptions.get(sub_id)
+        if sub is None:
+            raise Exception('Unknown subscription "%s"' % sub_id)
+        return sub
+
+    def _expire(self):
+        cutoff = time.time() - self.EXPIRY
+        for sub_id, sub in list(self.subscriptions.items()):
+            if sub.last_poll < cutoff:
+                self.print_error("subscription expired", sub_id)
+                del self.subscriptions[sub_id]
+
+    def _subscribers(self, path):
+        with self.cond:
+            self._expire()
+            return [sub for sub in self.subscriptions.values()
+                    if sub.wallets is None or path in sub.wallets]
+
+    def on_event(self, event, *args):
+        # network thread
+        wallet = args[1] if event == 'new_transaction' else args[0]
+        storage = getattr(wallet, 'storage', None)
+        if storage is None:
+            return
+        path = storage.path
+        if not self._subscribers(path):
+            return
+        events = []
+        if event == 'new_transaction':
+            tx = args[0]
+            txid = tx.txid()
+            height = wallet.get_tx_height(txid)[0]
+            events.append({'event': 'new_transaction', 'wallet': path,
+                           'txid': txid, 'height': height})
+            addrs = {addr for typ, addr, value in tx.outputs()
+                     if isinstance(addr, Address) and addr in wallet.receive_requests}
+            if addrs:
+                self.pending_requests.setdefault(wallet, set()).update(addrs)
+        elif event == 'verified2':
+            tx_hash, height, conf, timestamp = args[1:]
+            events.append({'event': 'verified', 'wallet': path,
+                           'txid': tx_hash, 'height': height,
+                           'timestamp': timestamp})
+        elif event == 'verifications_undone':
+            events.append({'event': 'verifications_undone', 'wallet': path,
+                           'txids': sorted(args[1])})
+        elif event == 'wallet_updated':
+            events.append({'event': 'wallet_updated', 'wallet': path})
+        events.extend(self._check_requests(wallet, path))
+        with self.cond:
+            for sub in self._subscribers(path):
+                for e in events:
+                    sub.put(e)
+            self.cond.notify_all()
+
+    def _check_requests(self, wallet, path):
+        addrs = self.pending_requests.get(wallet)
+        if not addrs:
+            return []
+        events = []
+        for addr in list(addrs):
+            r = wallet.receive_requests.get(addr)
+            status, conf = wallet.get_request_status(addr) if r else (None, None)
+            if status == PR_PAID:
+                events.append({'event': 'request_paid', 'wallet': path,
+                               'address': addr.to_ui_string(),
+                               'id': r.get('id'), 'amount': r.get('amount'),
+                               'confirmations': conf})
+            elif status == PR_UNKNOWN and r and r.get('amount'):
+                # the wallet is still syncing, look again later
+                continue
+            addrs.discard(addr)
+        if not addrs:
+            self.pending_requests.pop(wallet, None)
+        return events
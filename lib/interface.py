@@ -22,6 +22,9 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import asyncio
+import itertools
+import json
 import os
 import re
 import socket
@@ -30,6 +33,7 @@ import sys
 import threading
 import time
 import traceback
+from collections import deque
 
 import requests
 
@@ -138,6 +142,52 @@ class TcpConnection(threading.Thread, util.PrintError):
 
         return context
 
+    def save_temporary_cert(self, dercert, cert_path):
+        ''' Saves the server's certificate next to cert_path, to be pinned
+        once a connection with it succeeds. Returns the temporary path. '''
+        cert = ssl.DER_cert_to_PEM_cert(dercert)
+        # workaround android bug
+        cert = re.sub("([^\n])-----END CERTIFICATE-----","\\1\n-----END CERTIFICATE-----",cert)
+        temporary_path = cert_path + '.temp'
+        util.assert_datadir_available(self.config_path)
+        with open(temporary_path, "w", encoding='utf-8') as f:
+            f.write(cert)
+            f.flush()
+            os.fsync(f.fileno())
+        return temporary_path
+
+    def on_ssl_error(self, e, is_new, cert_path):
+        ''' Handles a failed handshake against a pinned (or about to be
+        pinned) certificate. '''
+        self.print_error("SSL error:", e)
+        if e.errno != 1:
+            return
+        if is_new:
+            rej = cert_path + '.rej'
+            if os.path.exists(rej):
+                os.unlink(rej)
+            os.rename(cert_path + '.temp', rej)
+        else:
+            util.assert_datadir_available(self.config_path)
+            with open(cert_path, encoding='utf-8') as f:
+                cert = f.read()
+            try:
+                b = pem.dePem(cert, 'CERTIFICATE')
+                x = x509.X509(b)
+            except:
+                if util.is_verbose:
+                    self.print_error("Error checking certificate, traceback follows")
+                    traceback.print_exc(file=sys.stderr)
+                self.print_error("wrong certificate")
+                return
+            try:
+                x.check_date()
+            except:
+                self.print_error("certificate has expired:", cert_path)
+                os.unlink(cert_path)
+                return
+            self.print_error("wrong certificate")
+
     def get_socket(self):
         if self.use_ssl:
             cert_path = os.path.join(self.config_path, 'certs', self.host)
@@ -175,15 +225,7 @@ class TcpConnection(threading.Thread, util.PrintError):
 
                 dercert = s.getpeercert(True)
                 s.close()
-                cert = ssl.DER_cert_to_PEM_cert(dercert)
-                # workaround android bug
-                cert = re.sub("([^\n])-----END CERTIFICATE-----","\\1\n-----END CERTIFICATE-----",cert)
-                temporary_path = cert_path + '.temp'
-                util.assert_datadir_available(self.config_path)
-                with open(temporary_path, "w", encoding='utf-8') as f:
-                    f.write(cert)
-                    f.flush()
-                    os.fsync(f.fileno())
+                temporary_path = self.save_temporary_cert(dercert, cert_path)
             else:
                 is_new = False
 
@@ -200,36 +242,7 @@ class TcpConnection(threading.Thread, util.PrintError):
                 self.print_error('timeout')
                 return
             except ssl.SSLError as e:
-                self.print_error("SSL error:", e)
-                if e.errno != 1:
-                    return
-                if is_new:
-                    rej = cert_path + '.rej'
-                    if os.path.exists(rej):
-                        os.unlink(rej)
-                    os.rename(temporary_path, rej)
-                else:
-                    util.assert_datadir_available(self.config_path)
-                    with open(cert_path, encoding='utf-8') as f:
-                        cert = f.read()
-                    try:
-                        b = pem.dePem(cert, 'CERTIFICATE')
-                        x = x509.X509(b)
-                    except:
-                        if util.is_verbose:
-                            self.print_error("Error checking certificate, traceback follows")
-                            traceback.print_exc(file=sys.stderr)
-                        self.print_error("wrong certificate")
-                        return
-                    try:
-                        x.check_date()
-                    except:
-                        self.print_error("certificate has expired:", cert_path)
-                        os.unlink(cert_path)
-                        return
-                    self.print_error("wrong certificate")
-                if e.errno == 104:
-                    return
+                self.on_ssl_error(e, is_new, cert_path)
                 return
 
             if is_new:
@@ -267,25 +280,53 @@ class Interface(util.PrintError):
     MODE_CATCH_UP = 'catch_up'
     MODE_VERIFICATION = 'verification'
 
+    # Bounds of the in-flight window: how many requests may be unanswered.
+    # It starts at INITIAL_WINDOW and adapts to the server, see _adapt_window().
+    MIN_WINDOW = 10
+    INITIAL_WINDOW = 100
+    MAX_WINDOW = 2000
+    # Requests sent together are coalesced into JSON-RPC batches of at most
+    # this many requests.
+    MAX_BATCH = 250
+    # JSON-RPC error codes servers use when we are asking too much of them
+    SERVER_BUSY_ERRORS = (-101, -102)
+
     def __init__(self, server, socket, *, max_message_bytes=0):
         self.server = server
         self.host, self.port, _ = server.rsplit(':', 2)
         self.socket = socket
 
-        self.pipe = util.SocketPipe(socket, max_message_bytes=max_message_bytes)
+        self.pipe = self.make_pipe(max_message_bytes)
         self.pipe.set_timeout(0.0)  # Don't wait for data
         # Dump network messages.  Set at runtime from the console.
         self.debug = False
-        self.unsent_requests = []
+        self.unsent_requests = deque()
         self.unanswered_requests = {}
         self.last_send = time.time()
         self.closed_remotely = False
+        # wire id -> time sent, of the unanswered requests
+        self.send_times = {}
+        self.window = self.INITIAL_WINDOW
+        self.min_rtt = None
+        self._last_shrink = 0
+        # elements of received batch responses not yet handed out
+        self._batched_responses = deque()
+        # cleared if the server turns down a batch, see _batch_failed()
+        self.batching = True
+        # wire ids of the unanswered requests that went out in batches
+        self._batched_ids = set()
+        # wire ids sent again after a batch failed, which may get answered
+        # twice if the server did answer some of our batches after all
+        self._resent_ids = set()
 
         self.mode = None
 
     def __repr__(self):
         return "<{}.{} {}>".format(__name__, type(self).__name__, self.format_address())
 
+    def make_pipe(self, max_message_bytes):
+        return util.SocketPipe(self.socket, max_message_bytes=max_message_bytes)
+
     def format_address(self):
         return "{}:{}".format(self.host, self.port)
 
@@ -317,28 +358,71 @@ class Interface(util.PrintError):
         self.unsent_requests.append(args)
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests within the in-flight window'''
+        n = self.window - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
         self.last_send = time.time()
         make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
         n = self.num_requests()
-        wire_requests = self.unsent_requests[0:n]
+        wire_requests = list(itertools.islice(self.unsent_requests, n))
+        wire_dicts = [make_dict(*r) for r in wire_requests]
+        if self.batching:
+            # lone requests go out as plain objects, the rest as batches
+            wire = [wire_dicts[i] if len(wire_dicts) - i == 1 else wire_dicts[i:i + self.MAX_BATCH]
+                    for i in range(0, n, self.MAX_BATCH)]
+        else:
+            wire = wire_dicts
         try:
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            self.pipe.send_all(wire)
         except (OSError, ssl.SSLError) as e:
             self.print_error("send_requests: {}: {}".format(type(e).__name__, e))
             return False
-        self.unsent_requests = self.unsent_requests[n:]
         for request in wire_requests:
+            self.unsent_requests.popleft()
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = self.last_send
+        for item in wire:
+            if type(item) is list:
+                self._batched_ids.update(d['id'] for d in item)
         return True
 
+    def _batch_failed(self, response):
+        '''The server answered a batch with a single error, which has no id
+        to tell which batch it was about.  Stop batching with this server
+        and send every request still waiting on a batch again, on its
+        own.'''
+        self.print_error("batch request failed, no longer batching:", response.get('error'))
+        self.batching = False
+        resend = [request for wire_id, request in self.unanswered_requests.items()
+                  if wire_id in self._batched_ids]
+        for request in resend:
+            del self.unanswered_requests[request[2]]
+            del self.send_times[request[2]]
+            self._resent_ids.add(request[2])
+        self._batched_ids.clear()
+        self.unsent_requests.extendleft(reversed(resend))
+
+    def _adapt_window(self, rtt, busy):
+        '''Grows the in-flight window by one for every prompt answer, and
+        shrinks it by a quarter, at most once per round trip, when the
+        server says it is busy or the round trip time has gone up well
+        beyond the best seen, i.e. when requests are queueing up at the
+        server rather than on the wire.'''
+        now = time.time()
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if busy or rtt > 4 * self.min_rtt + 0.5:
+            if now - self._last_shrink > rtt:
+                self._last_shrink = now
+                self.window = max(self.MIN_WINDOW, self.window * 3 // 4)
+        elif self.window < self.MAX_WINDOW:
+            self.window += 1
+
     def ping_required(self):
         '''Returns True if a ping should be sent.'''
         return time.time() - self.last_send > 300
@@ -363,14 +447,21 @@ class Interface(util.PrintError):
         '''
         responses = []
         while True:
-            try:
-                response = self.pipe.get()
-            except util.timeout:
-                break
-            except self.pipe.MessageSizeExceeded as e:
-                self.print_error(repr(e))
-                responses.append((None, None))  # signals Network class to close this connection
-                break
+            if self._batched_responses:
+                response = self._batched_responses.popleft()
+            else:
+                try:
+                    response = self.pipe.get()
+                except util.timeout:
+                    break
+                except self.pipe.MessageSizeExceeded as e:
+                    self.print_error(repr(e))
+                    responses.append((None, None))  # signals Network class to close this connection
+                    break
+                if type(response) is list and response:
+                    # answer to a batch request
+                    self._batched_responses.extend(response)
+                    continue
             if not type(response) is dict:
                 responses.append((None, None))
                 if response is None:
@@ -380,12 +471,21 @@ class Interface(util.PrintError):
             if self.debug:
                 self.print_error("<--", response)
             wire_id = response.get('id', None)
-            if wire_id is None:  # Notification
+            if wire_id is None and 'error' in response and 'method' not in response:
+                self._batch_failed(response)
+            elif wire_id is None:  # Notification
                 responses.append((None, response))
             else:
                 request = self.unanswered_requests.pop(wire_id, None)
+                self._batched_ids.discard(wire_id)
                 if request:
+                    error = response.get('error')
+                    busy = isinstance(error, dict) and error.get('code') in self.SERVER_BUSY_ERRORS
+                    self._adapt_window(time.time() - self.send_times.pop(wire_id), busy)
                     responses.append((request, response))
+                elif wire_id in self._resent_ids:
+                    # the second answer to a request sent again
+                    self._resent_ids.discard(wire_id)
                 else:
                     self.print_error("unknown wire ID", wire_id)
                     responses.append((None, None)) # Signal
@@ -394,6 +494,233 @@ class Interface(util.PrintError):
         return responses
 
 
+class AsyncTcpConnection(TcpConnection):
+    """asyncio counterpart of TcpConnection, for Networks that run an event
+    loop.  The TCP and TLS handshakes happen on the loop instead of in a
+    thread of their own; certificates are checked and pinned exactly like
+    TcpConnection does.
+
+    Once connected, (server, (reader, writer)) is put on the queue, or
+    (server, None) if the connection failed.
+    """
+
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, server, queue, config_path, *, limit):
+        super().__init__(server, queue, config_path)
+        self.limit = limit
+
+    def _is_proxied(self):
+        # Network.set_proxy() swaps socket.socket for a SOCKS socket, which
+        # the event loop cannot drive through its handshake.
+        return socket.socket is not getattr(socket, '_socketobject', socket.socket)
+
+    async def open_streams(self, context):
+        if self._is_proxied():
+            loop = asyncio.get_event_loop()
+            s = await loop.run_in_executor(None, self.get_simple_socket)
+            if s is None:
+                return
+            coro = asyncio.open_connection(sock=s, ssl=context, limit=self.limit,
+                                           server_hostname=self.host if context else None)
+        else:
+            coro = asyncio.open_connection(self.host, self.port, ssl=context, limit=self.limit)
+        try:
+            reader, writer = await asyncio.wait_for(coro, self.CONNECT_TIMEOUT)
+        except (asyncio.TimeoutError, OSError) as e:
+            if isinstance(e, ssl.SSLError):
+                raise
+            self.print_error("failed to connect", repr(e))
+            return
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return reader, writer
+
+    async def get_streams(self):
+        if not self.use_ssl:
+            return await self.open_streams(None)
+        cert_path = os.path.join(self.config_path, 'certs', self.host)
+        if not os.path.exists(cert_path):
+            is_new = True
+            # try with CA first
+            context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_path)
+            try:
+                streams = await self.open_streams(context)
+            except ssl.SSLError as e:
+                self.print_error(e)
+                streams = None
+            if streams:
+                if self.check_host_name(streams[1].get_extra_info('peercert'), self.host):
+                    self.print_error("SSL certificate signed by CA")
+                    return streams
+                streams[1].close()
+            # get server certificate.
+            context = self.get_ssl_context(cert_reqs=ssl.CERT_NONE, ca_certs=None)
+            try:
+                streams = await self.open_streams(context)
+            except ssl.SSLError as e:
+                self.print_error("SSL error retrieving SSL certificate:", e)
+                return
+            if not streams:
+                return
+            dercert = streams[1].get_extra_info('ssl_object').getpeercert(True)
+            streams[1].close()
+            temporary_path = self.save_temporary_cert(dercert, cert_path)
+        else:
+            is_new = False
+
+        context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED,
+                                       ca_certs=(temporary_path if is_new else cert_path))
+        try:
+            streams = await self.open_streams(context)
+        except ssl.SSLError as e:
+            self.on_ssl_error(e, is_new, cert_path)
+            return
+        if streams and is_new:
+            self.print_error("saving certificate")
+            os.rename(temporary_path, cert_path)
+        return streams
+
+    async def connect(self):
+        try:
+            streams = await self.get_streams()
+        except OSError:
+            if util.is_verbose:
+                self.print_error("Error getting socket, traceback follows")
+                traceback.print_exc(file=sys.stderr)
+            streams = None
+
+        if streams:
+            self.print_error("connected")
+        self.queue.put((self.server, streams))
+
+
+class AsyncPipe(util.PrintError):
+    """The part of util.SocketPipe that Interface uses, over asyncio streams.
+    A reader task decodes incoming messages as they arrive and a writer task
+    drains outgoing data, so a slow server only ever backs up its own
+    queue.  get() never blocks: it raises util.timeout once the decoded
+    messages run out.
+    """
+
+    MessageSizeExceeded = util.SocketPipe.MessageSizeExceeded
+
+    def __init__(self, reader, writer, *, on_message=None):
+        self.reader = reader
+        self.writer = writer
+        # called on the loop whenever messages were received
+        self.on_message = on_message
+        self.messages = []
+        self.recv_time = time.time()
+        self.loop = asyncio.get_event_loop()
+        self._send_buffer = bytearray()
+        self._send_lock = threading.Lock()
+        self._send_ready = asyncio.Event()
+        self.tasks = [self.loop.create_task(self._read_loop()),
+                      self.loop.create_task(self._write_loop())]
+
+    def set_timeout(self, t):
+        pass
+
+    def idle_time(self):
+        return time.time() - self.recv_time
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readuntil(b'\n')
+                self.recv_time = time.time()
+                try:
+                    self.messages.append(json.loads(line))
+                except ValueError:
+                    continue
+                if self.on_message:
+                    self.on_message()
+        except asyncio.CancelledError:
+            raise
+        except asyncio.LimitOverrunError as e:
+            self.messages.append(self.MessageSizeExceeded(repr(e)))
+        except (asyncio.IncompleteReadError, OSError) as e:
+            # Connection closed remotely
+            self.messages.append(None)
+        if self.on_message:
+            self.on_message()
+
+    async def _write_loop(self):
+        while True:
+            await self._send_ready.wait()
+            self._send_ready.clear()
+            with self._send_lock:
+                data, self._send_buffer = self._send_buffer, bytearray()
+            try:
+                self.writer.write(data)
+                # wait for the transport's buffer to empty below its limit
+                await self.writer.drain()
+            except OSError as e:
+                self.print_error("send: {}: {}".format(type(e).__name__, e))
+                return
+
+    def get(self):
+        if not self.messages:
+            raise util.timeout
+        msg = self.messages.pop(0)
+        if isinstance(msg, self.MessageSizeExceeded):
+            raise msg
+        return msg
+
+    def send_all(self, requests):
+        if self.writer.transport.is_closing():
+            raise OSError("connection closed")
+        data = b''.join((json.dumps(x) + '\n').encode('utf8') for x in requests)
+        with self._send_lock:
+            self._send_buffer += data
+        self.loop.call_soon_threadsafe(self._send_ready.set)
+
+    def clean_up(self):
+        self.messages = []
+        for task in self.tasks:
+            self.loop.call_soon_threadsafe(task.cancel)
+
+
+class AsyncInterface(Interface):
+    """An Interface over asyncio streams, as made by AsyncTcpConnection.
+
+    Its requests are written as soon as they are queued rather than on the
+    next select() round, and on_message is called on the loop as soon as
+    responses arrive, so get_responses() never has to wait.
+    """
+
+    def __init__(self, server, streams, *, max_message_bytes=0, on_message=None):
+        self.reader, self.writer = streams
+        self.on_message = on_message
+        super().__init__(server, self.writer.get_extra_info('socket'),
+                         max_message_bytes=max_message_bytes)
+
+    def make_pipe(self, max_message_bytes):
+        # the size limit is enforced by the reader, see AsyncTcpConnection
+        on_message = self.on_message and (lambda: self.on_message(self))
+        return AsyncPipe(self.reader, self.writer, on_message=on_message)
+
+    def fileno(self):
+        # Not used with select
+        return -1
+
+    def queue_request(self, *args):
+        super().queue_request(*args)
+        if self.num_requests():
+            self.send_requests()
+
+    def get_responses(self):
+        responses = super().get_responses()
+        # the in-flight window may have opened up
+        if self.num_requests():
+            self.send_requests()
+        return responses
+
+    def close(self):
+        self.pipe.clean_up()
+        self.pipe.loop.call_soon_threadsafe(self.writer.close)
+
+
 def check_cert(host, cert):
     try:
         b = pem.dePem(cert, 'CERTIFICATE')
@@ -25,6 +25,8 @@
 
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
 from base64 import b64decode
+import queue
+import threading
 import time
 
 from . import util
@@ -47,11 +49,33 @@ class RPCAuthUnsupportedType(Exception):
 
 # based on http://acooke.org/cute/BasicHTTPA0.html by andrew cooke
 class VerifyingJSONRPCServer(SimpleJSONRPCServer):
+    ''' If workers > 0, requests are handled concurrently in a pool of that
+    many threads, and handle_request() only accepts the connection. With
+    workers=0 each request is handled within handle_request().
 
-    def __init__(self, *args, rpc_user, rpc_password, **kargs):
+    The workers are not daemon threads, as commands run on them may write
+    wallet files (WalletStorage refuses to write from a daemon thread), and
+    server_close() waits for the requests in progress to finish.
+
+    At most as many accepted requests as there are workers wait for one.
+    When that many are waiting, handle_request() blocks until a worker is
+    free, and further connections wait in the listen backlog.
+
+    Connections are not kept alive: an idle connection would tie up a worker.
+    Clients that want to pipeline calls send them as a JSON-RPC batch. '''
+
+    # listen() backlog; socketserver's default of 5 drops connections when
+    # many clients connect at once
+    request_queue_size = 128
+
+    def __init__(self, *args, rpc_user, rpc_password, workers=0, **kargs):
 
         self.rpc_user = rpc_user
         self.rpc_password = rpc_password
+        self.requests = queue.Queue(maxsize=workers)
+        self.workers = [threading.Thread(target=self._worker, daemon=False,
+                                         name='RPC worker {}'.format(i))
+                        for i in range(workers)]
 
         class VerifyingRequestHandler(SimpleJSONRPCRequestHandler):
             def parse_request(myself):
@@ -72,6 +96,35 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
 
         SimpleJSONRPCServer.__init__(
             self, requestHandler=VerifyingRequestHandler, *args, **kargs)
+        for t in self.workers:
+            t.start()
+
+    def process_request(self, request, client_address):
+        if not self.workers:
+            super().process_request(request, client_address)
+        else:
+            self.requests.put((request, client_address))
+
+    def _worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for t in self.workers:
+            self.requests.put(None)
+        for t in self.workers:
+            if t is not threading.current_thread():
+                t.join()
 
     def authenticate(self, headers):
         if self.rpc_password == '':
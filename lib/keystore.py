@@ -261,7 +261,7 @@ class Xpub:
     def get_master_public_key(self):
         return self.xpub
 
-    def derive_pubkey(self, for_change, n):
+    def get_branch_xpub(self, for_change):
         xpub = self.xpub_change if for_change else self.xpub_receive
         if xpub is None:
             xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
@@ -269,8 +269,19 @@ class Xpub:
                 self.xpub_change = xpub
             else:
                 self.xpub_receive = xpub
+        return xpub
+
+    def derive_pubkey(self, for_change, n):
+        xpub = self.get_branch_xpub(for_change)
         return self.get_pubkey_from_xpub(xpub, (n,))
 
+    def derive_pubkey_range(self, for_change, start, count):
+        ''' Returns the hex pubkeys for indices start .. start+count-1 of the
+        branch, deriving them all from the branch key in one go. '''
+        xpub = self.get_branch_xpub(for_change)
+        _, _, _, _, c, cK = deserialize_xpub(xpub)
+        return [bh2u(K) for K in CKD_pub_range(cK, c, start, count)]
+
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
         _, _, _, _, c, cK = deserialize_xpub(xpub)
@@ -470,6 +481,10 @@ class Old_KeyStore(Deterministic_KeyStore):
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkey_range(self, for_change, start, count):
+        return [self.derive_pubkey(for_change, n)
+                for n in range(start, start + count)]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
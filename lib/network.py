@@ -21,6 +21,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
 import time
 import queue
 import os
@@ -40,7 +41,7 @@ from . import bitcoin
 from .bitcoin import *
 from . import networks
 from .i18n import _
-from .interface import Connection, Interface
+from .interface import Connection, Interface, AsyncTcpConnection, AsyncInterface
 from . import blockchain
 from . import version
 
@@ -192,6 +193,11 @@ class Network(util.DaemonThread):
     Connections are initiated by a Connection() thread which stops once
     the connection succeeds or fails.
 
+    With the 'asyncio_network' config option set, the network thread runs an
+    asyncio event loop instead of polling the sockets with select().  Then
+    connections are made by AsyncTcpConnection on that loop, each server is
+    an AsyncInterface, and responses are processed as soon as they arrive.
+
     Our external API:
 
     - Member functions get_header(), get_interfaces(), get_local_height(),
@@ -246,8 +252,11 @@ class Network(util.DaemonThread):
         self.banner = ''
         self.donation_address = ''
         self.relay_fee = None
-        # callbacks passed with subscriptions
+        # callbacks passed with subscriptions; a subscription is shared by
+        # all the callbacks in its list and lives until the last one leaves
         self.subscriptions = defaultdict(list)
+        # callback -> keys of self.subscriptions it is in
+        self.subscriptions_by_callback = defaultdict(set)
         self.sub_cache = {}                     # note: needs self.interface_lock
         # callbacks set by the GUI
         self.callbacks = defaultdict(list)
@@ -261,6 +270,8 @@ class Network(util.DaemonThread):
         self.subscribed_addresses = set()
         # Requests from client we've not seen a response to
         self.unanswered_requests = {}
+        # callback -> message ids of its entries in self.unanswered_requests
+        self.requests_by_callback = defaultdict(set)
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -273,6 +284,10 @@ class Network(util.DaemonThread):
         self.connecting = set()
         self.requested_chunks = set()
         self.socket_queue = queue.Queue()
+        # event loop for the 'asyncio_network' option, run by the network thread
+        self.loop = asyncio.new_event_loop() if self.config.get('asyncio_network', False) else None
+        self._wakeup = None  # asyncio.Event that cuts the loop's tick short
+        self._async_connections = set()  # tasks running AsyncTcpConnection.connect()
         if Network.INSTANCE:
             # This happens on iOS which kills and restarts the daemon on app sleep/wake
             self.print_error("A new instance has started and is replacing the old one.")
@@ -423,6 +438,7 @@ class Network(util.DaemonThread):
                 # Indicate to client code we are busy
                 return None
             self.unanswered_requests[message_id] = [method, params, callback]
+            self.requests_by_callback[callback].add(message_id)
             if not interface:
                 # Request was queued -- it should get sent if/when we get
                 # an interface in the future
@@ -441,6 +457,7 @@ class Network(util.DaemonThread):
         # Resend unanswered requests
         old_reqs = self.unanswered_requests
         self.unanswered_requests = {}
+        self.requests_by_callback.clear()
         for m_id, request in old_reqs.items():
             message_id = self.queue_request(request[0], request[1], callback = request[2])
             assert message_id is not None
@@ -551,7 +568,22 @@ class Network(util.DaemonThread):
                 self.print_error("connecting to %s as new interface" % server_key)
                 self.set_status('connecting')
             self.connecting.add(server_key)
-            c = Connection(server_key, self.socket_queue, self.config.path)
+            if self.loop:
+                c = AsyncTcpConnection(server_key, self.socket_queue, self.config.path,
+                                       limit=self.MAX_MESSAGE_BYTES)
+                self.loop.call_soon_threadsafe(self._start_async_connection, c)
+            else:
+                c = Connection(server_key, self.socket_queue, self.config.path)
+
+    def _start_async_connection(self, c):
+        async def connect():
+            try:
+                await c.connect()
+            finally:
+                self._async_connections.discard(task)
+            self.wakeup()
+        task = self.loop.create_task(connect())
+        self._async_connections.add(task)
 
     def get_unavailable_servers(self):
         exclude_set = set(self.interfaces)
@@ -810,6 +842,17 @@ class Network(util.DaemonThread):
         """ hashable index for subscriptions and cache"""
         return str(method) + (':' + str(params[0]) if params else '')
 
+    def pop_unanswered_request(self, message_id):
+        ''' Removes and returns the client request with message_id, or None. '''
+        client_req = self.unanswered_requests.pop(message_id, None)
+        if client_req:
+            ids = self.requests_by_callback.get(client_req[2])
+            if ids is not None:
+                ids.discard(message_id)
+                if not ids:
+                    self.requests_by_callback.pop(client_req[2], None)
+        return client_req
+
     def process_responses(self, interface):
         responses = interface.get_responses()
         for request, response in responses:
@@ -819,7 +862,7 @@ class Network(util.DaemonThread):
                 # client requests go through self.send() with a
                 # callback, are only sent to the current interface,
                 # and are placed in the unanswered_requests dictionary
-                client_req = self.unanswered_requests.pop(message_id, None)
+                client_req = self.pop_unanswered_request(message_id)
                 if client_req:
                     if interface != self.interface:
                         self.print_error("advisory: response from non-primary {}".format(interface))
@@ -873,6 +916,7 @@ class Network(util.DaemonThread):
         if messages: # Guard against empty message-list which is a no-op and just wastes CPU to enque/dequeue (not even callback is called). I've seen the code send empty message lists before in synchronizer.py
             with self.pending_sends_lock:
                 self.pending_sends.append((messages, callback))
+            self.wakeup()
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -893,6 +937,7 @@ class Network(util.DaemonThread):
                     l = self.subscriptions[k] # <-- it's a defaultdict(list)
                     if callback not in l:
                         l.append(callback)
+                        self.subscriptions_by_callback[callback].add(k)
                     # check cached response for subscriptions
                     r = self.sub_cache.get(k)
                 if r is not None:
@@ -920,10 +965,13 @@ class Network(util.DaemonThread):
         # no callbacks will exist to process them. For subscriptions we will
         # however cache the 'result' hash and feed it back in case a wallet that
         # was closed gets reopened (self.sub_cache).
+        # Only the subscriptions this callback is in are visited; those shared
+        # with other callbacks stay alive for them.
         ct = 0
         with self.lock:
-            for k,v in self.subscriptions.copy().items():
-                if callback in v:
+            for k in self.subscriptions_by_callback.pop(callback, ()):
+                v = self.subscriptions.get(k)
+                if v and callback in v:
                     v.remove(callback)
                     if not v:
                         # remove empty list
@@ -942,9 +990,8 @@ class Network(util.DaemonThread):
         # be safely ignored. This is better than the alternative which is to
         # keep references to an object that declared itself defunct.
         ct = 0
-        for message_id, client_req in self.unanswered_requests.copy().items():
-            if callback == client_req[2]:
-                self.unanswered_requests.pop(message_id, None) # guard against race conditions here. Note: this usually is called from the network thread but who knows what future programmers may do. :)
+        for message_id in self.requests_by_callback.pop(callback, ()):
+            if self.unanswered_requests.pop(message_id, None): # guard against race conditions here. Note: this usually is called from the network thread but who knows what future programmers may do. :)
                 ct += 1
         ct2 = self._cancel_pending_sends(callback)
         if ct or ct2:
@@ -970,7 +1017,11 @@ class Network(util.DaemonThread):
     def new_interface(self, server_key, socket):
         self.add_recent_server(server_key)
 
-        interface = Interface(server_key, socket, max_message_bytes=self.MAX_MESSAGE_BYTES)
+        if self.loop:
+            interface = AsyncInterface(server_key, socket, max_message_bytes=self.MAX_MESSAGE_BYTES,
+                                       on_message=self._on_async_message)
+        else:
+            interface = Interface(server_key, socket, max_message_bytes=self.MAX_MESSAGE_BYTES)
         interface.blockchain = None
         interface.tip_header = None
         interface.tip = 0
@@ -1440,13 +1491,15 @@ class Network(util.DaemonThread):
         filename = b.path()
         # NB: HEADER_SIZE = 80 bytes
         length = blockchain.HEADER_SIZE * (networks.net.VERIFICATION_BLOCK_HEIGHT + 1)
-        if not os.path.exists(filename) or os.path.getsize(filename) < length:
-            with open(filename, 'wb') as f:
-                if length>0:
-                    f.seek(length-1)
-                    f.write(b'\x00')
-        util.ensure_sparse_file(filename)
         with b.lock:
+            # the file may be replaced below, so it must not be mapped
+            b.close_mmap()
+            if not os.path.exists(filename) or os.path.getsize(filename) < length:
+                with open(filename, 'wb') as f:
+                    if length>0:
+                        f.seek(length-1)
+                        f.write(b'\x00')
+            util.ensure_sparse_file(filename)
             b.update_size()
 
     def run(self):
@@ -1458,15 +1511,61 @@ class Network(util.DaemonThread):
         if header is not None:
             self.verified_checkpoint = True
 
+        if self.loop:
+            try:
+                self.loop.run_until_complete(self._run_async())
+            finally:
+                self.loop.close()
+        else:
+            while self.is_running():
+                self.maintain_sockets()
+                self.wait_on_sockets()
+                self.maintain_requests()
+                if self.verified_checkpoint:
+                    self.run_jobs()    # Synchronizer and Verifier and Fx
+                self.process_pending_sends()
+        self.stop_network()
+        self.on_stop()
+
+    async def _run_async(self):
+        ''' The network thread's main loop with 'asyncio_network'.  Interfaces
+        read and write on their own tasks; this runs the periodic work, at
+        least every 0.1s and right away when woken by wakeup(). '''
+        self._wakeup = asyncio.Event()
         while self.is_running():
+            self._wakeup.clear()
             self.maintain_sockets()
-            self.wait_on_sockets()
             self.maintain_requests()
             if self.verified_checkpoint:
                 self.run_jobs()    # Synchronizer and Verifier and Fx
             self.process_pending_sends()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), 0.1)
+            except asyncio.TimeoutError:
+                pass
+        with self.interface_lock:
+            tasks = [t for i in self.interfaces.values() for t in i.pipe.tasks]
+        tasks += self._async_connections
+        for task in self._async_connections:
+            task.cancel()
         self.stop_network()
-        self.on_stop()
+        # let the closed interfaces' tasks wind down
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def wakeup(self):
+        ''' Makes the event loop run its periodic work now. Thread safe; a
+        no-op without 'asyncio_network'. '''
+        if self.loop and self._wakeup:
+            try:
+                self.loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                # loop already closed
+                pass
+
+    def _on_async_message(self, interface):
+        if self.interfaces.get(interface.server) is interface:
+            self.process_responses(interface)
+            self.wakeup()
 
     def on_server_version(self, interface, version_data):
         interface.server_version = version_data
@@ -1679,6 +1778,27 @@ class Network(util.DaemonThread):
             raise util.ServerError(r.get('error'))
         return r.get('result')
 
+    def synchronous_get_many(self, requests, timeout=30):
+        ''' Like synchronous_get, for a list of (method, params) requests.
+        They are sent together, so this takes about one round trip rather
+        than one per request. Returns the list of results in the order of
+        requests. '''
+        key = lambda method, params: (method, json.dumps(params))
+        unique = {key(*req): req for req in requests}
+        q = queue.Queue()
+        self.send(unique.values(), q.put)
+        results = {}
+        deadline = time.time() + timeout
+        while len(results) < len(unique):
+            try:
+                r = q.get(True, max(0, deadline - time.time()))
+            except queue.Empty:
+                raise util.TimeoutException('Server did not answer')
+            if r.get('error'):
+                raise util.ServerError(r.get('error'))
+            results[key(r.get('method'), r.get('params'))] = r.get('result')
+        return [results[key(*req)] for req in requests]
+
     def get_raw_tx_for_txid(self, txid, timeout=30):
         ''' Used by UI code to retrieve a transaction from the blockchain by
         txid.  (Qt Gui: Tools -> Load transaction -> From the blockchain)
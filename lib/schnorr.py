@@ -246,6 +246,177 @@ def verify(pubkey, signature, message_hash):
 
         return (R.x().to_bytes(32, 'big') == rbytes)
 
+def verify_batch(pubkeys, signatures, message_hashes):
+    '''Verify many Schnorr signatures at once.
+
+    The arguments are equal-length sequences of what `verify` takes. Returns
+    the list of indices whose signature is invalid, so an empty list means
+    they all verified. Raises ValueError for malformed arguments, like
+    `verify`.
+
+    With libsecp256k1 this is just `verify` in a loop, as the library has
+    no batch API and it is faster than doing point arithmetic from Python.
+    The pure python path checks a random linear combination of all the
+    verification equations,
+
+        (sum a_i*s_i)*G == sum a_i*R_i + sum (a_i*e_i)*P_i
+
+    with one multi-scalar multiplication (summing the coefficients of
+    repeated pubkeys first), and bisects to find the culprits if that
+    fails.'''
+    if not (len(pubkeys) == len(signatures) == len(message_hashes)):
+        raise ValueError('pubkeys, signatures and message_hashes must have the same length')
+    if _secp256k1_schnorr_verify:
+        return [i for i, args in enumerate(zip(pubkeys, signatures, message_hashes))
+                if not verify(*args)]
+
+    G = ecdsa.SECP256k1.generator
+    order = G.order()
+    p = G.curve().p()
+    # per item: (pubkey bytes (compressed), pubkey point, R point, s, e), or
+    # None if the signature was found to be invalid without any curve math
+    items = []
+    bad = []
+    point_cache = {}
+    for i, (pubkey, signature, message_hash) in enumerate(zip(pubkeys, signatures, message_hashes)):
+        if not isinstance(pubkey, bytes) or len(pubkey) not in (33, 65):
+            raise ValueError('pubkey #{} must be a bytes object of either length 33 or 65'.format(i))
+        if not isinstance(signature, bytes) or len(signature) != 64:
+            raise ValueError('signature #{} must be a bytes object of length 64'.format(i))
+        if not isinstance(message_hash, bytes) or len(message_hash) != 32:
+            raise ValueError('message_hash #{} must be a bytes object of length 32'.format(i))
+        pub = point_cache.get(pubkey)
+        if pub is None:
+            try:
+                pubpoint = ser_to_point(pubkey)
+            except:
+                raise ValueError('pubkey #{} could not be parsed'.format(i))
+            pub = point_cache[pubkey] = (point_to_ser(pubpoint, comp=True),
+                                         (pubpoint.x(), pubpoint.y()))
+        r = int.from_bytes(signature[:32], 'big')
+        s = int.from_bytes(signature[32:], 'big')
+        R = _lift_x_square_y(r, p)
+        if s >= order or R is None:
+            bad.append(i)
+            continue
+        e = int.from_bytes(hashlib.sha256(signature[:32] + pub[0] + message_hash).digest(), 'big')
+        items.append((i, pub, R, s, e))
+
+    def check(items):
+        if len(items) == 1:
+            i, pub, R, s, e = items[0]
+            # no need for randomization for a single equation
+            return _is_infinity(_multi_mul([(s, (G.x(), G.y())),
+                                            (order - 1, R),
+                                            (order - e, pub[1])], p))
+        s_sum = 0
+        coeffs = {}  # affine point -> scalar
+        for n, (i, pub, R, s, e) in enumerate(items):
+            a = 1 if n == 0 else int.from_bytes(os.urandom(16), 'big') or 1
+            s_sum += a * s
+            coeffs[R] = coeffs.get(R, 0) - a
+            coeffs[pub[1]] = coeffs.get(pub[1], 0) - a * e
+        pairs = [(k % order, P) for P, k in coeffs.items()]
+        pairs.append((s_sum % order, (G.x(), G.y())))
+        return _is_infinity(_multi_mul(pairs, p))
+
+    def find_bad(items):
+        if not items or check(items):
+            return
+        if len(items) == 1:
+            bad.append(items[0][0])
+            return
+        half = len(items) // 2
+        find_bad(items[:half])
+        find_bad(items[half:])
+
+    find_bad(items)
+    return sorted(bad)
+
+def _lift_x_square_y(x, p):
+    ''' The affine point (x, y) with jacobi(y) == 1, or None if x is not a
+    valid x coordinate. Since p % 4 == 3 and (p+1)/4 is even, the square
+    root computed as c^((p+1)/4) is itself a square. '''
+    if x >= p:
+        return None
+    c = (pow(x, 3, p) + 7) % p
+    y = pow(c, (p + 1) // 4, p)
+    if y * y % p != c:
+        return None
+    return x, y
+
+# Jacobian coordinates (X, Y, Z) on y^2 = x^3 + 7, with Z == 0 at infinity.
+# Used by _multi_mul, which does a lot of additions and so can't afford the
+# modular inversion of affine arithmetic at each one.
+_INFINITY = (1, 1, 0)
+
+def _is_infinity(P):
+    return P[2] == 0
+
+def _jacobian_double(P, p):
+    X, Y, Z = P
+    if not Y or not Z:
+        return _INFINITY
+    YY = Y * Y % p
+    S = 4 * X * YY % p
+    M = 3 * X * X % p
+    X3 = (M * M - 2 * S) % p
+    Y3 = (M * (S - X3) - 8 * YY * YY) % p
+    Z3 = 2 * Y * Z % p
+    return X3, Y3, Z3
+
+def _jacobian_add(P, Q, p):
+    if not P[2]:
+        return Q
+    if not Q[2]:
+        return P
+    X1, Y1, Z1 = P
+    X2, Y2, Z2 = Q
+    Z1Z1 = Z1 * Z1 % p
+    Z2Z2 = Z2 * Z2 % p
+    U1 = X1 * Z2Z2 % p
+    U2 = X2 * Z1Z1 % p
+    S1 = Y1 * Z2 * Z2Z2 % p
+    S2 = Y2 * Z1 * Z1Z1 % p
+    if U1 == U2:
+        if S1 != S2:
+            return _INFINITY
+        return _jacobian_double(P, p)
+    H = (U2 - U1) % p
+    HH = H * H % p
+    HHH = H * HH % p
+    r = (S2 - S1) % p
+    V = U1 * HH % p
+    X3 = (r * r - HHH - 2 * V) % p
+    Y3 = (r * (V - X3) - S1 * HHH) % p
+    Z3 = Z1 * Z2 * H % p
+    return X3, Y3, Z3
+
+def _multi_mul(pairs, p):
+    ''' sum(k*P for k, P in pairs), where P is an affine (x, y) tuple and
+    0 <= k < 2**256, using Pippenger's bucket method. Returns a Jacobian
+    point. '''
+    c = max(1, min(12, len(pairs).bit_length() - 2))  # window size in bits
+    mask = (1 << c) - 1
+    points = [(k, (x, y, 1)) for k, (x, y) in pairs if k]
+    result = _INFINITY
+    for shift in reversed(range(0, 256, c)):
+        for _ in range(c):
+            result = _jacobian_double(result, p)
+        buckets = [_INFINITY] * (mask + 1)
+        for k, P in points:
+            b = (k >> shift) & mask
+            if b:
+                buckets[b] = _jacobian_add(buckets[b], P, p)
+        # sum(b * buckets[b]) with running sums
+        running = total = _INFINITY
+        for b in range(mask, 0, -1):
+            running = _jacobian_add(running, buckets[b], p)
+            total = _jacobian_add(total, running, p)
+        result = _jacobian_add(result, total, p)
+    return result
+
+
 class BlindSigner:
     """ Schnorr blind signature creator, signer side.
 
@@ -32,6 +32,8 @@ import stat
 import hmac, hashlib
 import base64
 import zlib
+import sqlite3
+from contextlib import closing
 
 from .address import Address
 from .util import PrintError, profiler, standardize_path
@@ -47,8 +49,51 @@ NEW_SEED_VERSION = 11       # electrum versions >= 2.0
 FINAL_SEED_VERSION = 17     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
+DB_MAGIC = b'SQLite format 3\x00'
+
 TMP_SUFFIX = ".tmp.{}".format(os.getpid())
 
+_json_scalars = (str, int, float, bool, type(None))
+
+def _deepcopy(value):
+    ''' copy.deepcopy for JSON-able values, without the memo bookkeeping.
+    Scalars are immutable so they are shared. '''
+    t = type(value)
+    if t is dict:
+        return {k: v if type(v) is str or type(v) is int else _deepcopy(v)
+                for k, v in value.items()}
+    if t is list:
+        return [v if type(v) is str or type(v) is int else _deepcopy(v)
+                for v in value]
+    if t is tuple:
+        return tuple(v if type(v) is str or type(v) is int else _deepcopy(v)
+                     for v in value)
+    if isinstance(value, _json_scalars):
+        return value
+    return copy.deepcopy(value)
+
+def check_json_value(value):
+    ''' Raises TypeError if value cannot be saved in a wallet file, ie is not
+    made of dicts (with scalar keys), lists, tuples and JSON scalars. This walks
+    the structure rather than trying to serialize it. '''
+    t = type(value)
+    if t is dict:
+        for k, v in value.items():
+            if not isinstance(k, _json_scalars):
+                raise TypeError('bad key: {!r}'.format(k))
+            if type(v) is not str and type(v) is not int:
+                check_json_value(v)
+    elif t is list or t is tuple:
+        for v in value:
+            if type(v) is not str and type(v) is not int:
+                check_json_value(v)
+    elif isinstance(value, dict):
+        check_json_value(dict(value))
+    elif isinstance(value, (list, tuple)):
+        check_json_value(list(value))
+    elif not isinstance(value, _json_scalars):
+        raise TypeError('bad value: {!r}'.format(value))
+
 
 def multisig_type(wallet_type):
     '''If wallet_type is mofn multi-sig, return [m, n],
@@ -62,6 +107,20 @@ def multisig_type(wallet_type):
 
 
 class WalletStorage(PrintError):
+    ''' Wallet files come in two formats:
+
+    - The JSON format is the whole of self.data as a JSON document,
+      optionally zlib-compressed and encrypted. Every write rewrites the
+      whole file. This is the default, and the only format older releases
+      can read.
+    - The db format is an sqlite database with one row per top-level key of
+      self.data, each value JSON-encoded. put() tracks which keys changed,
+      and write() only updates those rows, in one sqlite transaction. In
+      encrypted wallets each row holds the compressed and encrypted
+      [key, value] pair, under an HMAC of the key.
+
+    A wallet stays in the format of its file until set_db_format() converts
+    it, either way. '''
 
     def __init__(self, path, manual_upgrades=False, *, in_memory_only=False):
         self.path = path = standardize_path(path)
@@ -74,7 +133,19 @@ class WalletStorage(PrintError):
         self.pubkey = None
         self.raw = None
         self._in_memory_only=in_memory_only
+        self._dirty_keys = set()  # keys put() since the last write
+        self._is_db = False  # True iff the file on disk is in the db format
+        self._use_db = False  # the format the next write() uses
+        self._db_encrypted = False
+        self._db_pubkey = None  # the pubkey the db values on disk are encrypted with
+        self._db_rows = None  # raw db rows of an encrypted db, until decrypt()
         if self.file_exists() and not self._in_memory_only:
+            if self._file_is_db():
+                self._read_db()
+                if not self.is_encrypted():
+                    self._load_dict({k: json.loads(v) for k, v in self._db_rows.items()})
+                    self._db_rows = None
+                return
             try:
                 with open(self.path, "r", encoding='utf-8') as f:
                     self.raw = f.read()
@@ -86,6 +157,48 @@ class WalletStorage(PrintError):
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
+    def _file_is_db(self):
+        with open(self.path, "rb") as f:
+            return f.read(len(DB_MAGIC)) == DB_MAGIC
+
+    @staticmethod
+    def _db_connect(path):
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        return conn
+
+    def _read_db(self):
+        try:
+            with closing(self._db_connect(self.path)) as conn:
+                meta = dict(conn.execute('SELECT name, value FROM meta'))
+                self._db_rows = dict(conn.execute('SELECT key, value FROM data'))
+        except sqlite3.Error as e:
+            raise IOError("Error reading file: " + str(e))
+        self._is_db = self._use_db = True
+        self._db_encrypted = meta.get('encrypted') == '1'
+
+    def _db_row(self, key, value):
+        if not self.pubkey:
+            return key, json.dumps(value, sort_keys=True)
+        s = json.dumps([key, value], sort_keys=True)
+        s = bitcoin.encrypt_message(zlib.compress(bytes(s, 'utf8')), self.pubkey).decode('utf8')
+        return self._db_row_key(key), s
+
+    def _db_row_key(self, key):
+        # keeps the names of the keys of encrypted wallets private
+        if not self.pubkey:
+            return key
+        return hmac.new(bytes(self.pubkey, 'utf8'), bytes(key, 'utf8'), hashlib.sha256).hexdigest()
+
+    def set_db_format(self, enable):
+        ''' Converts the wallet to the db format (or back to JSON) on the
+        next write(). '''
+        with self.lock:
+            if enable != self._use_db:
+                self._use_db = bool(enable)
+                self.modified = True
+
     def load_data(self, s):
         try:
             self.data = json.loads(s)
@@ -108,6 +221,13 @@ class WalletStorage(PrintError):
                     continue
                 self.data[key] = value
 
+        self._after_load()
+
+    def _load_dict(self, d):
+        self.data = d
+        self._after_load()
+
+    def _after_load(self):
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
@@ -120,6 +240,8 @@ class WalletStorage(PrintError):
                 self.upgrade()
 
     def is_encrypted(self):
+        if self._is_db:
+            return self._db_encrypted
         try:
             return base64.b64decode(self.raw)[0:4] == b'BIE1'
         except:
@@ -135,6 +257,15 @@ class WalletStorage(PrintError):
 
     def decrypt(self, password):
         ec_key = self.get_key(password)
+        if self._is_db:
+            d = {}
+            for value in (self._db_rows or {}).values():
+                key, value = json.loads(zlib.decompress(ec_key.decrypt_message(value)).decode('utf8'))
+                d[key] = value
+            self.pubkey = self._db_pubkey = ec_key.get_public_key()
+            self._db_rows = None
+            self._load_dict(d)
+            return
         s = zlib.decompress(ec_key.decrypt_message(self.raw)) if self.raw else None
         self.pubkey = ec_key.get_public_key()
         s = s.decode('utf8')
@@ -142,35 +273,52 @@ class WalletStorage(PrintError):
 
     def set_password(self, password, encrypt):
         self.put('use_encryption', bool(password))
+        old_pubkey = self.pubkey
         if encrypt and password:
             ec_key = self.get_key(password)
             self.pubkey = ec_key.get_public_key()
         else:
             self.pubkey = None
+        if self.pubkey != old_pubkey:
+            # the whole file needs to be re-encrypted on the next write
+            self.modified = True
+
+    def get(self, key, default=None, *, copy=True):
+        ''' Returns a deep copy of the value stored under key.
 
-    def get(self, key, default=None):
+        With copy=False the stored value itself is returned. It is then a
+        read-only view: the caller must not modify it (put() a new value
+        instead), which saves copying big structures such as 'txi'. '''
         with self.lock:
             v = self.data.get(key)
             if v is None:
                 v = default
-            else:
-                v = copy.deepcopy(v)
+            elif copy:
+                v = _deepcopy(v)
         return v
 
-    def put(self, key, value):
+    def put(self, key, value, *, copy=True):
+        ''' Stores a deep copy of value under key and marks the key dirty if
+        the value changed.
+
+        With copy=False ownership of value passes to the storage: it is
+        stored as is, and the caller must not modify it afterwards. '''
         try:
-            json.dumps(key)
-            json.dumps(value)
-        except:
+            check_json_value(key)
+            check_json_value(value)
+        except (TypeError, RecursionError):
             self.print_error("json error: cannot save", key)
             return
         with self.lock:
             if value is not None:
-                if self.data.get(key) != value:
+                old = self.data.get(key)
+                if old is not value and old != value:
                     self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                    self._dirty_keys.add(key)
+                    self.data[key] = _deepcopy(value) if copy else value
             elif key in self.data:
                 self.modified = True
+                self._dirty_keys.add(key)
                 self.data.pop(key)
 
     @profiler
@@ -186,6 +334,45 @@ class WalletStorage(PrintError):
             return
         if not self.modified:
             return
+        if not self._use_db:
+            self._write_json()
+        elif (self._is_db and self._db_pubkey == self.pubkey
+                and self.file_exists() and os.path.exists(self.path)):
+            self._write_db_dirty_keys()
+        else:
+            self._write_db_full()
+        self._file_exists = True
+        self._dirty_keys.clear()
+        self.print_error("saved", self.path)
+        self.modified = False
+
+    def _write_db_dirty_keys(self):
+        with closing(self._db_connect(self.path)) as conn, conn:
+            for key in self._dirty_keys:
+                if key in self.data:
+                    conn.execute('INSERT OR REPLACE INTO data VALUES (?, ?)',
+                                 self._db_row(key, self.data[key]))
+                else:
+                    conn.execute('DELETE FROM data WHERE key = ?',
+                                 (self._db_row_key(key),))
+
+    def _write_db_full(self):
+        temp_path = self.path + TMP_SUFFIX
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        with closing(self._db_connect(temp_path)) as conn, conn:
+            conn.execute('INSERT INTO meta VALUES (?, ?)',
+                         ('encrypted', '1' if self.pubkey else '0'))
+            conn.executemany('INSERT INTO data VALUES (?, ?)',
+                             (self._db_row(key, value)
+                              for key, value in self.data.items()))
+        self._replace_file(temp_path)
+        self.raw = None
+        self._is_db = True
+        self._db_encrypted = bool(self.pubkey)
+        self._db_pubkey = self.pubkey
+
+    def _write_json(self):
         s = json.dumps(self.data, indent=4, sort_keys=True)
         if self.pubkey:
             s = bytes(s, 'utf8')
@@ -198,7 +385,11 @@ class WalletStorage(PrintError):
             f.write(s)
             f.flush()
             os.fsync(f.fileno())
+        self._replace_file(temp_path)
+        self.raw = s
+        self._is_db = False
 
+    def _replace_file(self, temp_path):
         default_mode = stat.S_IREAD | stat.S_IWRITE
         try:
             mode = os.stat(self.path).st_mode if self.file_exists() else default_mode
@@ -211,10 +402,6 @@ class WalletStorage(PrintError):
             assert not os.path.exists(self.path)
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
-        self.raw = s
-        self._file_exists = True
-        self.print_error("saved", self.path)
-        self.modified = False
 
     def requires_split(self):
         d = self.get('accounts', {})
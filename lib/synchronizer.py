@@ -105,7 +105,8 @@ class Synchronizer(ThreadJob):
         self.network.subscribe_to_scripthashes(hashes, self.on_address_status)
         self.requested_hashes |= set(hashes)
 
-    def get_status(self, h):
+    @staticmethod
+    def get_status(h):
         if not h:
             return None
         status = ''
@@ -125,8 +126,9 @@ class Synchronizer(ThreadJob):
         addr = self.h2addr.get(scripthash, None)
         if not addr:
             return  # Bad server response?
-        history = self.wallet.get_address_history(addr)
-        if self.get_status(history) != result:
+        # the wallet keeps the status of each address, so an unchanged
+        # address costs no hashing of its history
+        if self.wallet.get_address_status(addr) != result:
             if self.requested_histories.get(scripthash) is None:
                 self.requested_histories[scripthash] = result
                 self.network.request_scripthash_history(scripthash,
@@ -164,7 +166,7 @@ class Synchronizer(ThreadJob):
             self.print_error("error: status mismatch: {}".format(addr))
         else:
             # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.wallet.receive_history_callback(addr, hist, tx_fees, server_status)
             # Request transactions we don't have
             self.request_missing_txs(hist)
 
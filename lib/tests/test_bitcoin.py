@@ -12,7 +12,8 @@ from ..bitcoin import (
     var_int, op_push, regenerate_key,
     verify_message, deserialize_privkey, serialize_privkey,
     is_minikey, is_compressed, is_xpub,
-    xpub_type, is_xprv, is_bip32_derivation, seed_type)
+    xpub_type, is_xprv, is_bip32_derivation, seed_type, deserialize_xpub,
+    CKD_pub, CKD_pub_range)
 from ..networks import set_mainnet, set_testnet
 from ..util import bfh
 
@@ -232,6 +233,13 @@ class Test_xprv_xpub(unittest.TestCase):
         self.assertEqual("xpub6FnCn6nSzZAw5Tw7cgR9bi15UV96gLZhjDstkXXxvCLsUXBGXPdSnLFbdpq8p9HmGsApME5hQTZ3emM2rnY5agb9rXpVGyy3bdW6EEgAtqt", xpub)
         self.assertEqual("xprvA2nrNbFZABcdryreWet9Ea4LvTJcGsqrMzxHx98MMrotbir7yrKCEXw7nadnHM8Dq38EGfSh6dqA9QWTyefMLEcBYJUuekgW4BYPJcr9E7j", xprv)
 
+    def test_ckd_pub_range(self):
+        xpub, xprv = self._do_test_bip32("000102030405060708090a0b0c0d0e0f", "m/0'/1")
+        _, _, _, _, c, cK = deserialize_xpub(xpub)
+        expected = [CKD_pub(cK, c, n)[0] for n in range(5, 25)]
+        self.assertEqual(expected, CKD_pub_range(cK, c, 5, 20))
+        self.assertEqual([], CKD_pub_range(cK, c, 5, 0))
+
     def test_xpub_from_xprv(self):
         """We can derive the xpub key from a xprv."""
         for xprv_details in self.xprv_xpub:
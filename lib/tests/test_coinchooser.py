@@ -0,0 +1,110 @@
+import unittest
+
+from .. import coinchooser
+from ..address import Address
+from ..bitcoin import TYPE_ADDRESS
+from ..coinchooser import CoinChooserBranchAndBound, CoinChooserPrivacy
+from ..transaction import Transaction
+from ..util import NotEnoughFunds
+
+PUBKEY = '02' + '11' * 32
+
+
+def make_coin(n, value, address=None, **kwargs):
+    coin = {'address': address or Address.from_P2PKH_hash(n.to_bytes(20, 'big')),
+            'value': value, 'prevout_hash': '%064x' % n, 'prevout_n': 0,
+            'type': 'p2pkh', 'num_sig': 1, 'x_pubkeys': [PUBKEY],
+            'signatures': [None]}
+    coin.update(kwargs)
+    return coin
+
+
+class TestCoinChooser(unittest.TestCase):
+
+    dest = Address.from_P2PKH_hash(b'\xaa' * 20)
+    change = Address.from_P2PKH_hash(b'\xbb' * 20)
+
+    def make_tx(self, chooser, coins, amount, fee_estimator=lambda size: size):
+        return chooser.make_tx(coins, [(TYPE_ADDRESS, self.dest, amount)],
+                               [self.change], fee_estimator, 546)
+
+    def test_estimated_input_size_key(self):
+        coins = [make_coin(1, 1000),
+                 make_coin(2, 2000, x_pubkeys=['ff' + '00' * 78]),
+                 make_coin(3, 3000, x_pubkeys=['04' + '11' * 64]),
+                 make_coin(4, 3000, type='p2sh', num_sig=2, x_pubkeys=[PUBKEY] * 3,
+                           signatures=[None] * 3)]
+        for sign_schnorr in (False, True):
+            sizes = {}
+            for coin in coins:
+                key = Transaction.estimated_input_size_key(coin, sign_schnorr)
+                size = Transaction.estimated_input_size(coin, sign_schnorr=sign_schnorr)
+                self.assertEqual(sizes.setdefault(key, size), size)
+            self.assertEqual(3, len(sizes))
+        self.assertIsNone(Transaction.estimated_input_size_key(
+            make_coin(5, 1000, type='unknown', scriptSig='00')))
+
+    def test_branch_and_bound(self):
+        bnb = CoinChooserBranchAndBound().branch_and_bound
+        values = [10, 7, 5, 5, 5, 3, 1]
+        self.assertEqual([0], bnb(values, 10, 0))
+        self.assertEqual([0, 6], bnb(values, 11, 0))
+        self.assertEqual([0, 1, 2, 3, 4, 5, 6], bnb(values, 36, 0))
+        self.assertEqual([0, 1, 2], bnb(values, 22, 0))
+        self.assertIsNone(bnb(values, 37, 10))
+        self.assertIsNone(bnb(values, 2, 0))
+        # the smallest excess within the window wins
+        self.assertEqual([0, 3], bnb([10, 8, 5, 3], 13, 5))
+        self.assertEqual([0, 1], bnb([10, 8, 5, 3], 17, 5))
+        # many equal values are not searched over and over
+        self.assertIsNone(bnb([2] * 100, 101, 0))
+        self.assertEqual(list(range(50)), bnb([2] * 100, 100, 0))
+
+    def test_exact_match_without_change(self):
+        coins = [make_coin(n, value) for n, value in
+                 enumerate([500000, 300000, 250000, 100000, 70000], 1)]
+        chooser = CoinChooserBranchAndBound()
+        input_size = Transaction.estimated_input_size(coins[0])
+        base_size = Transaction.from_io([], [(TYPE_ADDRESS, self.dest, 0)]).estimated_size()
+        amount = 350000 - 2 * input_size - base_size
+        tx = self.make_tx(chooser, coins, amount)
+        self.assertEqual({250000, 100000}, {txin['value'] for txin in tx.inputs()})
+        self.assertEqual(1, len(tx.outputs()))
+        self.assertEqual(2 * input_size + base_size, tx.get_fee())
+
+    def test_fallback_with_change(self):
+        coins = [make_coin(n, value) for n, value in
+                 enumerate([500000, 300000, 250000], 1)]
+        chooser = CoinChooserBranchAndBound()
+        # no exact match: the smallest coin that pays with change
+        tx = self.make_tx(chooser, coins, 260000)
+        self.assertEqual([300000], [txin['value'] for txin in tx.inputs()])
+        self.assertEqual(2, len(tx.outputs()))
+        # no coin pays on its own: the largest ones
+        tx = self.make_tx(CoinChooserBranchAndBound(), coins, 700000)
+        self.assertEqual({500000, 300000}, {txin['value'] for txin in tx.inputs()})
+        # a fixed fee
+        tx = self.make_tx(CoinChooserBranchAndBound(), coins, 260000, lambda size: 5000)
+        self.assertEqual(5000, tx.get_fee())
+        with self.assertRaises(NotEnoughFunds):
+            self.make_tx(CoinChooserBranchAndBound(), coins, 1050000)
+
+    def test_address_buckets(self):
+        addr = Address.from_P2PKH_hash(b'\xcc' * 20)
+        coins = [make_coin(1, 100000, addr), make_coin(2, 900000, addr),
+                 make_coin(3, 400000)]
+        tx = self.make_tx(CoinChooserBranchAndBound(), coins, 50000)
+        self.assertEqual([400000], [txin['value'] for txin in tx.inputs()])
+        tx = self.make_tx(CoinChooserBranchAndBound(), coins, 600000)
+        self.assertEqual({100000, 900000}, {txin['value'] for txin in tx.inputs()})
+
+    def test_get_coin_chooser(self):
+        self.assertIsInstance(coinchooser.get_coin_chooser({}), CoinChooserPrivacy)
+        self.assertIsInstance(coinchooser.get_coin_chooser({'coin_chooser': 'Priority'}),
+                              CoinChooserPrivacy)
+        self.assertIsInstance(coinchooser.get_coin_chooser({'coin_chooser': 'BranchAndBound'}),
+                              CoinChooserBranchAndBound)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,17 @@
+import os
+import shutil
+import tempfile
 import unittest
 from decimal import Decimal as PyDecimal
+from unittest import mock
 
+from .. import bitcoin
+from .. import keystore
+from .. import wallet
+from ..address import Address
 from ..commands import Commands
+from ..simple_config import SimpleConfig
+from ..storage import WalletStorage
 
 
 class TestCommands(unittest.TestCase):
@@ -31,3 +41,65 @@ class TestCommands(unittest.TestCase):
         self.assertEqual("2asd", Commands._setconfig_normalize_value('rpcpassword', '2asd'))
         self.assertEqual("['file:///var/www/','https://electrum.org']",
             Commands._setconfig_normalize_value('rpcpassword', "['file:///var/www/','https://electrum.org']"))
+
+
+class TestWalletCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.user_dir)
+        xprv, xpub = bitcoin.bip32_root(b'\x01' * 32, 'standard')
+        storage = WalletStorage(os.path.join(self.user_dir, 'somewallet'))
+        storage.put('keystore', keystore.from_xpub(xpub).dump())
+        storage.put('wallet_type', 'standard')
+        self.wallet = wallet.Standard_Wallet(storage)
+        self.addCleanup(self.wallet.stop_threads)
+        config = SimpleConfig({'electron_cash_path': self.user_dir})
+        self.network = mock.Mock()
+        self.commands = Commands(config, self.wallet, self.network)
+
+    def test_createnewaddresses(self):
+        addrs = self.commands.createnewaddresses(3)
+        self.assertEqual([a.to_ui_string() for a in self.wallet.get_receiving_addresses()], addrs)
+
+    def test_addrequests(self):
+        self.commands.createnewaddresses(2)
+        requests = [{'amount': '0.1', 'memo': 'a'}, {'amount': '0.2'}, {'amount': '0.3', 'expiration': 3600}]
+        # not enough unused addresses: all or nothing
+        self.assertFalse(self.commands.addrequests(requests))
+        self.assertFalse(self.wallet.receive_requests)
+
+        with mock.patch.object(self.wallet.storage, 'write') as write:
+            out = self.commands.addrequests(requests, force=True)
+            write.assert_called_once_with()
+        self.assertEqual(3, len(self.wallet.get_receiving_addresses()))
+        self.assertEqual([a.to_ui_string() for a in self.wallet.get_receiving_addresses()],
+                         [r['address'] for r in out])
+        self.assertEqual(['0.1', '0.2', '0.3'], [r['amount (BCH)'] for r in out])
+        self.assertEqual([None, None, 3600], [r['exp'] for r in out])
+        self.assertEqual('a', self.wallet.labels[self.wallet.get_receiving_addresses()[0].to_storage_string()])
+
+        self.assertEqual(out, self.commands.listrequests())
+        self.assertEqual(out[1:], self.commands.listrequests(offset=1))
+        self.assertEqual(out[1:2], self.commands.listrequests(offset=1, limit=1))
+        self.assertEqual([], self.commands.listrequests(limit=0))
+        for kwargs in ({'offset': -1}, {'limit': -1}, {'offset': '1'}, {'limit': 1.5}):
+            with self.assertRaisesRegex(BaseException, 'must be a non-negative integer'):
+                self.commands.listrequests(**kwargs)
+
+    def test_addrequests_float_amount(self):
+        # amounts arrive as floats over JSON-RPC
+        out = self.commands.addrequests([{'amount': 0.29}, {'amount': 1.1}], force=True)
+        self.assertEqual(['0.29', '1.1'], [r['amount (BCH)'] for r in out])
+        self.assertEqual([29000000, 110000000], [r['amount'] for r in out])
+
+    def test_getaddressbalances(self):
+        addrs = self.commands.createnewaddresses(2)
+        self.network.synchronous_get_many.return_value = [
+            {'confirmed': 100000000, 'unconfirmed': 0}, {'confirmed': 0, 'unconfirmed': 50000000}]
+        self.assertEqual({addrs[0]: {'confirmed': '1', 'unconfirmed': '0'},
+                          addrs[1]: {'confirmed': '0', 'unconfirmed': '0.5'}},
+                         self.commands.getaddressbalances(addrs))
+        requests = self.network.synchronous_get_many.call_args[0][0]
+        self.assertEqual([('blockchain.scripthash.get_balance', [Address.from_string(a).to_scripthash_hex()])
+                          for a in addrs], requests)
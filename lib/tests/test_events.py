@@ -0,0 +1,185 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from ..address import Address
+from ..events import WalletEvents
+from ..paymentrequest import PR_PAID, PR_UNKNOWN
+
+ADDR = Address.from_string('bitcoincash:qpm2qsznhks23z7629mms6s4cwef74vcwvy22gdx6a')
+
+
+def make_wallet(path):
+    wallet = mock.Mock()
+    wallet.storage.path = path
+    wallet.receive_requests = {}
+    wallet.get_tx_height.return_value = (100, 1, 0)
+    return wallet
+
+
+def make_tx(txid, outputs=()):
+    tx = mock.Mock()
+    tx.txid.return_value = txid
+    tx.outputs.return_value = list(outputs)
+    return tx
+
+
+class TestWalletEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.network = mock.Mock()
+        self.events = WalletEvents(self.network, max_waiters=1)
+        self.events.start()
+        self.network.register_callback.assert_called_once_with(
+            self.events.on_event, WalletEvents.CALLBACKS)
+        self.w1, self.w2 = make_wallet('/w1'), make_wallet('/w2')
+
+    def test_filter_and_order(self):
+        all_id = self.events.subscribe()
+        w2_id = self.events.subscribe(['/w2'])
+        self.events.on_event('new_transaction', make_tx('aa'), self.w1)
+        self.events.on_event('verified2', self.w2, 'bb', 100, 1, 1234)
+        self.events.on_event('verifications_undone', self.w2, {'cc', 'bb'})
+        self.assertEqual(
+            {'events': [{'event': 'new_transaction', 'wallet': '/w1', 'txid': 'aa', 'height': 100},
+                        {'event': 'verified', 'wallet': '/w2', 'txid': 'bb', 'height': 100, 'timestamp': 1234},
+                        {'event': 'verifications_undone', 'wallet': '/w2', 'txids': ['bb', 'cc']}],
+             'dropped': 0},
+            self.events.get_events(all_id))
+        self.assertEqual(['verified', 'verifications_undone'],
+                         [e['event'] for e in self.events.get_events(w2_id)['events']])
+        self.assertEqual({'events': [], 'dropped': 0}, self.events.get_events(w2_id))
+        self.assertTrue(self.events.unsubscribe(w2_id))
+        with self.assertRaises(Exception):
+            self.events.get_events(w2_id)
+
+    def test_overflow(self):
+        sub_id = self.events.subscribe()
+        n = WalletEvents.MAX_QUEUE + 10
+        for i in range(n):
+            self.events.on_event('verified2', self.w1, '%064x' % i, i, 1, 0)
+            # repeated updates are coalesced
+            self.events.on_event('wallet_updated', self.w1)
+            self.events.on_event('wallet_updated', self.w1)
+        result = self.events.get_events(sub_id)
+        self.assertEqual(2 * n - WalletEvents.MAX_QUEUE, result['dropped'])
+        self.assertEqual(WalletEvents.MAX_EVENTS, len(result['events']))
+        rest = self.events.get_events(sub_id)
+        self.assertEqual(0, rest['dropped'])
+        self.assertEqual(WalletEvents.MAX_QUEUE - WalletEvents.MAX_EVENTS, len(rest['events']))
+        self.assertEqual({'event': 'wallet_updated', 'wallet': '/w1'}, rest['events'][-1])
+        self.assertEqual(n - 1, rest['events'][-2]['height'])
+
+    def test_long_poll(self):
+        sub_id = self.events.subscribe()
+        timer = threading.Timer(0.1, self.events.on_event, ('wallet_updated', self.w1))
+        timer.start()
+        t0 = time.time()
+        result = self.events.get_events(sub_id, timeout=10)
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual([{'event': 'wallet_updated', 'wallet': '/w1'}], result['events'])
+        timer.join()
+
+    def test_max_waiters(self):
+        self.events.max_waiters = 0
+        sub_id = self.events.subscribe()
+        t0 = time.time()
+        self.assertEqual({'events': [], 'dropped': 0, 'retry_after': WalletEvents.BUSY_RETRY},
+                         self.events.get_events(sub_id, timeout=10))
+        self.assertLess(time.time() - t0, 5)
+        # not longer than the poll would have waited
+        self.assertEqual(2, self.events.get_events(self.events.subscribe(), timeout=2)['retry_after'])
+
+    def test_more_subscribers_than_waiters(self):
+        waiting_id, busy_id, other_id = [self.events.subscribe() for i in range(3)]
+        results = []
+        poll = threading.Thread(target=lambda: results.append(
+            self.events.get_events(waiting_id, timeout=10)))
+        poll.start()
+        while not self.events.waiters:
+            time.sleep(0.01)
+        t0 = time.time()
+        result = self.events.get_events(busy_id, timeout=10)
+        self.assertEqual([], result['events'])
+        self.assertEqual(WalletEvents.BUSY_RETRY, result['retry_after'])
+        self.assertLess(time.time() - t0, 1)
+
+        self.events.on_event('wallet_updated', self.w1)
+        poll.join()
+        self.assertEqual(1, len(results[0]['events']))
+        self.assertNotIn('retry_after', results[0])
+        self.events.get_events(busy_id)
+        # a waiter is free now, but polling again before retry_after does
+        # not wait for one
+        t0 = time.time()
+        result = self.events.get_events(busy_id, timeout=10)
+        self.assertLess(time.time() - t0, 1)
+        self.assertGreater(result['retry_after'], 0)
+        self.assertLessEqual(result['retry_after'], WalletEvents.BUSY_RETRY)
+        # unless there are events
+        self.events.on_event('verified2', self.w1, 'aa', 100, 1, 0)
+        result = self.events.get_events(busy_id, timeout=10)
+        self.assertEqual(['verified'], [e['event'] for e in result['events']])
+        self.assertNotIn('retry_after', result)
+        # other subscribers still get to wait
+        timer = threading.Timer(0.1, self.events.on_event, ('wallet_updated', self.w1))
+        timer.start()
+        self.events.get_events(other_id)
+        result = self.events.get_events(other_id, timeout=10)
+        timer.join()
+        self.assertEqual(['wallet_updated'], [e['event'] for e in result['events']])
+
+    def test_request_paid(self):
+        sub_id = self.events.subscribe()
+        self.w1.receive_requests = {ADDR: {'id': 'abc', 'amount': 1000}}
+        self.w1.get_request_status.return_value = (PR_UNKNOWN, None)
+        tx = make_tx('aa', [(0, ADDR, 1000)])
+        self.events.on_event('new_transaction', tx, self.w1)
+        # not up to date yet
+        self.assertEqual(['new_transaction'],
+                         [e['event'] for e in self.events.get_events(sub_id)['events']])
+        self.w1.get_request_status.return_value = (PR_PAID, 0)
+        self.events.on_event('wallet_updated', self.w1)
+        self.events.on_event('wallet_updated', self.w1)
+        self.assertEqual(
+            [{'event': 'wallet_updated', 'wallet': '/w1'},
+             {'event': 'request_paid', 'wallet': '/w1', 'address': ADDR.to_ui_string(),
+              'id': 'abc', 'amount': 1000, 'confirmations': 0},
+             {'event': 'wallet_updated', 'wallet': '/w1'}],
+            self.events.get_events(sub_id)['events'])
+
+    def test_remove_wallet(self):
+        self.events.subscribe()
+        self.w1.receive_requests = {ADDR: {'id': 'abc', 'amount': 1000}}
+        self.w1.get_request_status.return_value = (PR_UNKNOWN, None)
+        self.events.on_event('new_transaction', make_tx('aa', [(0, ADDR, 1000)]), self.w1)
+        self.assertEqual({self.w1: {ADDR}}, self.events.pending_requests)
+        self.events.remove_wallet(self.w1)
+        self.assertEqual({}, self.events.pending_requests)
+        self.events.remove_wallet(self.w1)
+
+    def test_expire(self):
+        stale_id, live_id = self.events.subscribe(), self.events.subscribe()
+        self.events.subscriptions[stale_id].last_poll -= WalletEvents.EXPIRY + 1
+        # polls of other subscriptions and events expire it too, not only
+        # new subscriptions
+        self.events.get_events(live_id)
+        self.assertEqual([live_id], list(self.events.subscriptions))
+        stale_id = self.events.subscribe()
+        self.events.subscriptions[stale_id].last_poll -= WalletEvents.EXPIRY + 1
+        self.events.on_event('wallet_updated', self.w1)
+        self.assertEqual([live_id], list(self.events.subscriptions))
+        with self.assertRaises(Exception):
+            self.events.get_events(stale_id)
+
+    def test_stop(self):
+        sub_id = self.events.subscribe()
+        self.events.stop()
+        self.network.unregister_callback.assert_called_once_with(self.events.on_event)
+        with self.assertRaises(Exception):
+            self.events.get_events(sub_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import jsonrpclib
+
+from .. import daemon as daemon_module, keystore
+from ..bitcoin import bip32_root
+from ..daemon import Daemon, get_fd_or_server
+from ..simple_config import SimpleConfig
+from ..storage import WalletStorage
+from ..wallet import Standard_Wallet
+from ..jsonrpc import VerifyingJSONRPCServer
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def _serve(self, server):
+        stop = threading.Event()
+        def loop():
+            while not stop.is_set():
+                server.handle_request()
+        t = threading.Thread(target=loop, daemon=True)
+        t.start()
+        def cleanup():
+            stop.set()
+            t.join()
+            server.server_close()
+        self.addCleanup(cleanup)
+        host, port = server.socket.getsockname()
+        return 'http://user:pass@%s:%d' % (host, port)
+
+
+class TestVerifyingJSONRPCServer(ServerTestCase):
+
+    def _server(self, workers):
+        server = VerifyingJSONRPCServer(('127.0.0.1', 0), logRequests=False,
+                                        rpc_user='user', rpc_password='pass',
+                                        workers=workers)
+        server.timeout = 0.1
+        return server
+
+    def test_concurrent_requests(self):
+        server = self._server(workers=2)
+        # both calls must be in progress at the same time to get past this
+        barrier = threading.Barrier(2, timeout=5)
+        server.register_function(lambda: barrier.wait() is not None, 'meet')
+        url = self._serve(server)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(jsonrpclib.Server(url).meet()))
+                   for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([True, True], results)
+
+    def test_bounded_queue(self):
+        server = self._server(workers=1)
+        release = threading.Event()
+        server.register_function(lambda: release.wait(5), 'wait')
+        url = self._serve(server)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(jsonrpclib.Server(url).wait()))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+        # one request runs, one waits in the queue, the others in the backlog
+        self.assertEqual(1, server.requests.qsize())
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual([True] * 4, results)
+
+    def test_workers_can_write_wallets(self):
+        # WalletStorage refuses to write from daemon threads
+        server = self._server(workers=2)
+        server.register_function(lambda: threading.current_thread().daemon, 'is_daemon')
+        url = self._serve(server)
+        self.assertFalse(jsonrpclib.Server(url).is_daemon())
+
+    def test_batch_and_auth(self):
+        server = self._server(workers=2)
+        server.register_function(lambda x: x + 1, 'inc')
+        url = self._serve(server)
+        client = jsonrpclib.Server(url)
+        self.assertEqual(2, client.inc(1))
+        batch = jsonrpclib.MultiCall(client)
+        for i in range(3):
+            batch.inc(i)
+        self.assertEqual([1, 2, 3], list(batch()))
+        with self.assertRaises(Exception):
+            jsonrpclib.Server(url.replace('pass', 'wrong')).inc(1)
+
+
+class TestDaemonRPC(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def _daemon(self):
+        config = SimpleConfig({'electron_cash_path': self.path, 'offline': True,
+                               'rpcuser': 'user', 'rpcpassword': 'pass',
+                               'rpchost': '127.0.0.1', 'rpcworkers': 2})
+        fd, server = get_fd_or_server(config)
+        daemon = Daemon(config, fd, False)
+        daemon.start()
+        def stop():
+            daemon.stop()
+            daemon.join()
+        self.addCleanup(stop)
+        host, port = daemon.server.socket.getsockname()
+        return daemon, jsonrpclib.Server('http://user:pass@%s:%d' % (host, port))
+
+    def test_wallet_param(self):
+        daemon, client = self._daemon()
+        os.mkdir(os.path.join(self.path, 'wallets'))
+
+        w1, w2 = mock.Mock(), mock.Mock()
+        w1.get_balance.return_value = (100000000, 0, 0)
+        w2.get_balance.return_value = (200000000, 0, 0)
+        daemon.wallets[os.path.join(self.path, 'wallets', 'w1')] = w1
+        daemon.wallets[os.path.join(self.path, 'wallets', 'w2')] = w2
+        daemon.default_wallet = w1
+
+        self.assertEqual({'confirmed': '1'}, client.getbalance())
+        self.assertEqual({'confirmed': '2'}, client.getbalance(wallet='w2'))
+        self.assertEqual({'confirmed': '2'}, client.getbalance(
+            wallet=os.path.join(self.path, 'wallets', 'w2')))
+        with self.assertRaises(Exception):
+            client.getbalance(wallet='w3')
+
+    def test_events(self):
+        daemon, client = self._daemon()
+        w1, w2 = mock.Mock(), mock.Mock()
+        w1.storage.path = os.path.join(self.path, 'wallets', 'w1')
+        w2.storage.path = os.path.join(self.path, 'wallets', 'w2')
+        daemon.wallets[w1.storage.path] = w1
+        daemon.wallets[w2.storage.path] = w2
+
+        sub = client.subscribe_events(['w2'])
+        with self.assertRaises(Exception):
+            client.subscribe_events(['w3'])
+        timer = threading.Timer(0.2, lambda: [daemon.events.on_event('wallet_updated', w)
+                                              for w in (w1, w2)])
+        timer.start()
+        result = client.get_events(sub, 10)
+        timer.join()
+        self.assertEqual({'events': [{'event': 'wallet_updated', 'wallet': w2.storage.path}],
+                          'dropped': 0}, result)
+        self.assertTrue(client.unsubscribe_events(sub))
+        self.assertFalse(client.unsubscribe_events(sub))
+
+        # nothing is kept about stopped wallets
+        daemon.events.pending_requests[w1] = {'address'}
+        daemon.stop_wallet(w1.storage.path)
+        w1.stop_threads.assert_called_once_with()
+        self.assertEqual({}, daemon.events.pending_requests)
+
+    def _make_wallet(self, path):
+        xprv, xpub = bip32_root(b'\x01' * 32, 'standard')
+        storage = WalletStorage(path)
+        storage.put('keystore', keystore.from_xpub(xpub).dump())
+        storage.put('wallet_type', 'standard')
+        wallet = Standard_Wallet(storage)
+        wallet.synchronize()
+        storage.write()
+        return wallet
+
+    def test_concurrent_load_wallet(self):
+        daemon, client = self._daemon()
+        path = os.path.join(self.path, 'w1')
+        self._make_wallet(path)
+        barrier = threading.Barrier(2, timeout=5)
+        results = []
+        def slow_wallet(storage):
+            # the other thread gets its turn while this one builds the wallet
+            time.sleep(0.2)
+            return mock.Mock()
+        def load():
+            barrier.wait()
+            results.append(daemon.load_wallet(path, None))
+        with mock.patch.object(daemon_module, 'Wallet', side_effect=slow_wallet) as Wallet:
+            threads = [threading.Thread(target=load) for i in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        Wallet.assert_called_once()
+        self.assertIs(results[0], results[1])
+        results[0].start_threads.assert_called_once_with(None)
+
+    def test_stop_wallet_waits_for_commands(self):
+        daemon, client = self._daemon()
+        path = os.path.join(self.path, 'w1')
+        wallet = mock.Mock()
+        wallet.storage.path = path
+        started, release = threading.Event(), threading.Event()
+        def get_balance():
+            started.set()
+            release.wait(5)
+            return (100000000, 0, 0)
+        wallet.get_balance.side_effect = get_balance
+        daemon.add_wallet(wallet)
+        daemon.default_wallet = wallet
+
+        results = []
+        command = threading.Thread(target=lambda: results.append(client.getbalance()))
+        command.start()
+        self.assertTrue(started.wait(5))
+        stop = threading.Thread(target=daemon.stop_wallet, args=(path,))
+        stop.start()
+        stop.join(0.2)
+        # the wallet is unlisted at once, but only stopped after the command
+        self.assertIsNone(daemon.get_wallet(path))
+        self.assertIsNone(daemon.default_wallet)
+        wallet.stop_threads.assert_not_called()
+        release.set()
+        command.join()
+        stop.join()
+        wallet.stop_threads.assert_called_once_with()
+        self.assertEqual([{'confirmed': '1'}], results)
+
+    def test_command_writes_wallet(self):
+        daemon, client = self._daemon()
+        path = os.path.join(self.path, 'w1')
+        wallet = self._make_wallet(path)
+        daemon.add_wallet(wallet)
+
+        req = client.addrequest(amount=0.5, memo='hello', wallet=path)
+        # the request was saved from the RPC worker thread
+        saved = WalletStorage(path).get('payment_requests')
+        self.assertEqual(['hello'], [r['memo'] for r in saved.values()])
+        self.assertEqual(0.5, float(req['amount (BCH)']))
@@ -0,0 +1,317 @@
+import json
+import queue
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+import asyncio
+
+from .. import networks
+from ..blockchain import NULL_HEADER
+from ..interface import AsyncTcpConnection, AsyncInterface, Interface, TcpConnection
+from ..network import Network
+
+
+class StubElectrumX(socketserver.ThreadingTCPServer):
+    ''' A local stand-in for an ElectrumX server, speaking newline-delimited
+    JSON-RPC, batches included, over plain TCP.  Methods in `handlers` are
+    answered with their handler's result; other requests are left
+    unanswered.  Each answer is held back by `latency` seconds, as if it
+    had to travel over a slow link.  The first `reject_batches` batches
+    are turned down with a single error, like servers without batch
+    support do. '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.reject_batches = 0
+        self.handlers = {
+            'server.version': lambda params: ['ElectrumX stub', '1.4'],
+            'server.ping': lambda params: None,
+            # a tip above the checkpoint, so that we do not get dropped
+            'blockchain.headers.subscribe': lambda params: {
+                'hex': NULL_HEADER.hex(),
+                'height': networks.net.VERIFICATION_BLOCK_HEIGHT + 1000},
+            'blockchain.scripthash.get_balance': lambda params: {
+                'confirmed': len(params[0]), 'unconfirmed': 0},
+            'blockchain.scripthash.subscribe': lambda params: None,
+        }
+        # what was received: request dicts, or lists of them for batches
+        self.requests = []
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def server_key(self):
+        return '127.0.0.1:{}:t'.format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.write_lock = threading.Lock()
+        for line in self.rfile:
+            request = json.loads(line.decode())
+            self.server.requests.append(request)
+            if isinstance(request, list) and self.server.reject_batches:
+                self.server.reject_batches -= 1
+                response = {'jsonrpc': '2.0', 'id': None,
+                            'error': {'code': -32600, 'message': 'batches not supported'}}
+            elif isinstance(request, list):
+                response = [r for r in map(self.answer, request) if r is not None]
+            else:
+                response = self.answer(request)
+            if response:
+                data = (json.dumps(response) + '\n').encode()
+                if self.server.latency:
+                    threading.Timer(self.server.latency, self.write, (data,)).start()
+                else:
+                    self.write(data)
+
+    def answer(self, request):
+        handler = self.server.handlers.get(request['method'])
+        if handler is not None:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'result': handler(request['params'])}
+
+    def write(self, data):
+        with self.write_lock:
+            try:
+                self.wfile.write(data)
+            except OSError:
+                pass
+
+
+class TestAsyncInterface(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubElectrumX()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.server.stop()
+
+    def test_request_response(self):
+        q = queue.Queue()
+        conn = AsyncTcpConnection(self.server.server_key, q, '', limit=1 << 20)
+
+        async def run():
+            await conn.connect()
+            server_key, streams = q.get_nowait()
+            self.assertEqual(server_key, self.server.server_key)
+            received = asyncio.Event()
+            interface = AsyncInterface(server_key, streams, on_message=lambda i: received.set())
+            for n in range(3):
+                interface.queue_request('server.ping', [], n)
+            interface.queue_request('blockchain.scripthash.get_balance', ['ab' * 32], 3)
+            responses = []
+            while len(responses) < 4:
+                await asyncio.wait_for(received.wait(), 5)
+                received.clear()
+                responses += interface.get_responses()
+            interface.close()
+            return responses
+
+        responses = self.loop.run_until_complete(run())
+        self.assertEqual([request[2] for request, response in responses], [0, 1, 2, 3])
+        self.assertEqual(responses[3][1]['result'], {'confirmed': 64, 'unconfirmed': 0})
+
+    def test_connection_refused(self):
+        q = queue.Queue()
+        self.server.stop()
+        conn = AsyncTcpConnection(self.server.server_key, q, '', limit=1 << 20)
+        self.loop.run_until_complete(conn.connect())
+        self.assertEqual(q.get_nowait(), (self.server.server_key, None))
+
+
+class TestInterfaceBatching(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubElectrumX()
+        sock = TcpConnection(self.server.server_key, None, '').get_simple_socket()
+        self.interface = Interface(self.server.server_key, sock)
+
+    def tearDown(self):
+        self.interface.close()
+        self.server.stop()
+
+    def run_requests(self, requests):
+        for n, (method, params) in enumerate(requests):
+            self.interface.queue_request(method, params, n)
+        responses = []
+        deadline = time.time() + 10
+        while len(responses) < len(requests) and time.time() < deadline:
+            if self.interface.num_requests():
+                self.assertTrue(self.interface.send_requests())
+            responses += self.interface.get_responses()
+        return responses
+
+    def test_batches(self):
+        requests = [('blockchain.scripthash.subscribe', ['%064x' % n]) for n in range(600)]
+        self.interface.window = 600
+        responses = self.run_requests(requests)
+        self.assertEqual(sorted(request[2] for request, response in responses), list(range(600)))
+        for request, response in responses:
+            self.assertEqual(response['id'], request[2])
+        # 600 requests make 2 full batches and a lone request
+        batch_sizes = [len(r) if isinstance(r, list) else 0 for r in self.server.requests]
+        self.assertEqual(batch_sizes, [Interface.MAX_BATCH, Interface.MAX_BATCH, 100])
+        self.assertFalse(self.interface.unanswered_requests)
+        self.assertFalse(self.interface.send_times)
+
+    def test_batch_rejected(self):
+        requests = [('blockchain.scripthash.subscribe', ['%064x' % n]) for n in range(600)]
+        self.interface.window = 600
+        self.server.reject_batches = 1
+        responses = self.run_requests(requests)
+        # every request is answered once, the second batch's requests may
+        # have been answered twice by the server
+        self.assertEqual(sorted(request[2] for request, response in responses), list(range(600)))
+        self.assertNotIn((None, None), responses)
+        self.assertFalse(self.interface.batching)
+        self.assertFalse(self.interface.unanswered_requests)
+        self.assertFalse(self.interface.send_times)
+        # the rejected batch was sent again as single requests
+        n = len(self.server.requests)
+        self.assertTrue(all(isinstance(r, dict) for r in self.server.requests[3:]))
+        self.assertEqual(list(range(Interface.MAX_BATCH)),
+                         [r['id'] for r in self.server.requests[3:3 + Interface.MAX_BATCH]])
+        # and nothing is batched any more
+        self.assertEqual(2, len(self.run_requests([('server.ping', [])] * 2)))
+        self.assertEqual([0, 1], [r['id'] for r in self.server.requests[n:]])
+
+    def test_lone_request(self):
+        responses = self.run_requests([('server.ping', [])])
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(self.server.requests, [{'method': 'server.ping', 'params': [], 'id': 0}])
+
+    def test_window(self):
+        i = self.interface
+        for n in range(50):
+            i._adapt_window(0.05, False)
+        self.assertEqual(i.window, Interface.INITIAL_WINDOW + 50)
+        # the server got slow: shrink once per round trip
+        i._adapt_window(1.0, False)
+        i._adapt_window(1.0, False)
+        self.assertEqual(i.window, 150 * 3 // 4)
+        i._last_shrink = 0
+        i._adapt_window(0.05, True)
+        self.assertEqual(i.window, 150 * 3 // 4 * 3 // 4)
+        for n in range(20):
+            i._last_shrink = 0
+            i._adapt_window(0.05, True)
+        self.assertEqual(i.window, Interface.MIN_WINDOW)
+
+
+class TestAsyncNetwork(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubElectrumX()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_network(self):
+        network = Network({
+            'electron_cash_path': self.tmpdir,
+            'server': self.server.server_key,
+            'oneserver': True,
+            'auto_connect': False,
+            'whitelist_servers_only': False,
+            'asyncio_network': True,
+        })
+        self.addCleanup(setattr, Network, 'INSTANCE', None)
+        network.start()
+        try:
+            result = network.synchronous_get(('blockchain.scripthash.get_balance', ['ab']), timeout=10)
+            self.assertEqual(result, {'confirmed': 2, 'unconfirmed': 0})
+            self.assertTrue(network.is_connected())
+            # results come back in the order asked, duplicates included
+            results = network.synchronous_get_many(
+                [('blockchain.scripthash.get_balance', [h]) for h in ('ab', 'abcd', 'ab')], timeout=10)
+            self.assertEqual([2, 4, 2], [r['confirmed'] for r in results])
+        finally:
+            network.stop()
+            network.join(10)
+        self.assertFalse(network.is_alive())
+        self.assertFalse(network.interfaces)
+        methods = [request['method'] for request in self.server.requests]
+        self.assertEqual(methods[:2], ['server.version', 'blockchain.headers.subscribe'])
+
+
+class TestSubscriptions(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # never started, so it stays offline
+        self.network = Network({
+            'electron_cash_path': self.tmpdir,
+            'server': '127.0.0.1:1:t',
+            'oneserver': True,
+            'auto_connect': False,
+            'whitelist_servers_only': False,
+            'asyncio_network': True,
+        })
+        self.responses = []
+
+    def tearDown(self):
+        self.network.loop.close()
+        Network.INSTANCE = None
+        shutil.rmtree(self.tmpdir)
+
+    def callback_a(self, response):
+        self.responses.append(('a', response['params'][0]))
+
+    def callback_b(self, response):
+        self.responses.append(('b', response['params'][0]))
+
+    def subscribe(self, hashes, callback):
+        network = self.network
+        for h in hashes:
+            # answer from the cache, as no server is there to do it
+            network.sub_cache['blockchain.scripthash.subscribe:' + h] = {'params': [h], 'result': None}
+        network.subscribe_to_scripthashes(hashes, callback)
+        network.interface = True
+        network.process_pending_sends()
+        network.interface = None
+
+    def test_unsubscribe(self):
+        network = self.network
+        self.subscribe(['h1', 'h2'], self.callback_a)
+        self.subscribe(['h2', 'h3'], self.callback_b)
+        self.assertEqual(sorted(self.responses), [('a', 'h1'), ('a', 'h2'), ('b', 'h2'), ('b', 'h3')])
+        key = 'blockchain.scripthash.subscribe:'
+        self.assertEqual(network.subscriptions[key + 'h2'], [self.callback_a, self.callback_b])
+        network.unsubscribe(self.callback_a)
+        # h2 is shared and stays subscribed for b
+        self.assertEqual(dict(network.subscriptions), {key + 'h2': [self.callback_b],
+                                                       key + 'h3': [self.callback_b]})
+        self.assertEqual(dict(network.subscriptions_by_callback), {self.callback_b: {key + 'h2', key + 'h3'}})
+        network.unsubscribe(self.callback_b)
+        self.assertFalse(network.subscriptions)
+        self.assertFalse(network.subscriptions_by_callback)
+
+    def test_cancel_requests(self):
+        network = self.network
+        ids_a = [network.queue_request('blockchain.transaction.get', [str(n)], callback=self.callback_a)
+                 for n in range(3)]
+        id_b = network.queue_request('blockchain.transaction.get', ['b'], callback=self.callback_b)
+        self.assertEqual(network.pop_unanswered_request(ids_a[0])[2], self.callback_a)
+        self.assertEqual(network.requests_by_callback[self.callback_a], set(ids_a[1:]))
+        network.cancel_requests(self.callback_a)
+        self.assertEqual(list(network.unanswered_requests), [id_b])
+        self.assertEqual(dict(network.requests_by_callback), {self.callback_b: {id_b}})
+        self.assertIsNone(network.pop_unanswered_request(ids_a[1]))
+        network.pop_unanswered_request(id_b)
+        self.assertFalse(network.requests_by_callback)
@@ -51,6 +51,49 @@ class TestSchnorr(unittest.TestCase):
             schnorr._secp256k1_schnorr_sign, schnorr._secp256k1_schnorr_verify = saved
             self.do_it()
 
+class TestVerifyBatch(unittest.TestCase):
+
+    def do_it(self):
+        privkeys = [secrets.token_bytes(32) for _ in range(3)]
+        pubkeys, sigs, msgs = [], [], []
+        for i in range(20):
+            privkey = privkeys[i % 3]  # repeated pubkeys get merged
+            msg = secrets.token_bytes(32)
+            pubkeys.append(regenerate_key(privkey).GetPubKey(i % 2 == 0))
+            sigs.append(schnorr.sign(privkey, msg))
+            msgs.append(msg)
+        self.assertEqual([], schnorr.verify_batch(pubkeys, sigs, msgs))
+        self.assertEqual([], schnorr.verify_batch([], [], []))
+
+        # wrong message, s out of range, r not on the curve, sig of another key
+        msgs[3] = secrets.token_bytes(32)
+        sigs[7] = sigs[7][:32] + (2**256 - 1).to_bytes(32, 'big')
+        sigs[12] = (5).to_bytes(32, 'big') + sigs[12][32:]
+        sigs[19] = sigs[18]
+        bad = [3, 7, 12, 19]
+        self.assertEqual(bad, schnorr.verify_batch(pubkeys, sigs, msgs))
+        for i, args in enumerate(zip(pubkeys, sigs, msgs)):
+            self.assertEqual(i not in bad, schnorr.verify(*args))
+
+        with self.assertRaises(ValueError):
+            schnorr.verify_batch(pubkeys, sigs, msgs[1:])
+        with self.assertRaises(ValueError):
+            schnorr.verify_batch([b'\x05' * 33], sigs[:1], msgs[:1])
+
+    def test_slow(self):
+        saved = schnorr._secp256k1_schnorr_verify
+        schnorr._secp256k1_schnorr_verify = None
+        try:
+            self.do_it()
+        finally:
+            schnorr._secp256k1_schnorr_verify = saved
+
+    def test_fast(self):
+        if not schnorr.has_fast_verify():
+            self.skipTest("accelerated ECC library not available")
+        self.do_it()
+
+
 class TestBlind(unittest.TestCase):
 
     def do_it(self):
@@ -1,9 +1,12 @@
+import threading
 import unittest
+from unittest import mock
 from pprint import pprint
 
+from .. import ecc_fast
 from .. import transaction
-from ..address import Address, ScriptOutput, PublicKey
-from ..bitcoin import TYPE_ADDRESS, TYPE_PUBKEY, TYPE_SCRIPT
+from ..address import Address, ScriptOutput, PublicKey, Script
+from ..bitcoin import TYPE_ADDRESS, TYPE_PUBKEY, TYPE_SCRIPT, public_key_from_private_key
 
 from ..keystore import xpubkey_to_address
 
@@ -46,6 +49,11 @@ class TestBCDataStream(unittest.TestCase):
         with self.assertRaises(transaction.SerializationError):
             s.read_string()
 
+    def test_compact_size_matches_var_int(self):
+        from ..bitcoin import var_int
+        for v in [0, 1, 252, 253, 2**16-1, 2**16, 2**32-1, 2**32, 2**64-1]:
+            self.assertEqual(var_int(v), bh2u(transaction.compact_size(v)))
+
     def test_bytes(self):
         s = transaction.BCDataStream()
         s.write(b'foobar')
@@ -125,6 +133,9 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(tx.as_dict(), {'hex': signed_blob, 'complete': True, 'final': True})
 
         self.assertEqual(tx.serialize(), signed_blob)
+        self.assertEqual(bytes.fromhex(signed_blob), tx.serialize_bytes())
+        self.assertEqual(expected, transaction.deserialize(bytes.fromhex(signed_blob)))
+        self.assertEqual(tx.txid(), transaction.Transaction._txid(signed_blob))
 
         tx.update_signatures([expected['inputs'][0]['signatures'][0][:-2]])
 
@@ -227,6 +238,23 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(tx.outputs(), [(TYPE_SCRIPT, ScriptOutput(b'\x4c\x41\x04' + b'\x00'*64 + b'\xac'), 0)])
         self.assertEqual('bd8e0827c8bacd6bac10dd28d5fc6ad52f3fef3f91200c7c1d8698531c9325e9', tx.txid())
 
+    def test_serialize_preimage(self):
+        expected = ('010000001182991bddc02690e8dce25d7b06f54a6d170bdf24db577544acb3ff8ab80d8b'
+                    '18606b350cd8bf565266bc352f0caddcf01e8fa789dd8a15386327cf8cabe19849f35e43'
+                    'fefd22d8bb9e4b3ff294c6286154c25712baf6ab77b646e5074d6aed010000001976a914'
+                    '1b633d96290b55e85ee1a708c8cf99981db6df3c88acd8e4320100000000feffffff6937'
+                    '481c56c17c4bada2459f5e69fe2852f1d218cef12dfe3e6a2300ad843f435fbd07004100'
+                    '0000')
+        tx = transaction.Transaction(unsigned_blob)
+        self.assertEqual(expected, tx.serialize_preimage(0))
+        self.assertEqual(expected, tx.serialize_preimage(0, use_cache=True))
+        # the cached hashOutputs must not survive adding an output
+        out = (TYPE_ADDRESS, Address.from_string('1CQj15y1N7LDHp7wTt28eoD1QhHgFgxECH'), 1000)
+        tx.add_outputs([out])
+        uncached = tx.serialize_preimage(0)
+        self.assertNotEqual(expected, uncached)
+        self.assertEqual(uncached, tx.serialize_preimage(0, use_cache=True))
+
     def test_parse_output_baremultisig(self):
         # no special support for recognizing bare multisig outputs
         tx = transaction.Transaction('0100000001000000000000000000000000000000000000000000000000000000000000000000000000000000000001000000000000000025512103000000000000000000000000000000000000000000000000000000000000000051ae00000000')
@@ -260,6 +288,82 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual("", tx.outputs()[0][1].to_ui_string())
         self.assertEqual('50fa7bd4e5e2d3220fd2e84effec495b9845aba379d853408779d59a4b0b4f59', tx.txid())
 
+    def _make_unsigned(self, pubkeys, num_sig, num_inputs):
+        pubkeys = sorted(pubkeys)
+        if num_sig == 1:
+            _type, addr = 'p2pkh', Address.from_pubkey(pubkeys[0])
+        else:
+            _type, addr = 'p2sh', Address.from_multisig_script(Script.multisig_script(
+                num_sig, [bytes.fromhex(pk) for pk in pubkeys]))
+        txins = [{'type': _type, 'address': addr, 'num_sig': num_sig,
+                  'value': 10000, 'prevout_hash': '%064x' % (i + 1), 'prevout_n': i,
+                  'x_pubkeys': list(pubkeys), 'pubkeys': list(pubkeys),
+                  'signatures': [None] * len(pubkeys)}
+                 for i in range(num_inputs)]
+        return transaction.Transaction.from_io(txins, [(TYPE_ADDRESS, addr, 9000 * num_inputs)])
+
+    def test_sign_parallel(self):
+        privkeys = [bytes([i]) * 32 for i in (1, 2, 3)]
+        pubkeys = [public_key_from_private_key(k, True) for k in privkeys]
+        keypairs = {pk: (k, True) for pk, k in zip(pubkeys, privkeys)}
+        # single sig, and 2 of 3 multisig with only two of the keys on hand
+        cases = ((pubkeys[:1], 1, keypairs),
+                 (pubkeys, 2, {pk: keypairs[pk] for pk in pubkeys[1:]}))
+        for schnorr in (False, True):
+            for tx_pubkeys, num_sig, tx_keypairs in cases:
+                txs = []
+                for workers in (1, 2):
+                    tx = self._make_unsigned(tx_pubkeys, num_sig, 6)
+                    tx.set_sign_schnorr(schnorr)
+                    tx.set_sign_workers(workers)
+                    tx.sign(tx_keypairs)
+                    self.assertTrue(tx.is_complete())
+                    txs.append(tx)
+                self.assertEqual(txs[0].raw, txs[1].raw)
+
+    def test_sign_parallel_in_process(self):
+        # private keys must not be handed to other processes, and signing
+        # must work from daemon threads such as the RPC workers
+        privkey = b'\x01' * 32
+        pubkey = public_key_from_private_key(privkey, True)
+        tx = self._make_unsigned([pubkey], 1, 4)
+        tx.set_sign_workers(4)
+        def sign():
+            tx.sign({pubkey: (privkey, True)})
+        with mock.patch('os.fork', side_effect=AssertionError('forked')):
+            thread = threading.Thread(target=sign, daemon=True)
+            thread.start()
+            thread.join()
+        self.assertTrue(tx.is_complete())
+
+    @unittest.skipUnless(ecc_fast.is_using_fast_ecc(), 'libsecp256k1 not available')
+    def test_sign_with_libsecp256k1(self):
+        # the libsecp256k1 path must make the same signatures as python-ecdsa
+        privkeys = [bytes([i]) * 32 for i in (1, 2, 3)]
+        pubkeys = [public_key_from_private_key(k, True) for k in privkeys]
+        keypairs = {pk: (k, True) for pk, k in zip(pubkeys, privkeys)}
+        raws = []
+        for fast in (True, False):
+            tx = self._make_unsigned(pubkeys, 2, 6)
+            tx.set_sign_workers(2)
+            if fast:
+                tx.sign(keypairs)
+            else:
+                ecc_fast.undo_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
+                try:
+                    tx.sign(keypairs)
+                finally:
+                    ecc_fast.do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
+            self.assertTrue(tx.is_complete())
+            raws.append(tx.raw)
+        self.assertEqual(raws[0], raws[1])
+        pubkey, sig = ecc_fast.sign_digest(privkeys[0], b'\x05' * 32, compressed=False)
+        self.assertEqual(pubkey.hex(), public_key_from_private_key(privkeys[0], False))
+        self.assertTrue(transaction.Transaction.verify_signature(pubkey, sig, b'\x05' * 32))
+        with self.assertRaises(ValueError):
+            ecc_fast.sign_digest(b'\x00' * 32, b'\x05' * 32)
+
+
 class NetworkMock(object):
 
     def __init__(self, unspent):
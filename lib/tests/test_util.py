@@ -1,5 +1,7 @@
+import json
+import socket
 import unittest
-from ..util import format_satoshis
+from ..util import format_satoshis, SocketPipe, timeout
 from ..web import parse_URI
 
 class TestUtil(unittest.TestCase):
@@ -110,3 +112,55 @@ class TestUtil(unittest.TestCase):
 
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoincash:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
+
+
+class FakeSocket:
+    ''' Hands out the given data in pieces of at most `step` bytes. '''
+
+    def __init__(self, data, step):
+        self.data = data
+        self.step = step
+        self.sent = b''
+
+    def settimeout(self, t):
+        pass
+
+    def recv(self, n):
+        n = min(n, self.step)
+        data, self.data = self.data[:n], self.data[n:]
+        if not data:
+            raise socket.timeout
+        return data
+
+    def send(self, data):
+        data = bytes(data[:self.step])
+        self.sent += data
+        return len(data)
+
+
+class TestSocketPipe(unittest.TestCase):
+
+    def test_get(self):
+        big = {'id': 2, 'result': 'ab' * 100000}
+        data = b'{"id": 1}\n' + json.dumps(big).encode() + b'\nnot json\n{"id": 3}\n{"id"'
+        for step in (1, 7, 1000, len(data)):
+            pipe = SocketPipe(FakeSocket(data, step))
+            self.assertEqual(pipe.get(), {'id': 1})
+            self.assertEqual(pipe.get(), big)
+            self.assertEqual(pipe.get(), {'id': 3})
+            with self.assertRaises(timeout):
+                pipe.get()
+            self.assertEqual(pipe.message, b'{"id"')
+            pipe.socket.data = b': 4}\n'
+            self.assertEqual(pipe.get(), {'id': 4})
+
+    def test_message_size_exceeded(self):
+        pipe = SocketPipe(FakeSocket(b'x' * 100, 10), max_message_bytes=50)
+        with self.assertRaises(SocketPipe.MessageSizeExceeded):
+            pipe.get()
+
+    def test_send_all(self):
+        requests = [{'id': n, 'method': 'server.ping'} for n in range(10)]
+        pipe = SocketPipe(FakeSocket(b'', 13))
+        pipe.send_all(requests)
+        self.assertEqual([json.loads(line) for line in pipe.socket.sent.splitlines()], requests)
@@ -2,12 +2,20 @@ import shutil
 import tempfile
 import sys
 import unittest
+from unittest import mock
 import os
 import json
+import sqlite3
+from contextlib import closing
 
 from io import StringIO
 from ..storage import WalletStorage, FINAL_SEED_VERSION
 from .. import wallet
+from .. import bitcoin
+from .. import keystore
+from ..address import Address
+from ..bitcoin import TYPE_ADDRESS
+from ..transaction import Transaction
 
 
 class FakeSynchronizer(object):
@@ -68,3 +76,526 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+    def test_db_format(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 'b')
+        storage.set_db_format(True)
+        storage.write()
+
+        with closing(sqlite3.connect(self.wallet_path)) as conn:
+            contents = {k: json.loads(v) for k, v in conn.execute('SELECT key, value FROM data')}
+        self.assertEqual({'a': 'b', 'seed_version': FINAL_SEED_VERSION}, contents)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(contents, storage.data)
+        self.assertFalse(storage.requires_upgrade())
+
+        # and back to JSON
+        storage.set_db_format(False)
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(contents, json.loads(f.read()))
+
+    def test_write_only_modified_keys(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_db_format(True)
+        storage.put('a', {'x': 1})
+        storage.put('b', [1, 2])
+        storage.write()
+
+        storage.put('a', {'x': 2})
+        storage.put('b', None)
+        with mock.patch.object(storage, '_db_row', wraps=storage._db_row) as db_row:
+            storage.write()
+            db_row.assert_called_once_with('a', {'x': 2})
+        self.assertEqual({'a': {'x': 2}, 'seed_version': FINAL_SEED_VERSION},
+                         WalletStorage(self.wallet_path).data)
+
+    def test_get_put_ownership(self):
+        storage = WalletStorage(self.wallet_path)
+        value = {'a': [1, 2], 'b': {'c': (3, 'd')}}
+        storage.put('x', value)
+        value['a'].append(3)
+        self.assertEqual([1, 2], storage.get('x')['a'])
+        storage.get('x')['a'].append(4)
+        self.assertEqual([1, 2], storage.get('x')['a'])
+
+        # without copies the caller hands over / gets a view of the stored value
+        storage.put('x', value, copy=False)
+        self.assertIs(value, storage.get('x', copy=False))
+        self.assertIn('x', storage._dirty_keys)
+        storage.write()
+        storage.put('x', value, copy=False)
+        self.assertFalse(storage.modified)
+
+        # values that would not serialize are refused
+        storage.put('y', {'z': object()})
+        storage.put('y', {(1, 2): 'z'})
+        self.assertIsNone(storage.get('y'))
+        storage.put('y', {1: None, 'f': [1.5, True, ('g',)]})
+        self.assertEqual({1: None, 'f': [1.5, True, ('g',)]}, storage.get('y'))
+
+    def test_encrypted_db(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_db_format(True)
+        storage.put('a', 'b')
+        storage.set_password('secret', encrypt=True)
+        storage.write()
+        storage.put('c', 'd')
+        storage.write()
+        storage.put('a', None)
+        storage.write()
+        # the key names are not in the clear either
+        with closing(sqlite3.connect(self.wallet_path)) as conn:
+            keys = [k for k, in conn.execute('SELECT key FROM data')]
+        self.assertEqual(3, len(keys))
+        self.assertFalse({'a', 'c', 'seed_version', 'use_encryption'} & set(keys))
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted())
+        self.assertIsNone(storage.get('a'))
+        storage.decrypt('secret')
+        self.assertIsNone(storage.get('a'))
+        self.assertEqual('d', storage.get('c'))
+
+        # removing the password rewrites the file unencrypted
+        storage.set_password(None, encrypt=False)
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertFalse(storage.is_encrypted())
+        self.assertEqual('d', storage.get('c'))
+
+    def test_json_wallet_stays_json(self):
+        some_dict = {"a": "b", "wallet_type": "standard", "seed_version": 17,
+                     "keystore": {"type": "bip32", "xpub": "x"}}
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps(some_dict))
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertFalse(storage.requires_upgrade())
+        storage.put('c', 'd')
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(dict(some_dict, c='d'), json.loads(f.read()))
+
+
+class TestWalletHistory(WalletTestCase):
+    ''' Tests the wallet's transaction bookkeeping (txi/txo, utxo index and
+    friends) by feeding it history the same way the synchronizer does. '''
+
+    def setUp(self):
+        super().setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.wallet = wallet.ImportedPrivkeyWallet(self.storage)
+        self.keypairs = {}
+        self.addrs = [self._import_key(i) for i in range(1, 4)]
+        self.ext_pubkey = self._add_keypair(bytes([9]) * 32)
+        self.ext_addr = Address.from_pubkey(self.ext_pubkey)
+
+    def tearDown(self):
+        self.wallet.stop_threads()
+        super().tearDown()
+
+    def _add_keypair(self, privkey):
+        pubkey = bitcoin.public_key_from_private_key(privkey, True)
+        self.keypairs[pubkey] = (privkey, True)
+        return pubkey
+
+    def _import_key(self, i):
+        privkey = bytes([i]) * 32
+        self._add_keypair(privkey)
+        wif = bitcoin.serialize_privkey(privkey, True, 'p2pkh')
+        return Address.from_string(self.wallet.import_private_key(wif, None))
+
+    def _make_tx(self, inputs, outputs):
+        ''' inputs is a list of (address, prevout_hash, prevout_n, value) '''
+        txins = []
+        for addr, prevout_hash, prevout_n, value in inputs:
+            pubkey = next(pk for pk in self.keypairs
+                          if Address.from_pubkey(pk) == addr)
+            txins.append({
+                'type': 'p2pkh', 'address': addr, 'value': value,
+                'prevout_hash': prevout_hash, 'prevout_n': prevout_n,
+                'x_pubkeys': [pubkey], 'pubkeys': [pubkey],
+                'signatures': [None], 'num_sig': 1,
+            })
+        outputs = [(TYPE_ADDRESS, addr, value) for addr, value in outputs]
+        tx = Transaction.from_io(txins, outputs, locktime=0)
+        tx.sign(self.keypairs)
+        return Transaction(str(tx))
+
+    def _receive(self, tx, height, addrs):
+        ''' Simulates the synchronizer learning of tx at height for addrs. '''
+        tx_hash = tx.txid()
+        for addr in addrs:
+            hist = [item for item in self.wallet.get_address_history(addr)
+                    if item[0] != tx_hash]
+            self.wallet.receive_history_callback(addr, hist + [(tx_hash, height)], {})
+        self.wallet.receive_tx_callback(tx_hash, tx, height)
+        return tx_hash
+
+    def _forget(self, tx_hash, addrs):
+        ''' Simulates the server dropping tx_hash from the history of addrs. '''
+        for addr in addrs:
+            hist = [item for item in self.wallet.get_address_history(addr)
+                    if item[0] != tx_hash]
+            self.wallet.receive_history_callback(addr, hist, {})
+
+    def _fund(self, height=100):
+        a0, a1, a2 = self.addrs
+        tx1 = self._make_tx([(self.ext_addr, 'ab' * 32, 0, 200000)],
+                            [(a0, 100000), (a1, 50000)])
+        return self._receive(tx1, height, [a0, a1])
+
+    def _expected_history(self, domain):
+        ''' The history of domain, computed from scratch. '''
+        w = self.wallet
+        deltas = {}
+        for addr in domain:
+            for tx_hash, height in w.get_address_history(addr):
+                delta = w.get_tx_delta(tx_hash, addr)
+                old = deltas.get(tx_hash, 0)
+                deltas[tx_hash] = None if delta is None or old is None else old + delta
+        balance = sum(w.get_balance(domain))
+        h = []
+        for tx_hash in sorted(deltas, key=lambda tx_hash: (w.get_txpos(tx_hash), tx_hash), reverse=True):
+            h.append((tx_hash,) + w.get_tx_height(tx_hash) + (deltas[tx_hash], balance))
+            if balance is None or deltas[tx_hash] is None:
+                balance = None
+            else:
+                balance -= deltas[tx_hash]
+        return h[::-1]
+
+    def _check_history(self):
+        ''' The cached histories must match the ones computed from scratch. '''
+        for domain in (None, self.addrs[:1], self.addrs[1:]):
+            h = self._expected_history(self.wallet.get_addresses() if domain is None else domain)
+            view = self.wallet.get_history(domain)
+            self.assertEqual(h, list(view))
+            self.assertEqual(h, [view[i] for i in range(len(view))])
+            self.assertEqual(h[::-1], list(self.wallet.get_history(domain, reverse=True)))
+            self.assertEqual(h[::-1], list(reversed(view)))
+        return list(self.wallet.get_history())
+
+    def _utxo_set(self, **kwargs):
+        return {(c['prevout_hash'], c['prevout_n'], c['value'], c['height'])
+                for c in self.wallet.get_utxos(**kwargs)}
+
+    def test_utxos_follow_history(self):
+        a0, a1, a2 = self.addrs
+        tx1_hash = self._fund()
+        self.assertEqual({(tx1_hash, 0, 100000, 100), (tx1_hash, 1, 50000, 100)},
+                         self._utxo_set())
+        self.assertEqual((150000, 0, 0), self.wallet.get_balance())
+
+        tx2 = self._make_tx([(a0, tx1_hash, 0, 100000)], [(a2, 90000)])
+        tx2_hash = self._receive(tx2, 0, [a0, a2])
+        self.assertEqual({(tx1_hash, 1, 50000, 100), (tx2_hash, 0, 90000, 0)},
+                         self._utxo_set())
+        self.assertEqual({(tx1_hash, 1, 50000, 100)},
+                         self._utxo_set(confirmed_only=True))
+        self.assertEqual({}, self.wallet.get_addr_utxo(a0))
+        self.assertEqual((150000, -100000, 0), self.wallet.get_balance([a0, a1]))
+        self.assertEqual((150000, -10000, 0), self.wallet.get_balance())
+
+        self.assertEqual({tx1_hash: {tx2_hash}}, self.wallet._txi_spenders)
+
+        # server drops the unconfirmed spend: a0's coin is unspent again
+        self._forget(tx2_hash, [a0, a2])
+        self.assertEqual({}, self.wallet._txi_spenders)
+        self.assertEqual({(tx1_hash, 0, 100000, 100), (tx1_hash, 1, 50000, 100)},
+                         self._utxo_set())
+        self.assertEqual((150000, 0, 0), self.wallet.get_balance())
+
+    def test_addr_io_copies(self):
+        a0, a1, a2 = self.addrs
+        tx1_hash = self._fund()
+        received, sent = self.wallet.get_addr_io(a0)
+        received.clear()
+        sent[tx1_hash + ':0'] = 100
+        self.assertEqual({(tx1_hash, 0, 100000, 100), (tx1_hash, 1, 50000, 100)},
+                         self._utxo_set())
+        self.assertEqual(({tx1_hash + ':0': (100, 100000, False)}, {}),
+                         self.wallet.get_addr_io(a0))
+        self.assertEqual(100000, self.wallet.get_addr_received(a0))
+
+    def test_utxos_frozen(self):
+        a0, a1, a2 = self.addrs
+        tx1_hash = self._fund()
+        self.wallet.set_frozen_state([a1], True)
+        self.assertEqual({(tx1_hash, 0, 100000, 100)},
+                         self._utxo_set(exclude_frozen=True))
+        self.wallet.set_frozen_coin_state([tx1_hash + ':0'], True)
+        self.assertEqual(set(), self._utxo_set(exclude_frozen=True))
+        coin = self.wallet.get_addr_utxo(a0)[tx1_hash + ':0']
+        self.assertTrue(coin['is_frozen_coin'])
+        self.assertEqual(2, len(self._utxo_set()))
+
+    def test_pruned_txo(self):
+        a0, a1, a2 = self.addrs
+        tx1 = self._make_tx([(self.ext_addr, 'ab' * 32, 0, 200000)],
+                            [(a0, 100000), (a1, 50000)])
+        tx1_hash = tx1.txid()
+        tx2 = self._make_tx([(a0, tx1_hash, 0, 100000)], [(a2, 90000)])
+        # the spend arrives before the tx it spends from
+        tx2_hash = self._receive(tx2, 0, [a0, a2])
+        self.assertEqual({tx1_hash + ':0': tx2_hash}, self.wallet.pruned_txo)
+        self.assertEqual({tx2_hash: {tx1_hash + ':0'}}, self.wallet.pruned_txo_values)
+        self.assertIsNone(self.wallet.get_tx_delta(tx2_hash, a0))
+
+        self._receive(tx1, 100, [a0, a1])
+        self.assertEqual({}, self.wallet.pruned_txo)
+        self.assertEqual({}, self.wallet.pruned_txo_values)
+        self.assertEqual(-100000, self.wallet.get_tx_delta(tx2_hash, a0))
+        self.assertEqual({tx1_hash: {tx2_hash}}, self.wallet._txi_spenders)
+
+        self._check_history()
+
+        # removing the funding tx prunes the spent outpoint again
+        self._forget(tx1_hash, [a0, a1])
+        # and tx2's delta is unknown, as are the balances before it
+        self.assertEqual([(tx2_hash, 0, 0, 0, None, 90000)], self._check_history())
+        self.assertEqual({tx1_hash + ':0': tx2_hash}, self.wallet.pruned_txo)
+        self.assertEqual({tx2_hash: {tx1_hash + ':0'}}, self.wallet.pruned_txo_values)
+        self.assertEqual({}, self.wallet._txi_spenders)
+        self.assertEqual({}, self.wallet.txi[tx2_hash])
+
+    def test_storage_untouched_until_save(self):
+        a0, a1, a2 = self.addrs
+        tx0_hash = self._receive(self._make_tx([(self.ext_addr, 'ab' * 32, 0, 200000)],
+                                               [(a0, 100000)]), 100, [a0])
+        tx1 = self._make_tx([(self.ext_addr, 'ab' * 32, 1, 200000)], [(a0, 50000)])
+        tx1_hash = tx1.txid()
+        # spends a known and a not yet known coin of a0
+        tx2 = self._make_tx([(a0, tx0_hash, 0, 100000), (a0, tx1_hash, 0, 50000)],
+                            [(a2, 140000)])
+        tx2_hash = self._receive(tx2, 0, [a0, a2])
+        self.wallet.save_transactions(write=True)
+
+        # the txi/txo/history leaves of a loaded wallet are shared with storage
+        self.wallet.stop_threads()
+        storage = WalletStorage(self.wallet_path)
+        self.wallet = wallet.ImportedPrivkeyWallet(storage)
+        def saved():
+            return json.dumps({k: storage.data.get(k) for k in
+                               ('txi', 'txo', 'addr_history', 'transactions')},
+                              sort_keys=True)
+        before = saved()
+        self._receive(tx1, 100, [a0])
+        self.assertEqual(2, len(self.wallet.txi[tx2_hash][a0]))
+        self.assertEqual(before, saved())
+        self._forget(tx1_hash, [a0])
+        self.assertEqual(1, len(self.wallet.txi[tx2_hash][a0]))
+        self.assertEqual(before, saved())
+        self._receive(tx1, 100, [a0])
+        self.wallet.save_transactions()
+        self.assertNotEqual(before, saved())
+        self.assertEqual(2, len(storage.get('txi')[tx2_hash][a0.to_storage_string()]))
+
+    def test_history(self):
+        a0, a1, a2 = self.addrs
+        self.assertEqual([], self._check_history())
+        tx1_hash = self._fund(height=0)
+        self.assertEqual([(tx1_hash, 0, 0, 0, 150000, 150000)], self._check_history())
+
+        tx2 = self._make_tx([(a0, tx1_hash, 0, 100000)], [(a2, 90000), (self.ext_addr, 5000)])
+        tx2_hash = self._receive(tx2, 0, [a0, a2])
+        self.assertEqual([tx1_hash, tx2_hash] if tx1_hash < tx2_hash else [tx2_hash, tx1_hash],
+                         [item[0] for item in self._check_history()])
+
+        # tx1 gets mined and verified: it now sorts before tx2
+        with mock.patch.object(self.wallet, 'network') as network:
+            network.get_local_height.return_value = 101
+            tx1 = self.wallet.transactions[tx1_hash]
+            self._receive(tx1, 100, [a0, a1])
+            self.wallet.add_verified_tx(tx1_hash, (100, 1500000000, 1), None)
+            self.assertEqual([(tx1_hash, 100, 2, 1500000000, 150000, 150000),
+                              (tx2_hash, 0, 0, 0, -10000, 140000)],
+                             self._check_history())
+
+            self._forget(tx2_hash, [a0, a2])
+            self.assertEqual([(tx1_hash, 100, 2, 1500000000, 150000, 150000)],
+                             self._check_history())
+
+            # a new block only changes the confirmation count
+            network.get_local_height.return_value = 102
+            self.assertEqual([(tx1_hash, 100, 3, 1500000000, 150000, 150000)],
+                             self._check_history())
+
+    def test_history_incremental(self):
+        a0, a1, a2 = self.addrs
+        tx1_hash = self._fund()
+        old = self.wallet.get_history()
+        old_items = list(old)
+        tx2 = self._make_tx([(a0, tx1_hash, 0, 100000)], [(a2, 90000)])
+        with mock.patch.object(wallet._HistoryCache, '_get_item',
+                               autospec=True, side_effect=wallet._HistoryCache._get_item) as get_item:
+            tx2_hash = self._receive(tx2, 0, [a0, a2])
+            h = self.wallet.get_history()
+            # only the new tx was looked at, and the cache was not rebuilt
+            self.assertEqual({tx2_hash}, {call[0][2] for call in get_item.call_args_list})
+        self.assertEqual([tx1_hash, tx2_hash], [item[0] for item in h])
+        self.assertEqual(140000, h[-1][5])
+        # what was returned before is a snapshot
+        self.assertEqual(old_items, list(old))
+        self.assertEqual(1, len(old))
+        self.assertEqual(h[:1], old_items)
+        self._check_history()
+
+    def test_history_domains_cached(self):
+        a0, a1, a2 = self.addrs
+        self._fund()
+        self.wallet.get_history()
+        for addr in self.addrs:
+            self.wallet.get_history([addr])
+        self.assertEqual([None] + [frozenset([addr]) for addr in self.addrs],
+                         list(self.wallet._hist_caches))
+        with mock.patch.object(self.wallet, 'HISTORY_CACHES', 2):
+            self.wallet.get_history([a1])
+            self.wallet.get_history([a0, a1])
+        # the least recently used domains went, the whole wallet stays
+        self.assertEqual([None, frozenset([a1]), frozenset([a0, a1])],
+                         list(self.wallet._hist_caches))
+
+    def test_spv_proofs(self):
+        from ..verifier import SPV
+        tx1_hash = self._fund()
+        header_a = {'merkle_root': 'aa' * 32, 'timestamp': 1500000000}
+        header_b = {'merkle_root': 'bb' * 32, 'timestamp': 1500000000}
+        with mock.patch.object(self.wallet, 'network') as network:
+            network.get_local_height.return_value = 101
+            network.interface.window = 100
+            network.blockchain.return_value = network.interface.blockchain
+            read_header = network.interface.blockchain.read_header
+
+            self.wallet.add_verified_tx(tx1_hash, (100, 1500000000, 1), header_a)
+            self.assertEqual((100, 1, 'aa' * 32), self.wallet.get_spv_proof(tx1_hash))
+            self.wallet.save_verified_tx()
+            self.assertEqual({tx1_hash: (100, 1, 'aa' * 32)}, self.storage.get('spv_proofs'))
+
+            # a reorg to a block with the same timestamp is still caught,
+            # and the proof is kept
+            read_header.return_value = header_b
+            self.assertEqual({tx1_hash}, self.wallet.undo_verifications(network.interface.blockchain, 0))
+            self.assertNotIn(tx1_hash, self.wallet.verified_tx)
+            self.assertEqual((100, 1, 'aa' * 32), self.wallet.get_spv_proof(tx1_hash))
+
+            # on this chain the server is asked for the merkle branch
+            self.wallet.add_unverified_tx(tx1_hash, 100)
+            verifier = SPV(network, self.wallet)
+            verifier.run()
+            network.get_merkle_for_transaction.assert_called_once_with(
+                tx1_hash, 100, verifier.verify_merkle, max_qlen=100)
+            self.assertNotIn(tx1_hash, self.wallet.verified_tx)
+
+            # back on the first chain the stored proof verifies it locally
+            network.get_merkle_for_transaction.reset_mock()
+            read_header.return_value = header_a
+            verifier = SPV(network, self.wallet)
+            verifier.run()
+            network.get_merkle_for_transaction.assert_not_called()
+            self.assertEqual((100, 1500000000, 1), self.wallet.verified_tx[tx1_hash])
+
+    def test_transactions_are_lazy(self):
+        tx1_hash = self._fund()
+        raw = str(self.wallet.transactions[tx1_hash])
+        self.wallet.save_transactions()
+        self.assertEqual({tx1_hash: raw}, self.storage.get('transactions'))
+
+        txs = wallet.TxStore(self.storage.get('transactions'), maxlen=1)
+        self.assertIn(tx1_hash, txs)
+        self.assertEqual(raw, txs.get_raw(tx1_hash))
+        self.assertEqual(0, len(txs._lru))
+        tx = txs[tx1_hash]
+        self.assertEqual(tx1_hash, tx.txid())
+        self.assertIs(tx, txs.get(tx1_hash))
+        txs['00' * 32] = Transaction(raw)
+        self.assertEqual(['00' * 32], list(txs._lru))  # evicted tx1
+        self.assertEqual(raw, str(txs.pop(tx1_hash)))
+        self.assertIsNone(txs.pop(tx1_hash, None))
+        self.assertEqual(['00' * 32], list(txs))
+
+    def test_address_status(self):
+        from ..synchronizer import Synchronizer
+        a0, a1, a2 = self.addrs
+        self.assertIsNone(self.wallet.get_address_status(a0))
+        tx1_hash = self._fund()
+        status = Synchronizer.get_status([(tx1_hash, 100)])
+        self.assertEqual(status, self.wallet.get_address_status(a0))
+        # a status handed in by the synchronizer is taken as is
+        self.wallet.receive_history_callback(a1, [(tx1_hash, 100)], {}, 'cafe')
+        self.assertEqual('cafe', self.wallet.get_address_status(a1))
+        self.wallet.save_transactions()
+        self.assertEqual({a0.to_storage_string(): status, a1.to_storage_string(): 'cafe'},
+                         self.storage.get('addr_status'))
+        # persisted across restarts, without looking at the history
+        with mock.patch.object(Synchronizer, 'get_status') as get_status:
+            w = wallet.ImportedPrivkeyWallet(self.storage)
+            self.assertEqual(status, w.get_address_status(a0))
+            self.assertEqual('cafe', w.get_address_status(a1))
+            get_status.assert_not_called()
+        # and dropped when the history changes
+        self._forget(tx1_hash, [a0, a1])
+        self.assertIsNone(self.wallet.get_address_status(a0))
+        self.assertIsNone(self.wallet.get_address_status(a1))
+
+
+class TestDeterministicWallet(WalletTestCase):
+
+    def setUp(self):
+        super().setUp()
+        xprv, xpub = bitcoin.bip32_root(b'\x01' * 32, 'standard')
+        self.xpub = xpub
+        self.storage = WalletStorage(self.wallet_path)
+        self.storage.put('keystore', keystore.from_xpub(xpub).dump())
+        self.storage.put('wallet_type', 'standard')
+        self.storage.put('gap_limit', 10)
+        self.wallet = wallet.Standard_Wallet(self.storage)
+
+    def tearDown(self):
+        self.wallet.stop_threads()
+        super().tearDown()
+
+    def _address(self, for_change, n):
+        pubkey = keystore.Xpub.get_pubkey_from_xpub(self.xpub, (int(for_change), n))
+        return Address.from_pubkey(pubkey)
+
+    def test_create_new_addresses(self):
+        addrs = self.wallet.create_new_addresses(False, 5)
+        self.assertEqual([self._address(False, n) for n in range(5)], addrs)
+        self.assertEqual(self._address(False, 5), self.wallet.create_new_address(False))
+        self.assertEqual([self._address(True, 0)], self.wallet.create_new_addresses(True, 1))
+        self.assertEqual(6, len(self.wallet.get_receiving_addresses()))
+        self.assertEqual([a.to_storage_string() for a in addrs + [self._address(False, 5)]],
+                         self.storage.get('addresses')['receiving'])
+
+    def test_synchronize_gap_limit(self):
+        with mock.patch.object(self.wallet, 'save_addresses',
+                               wraps=self.wallet.save_addresses) as save:
+            self.wallet.synchronize()
+            self.assertEqual(2, save.call_count)
+        self.assertEqual(10, len(self.wallet.get_receiving_addresses()))
+        self.assertEqual(self.wallet.gap_limit_for_change, len(self.wallet.get_change_addresses()))
+        # a used address extends the gap window past itself
+        used = self.wallet.get_receiving_addresses()[7]
+        self.wallet.receive_history_callback(used, [('ab' * 32, 1)], {})
+        with mock.patch.object(self.wallet, 'get_local_height', return_value=100):
+            self.wallet.synchronize()
+        self.assertEqual(18, len(self.wallet.get_receiving_addresses()))
+        self.assertEqual(self._address(False, 17), self.wallet.get_receiving_addresses()[-1])
+
+    def test_get_address_index(self):
+        recv = self.wallet.create_new_addresses(False, 30)
+        change = self.wallet.create_new_addresses(True, 5)
+        self.assertEqual((False, 29), self.wallet.get_address_index(recv[29]))
+        self.assertEqual((True, 4), self.wallet.get_address_index(change[4]))
+        # the map follows later additions and truncation of the lists
+        self.assertEqual((True, 5), self.wallet.get_address_index(
+            self.wallet.create_new_address(True)))
+        # as done by rebuild_history()
+        self.wallet.receiving_addresses = self.wallet.receiving_addresses[:5]
+        with self.assertRaises(Exception):
+            self.wallet.get_address_index(recv[29])
+        self.assertEqual((False, 4), self.wallet.get_address_index(recv[4]))
+        with self.assertRaises(Exception):
+            self.wallet.get_address_index(self._address(False, 100))
@@ -34,10 +34,12 @@ from .bitcoin import *
 from .address import (PublicKey, Address, Script, ScriptOutput, hash160,
                       UnknownAddress, OpCodes as opcodes,
                       P2PKH_prefix, P2PKH_suffix, P2SH_prefix, P2SH_suffix)
+from . import ecc_fast
 from . import schnorr
 from . import util
 import struct
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 #
 # Workalike python implementation of Bitcoin's CDataStream class.
@@ -53,6 +55,25 @@ class SerializationError(Exception):
 class InputValueMissing(Exception):
     """ thrown when the value of an input is needed but not present """
 
+_int16 = struct.Struct('<h')
+_uint16 = struct.Struct('<H')
+_int32 = struct.Struct('<i')
+_uint32 = struct.Struct('<I')
+_int64 = struct.Struct('<q')
+_uint64 = struct.Struct('<Q')
+
+def compact_size(i):
+    ''' Returns the bytes of Bitcoin's variable length integer encoding of i
+    (the binary counterpart of bitcoin.var_int). '''
+    if i < 0xfd:
+        return bytes((i,))
+    elif i <= 0xffff:
+        return b'\xfd' + _uint16.pack(i)
+    elif i <= 0xffffffff:
+        return b'\xfe' + _uint32.pack(i)
+    else:
+        return b'\xff' + _uint64.pack(i)
+
 class BCDataStream(object):
     def __init__(self):
         self.input = None
@@ -105,31 +126,31 @@ class BCDataStream(object):
         return self.read_cursor < len(self.input)
 
     def read_boolean(self): return self.read_bytes(1)[0] != chr(0)
-    def read_int16(self): return self._read_num('<h')
-    def read_uint16(self): return self._read_num('<H')
-    def read_int32(self): return self._read_num('<i')
-    def read_uint32(self): return self._read_num('<I')
-    def read_int64(self): return self._read_num('<q')
-    def read_uint64(self): return self._read_num('<Q')
+    def read_int16(self): return self._read_num(_int16)
+    def read_uint16(self): return self._read_num(_uint16)
+    def read_int32(self): return self._read_num(_int32)
+    def read_uint32(self): return self._read_num(_uint32)
+    def read_int64(self): return self._read_num(_int64)
+    def read_uint64(self): return self._read_num(_uint64)
 
     def write_boolean(self, val): return self.write(chr(1) if val else chr(0))
-    def write_int16(self, val): return self._write_num('<h', val)
-    def write_uint16(self, val): return self._write_num('<H', val)
-    def write_int32(self, val): return self._write_num('<i', val)
-    def write_uint32(self, val): return self._write_num('<I', val)
-    def write_int64(self, val): return self._write_num('<q', val)
-    def write_uint64(self, val): return self._write_num('<Q', val)
+    def write_int16(self, val): return self._write_num(_int16, val)
+    def write_uint16(self, val): return self._write_num(_uint16, val)
+    def write_int32(self, val): return self._write_num(_int32, val)
+    def write_uint32(self, val): return self._write_num(_uint32, val)
+    def write_int64(self, val): return self._write_num(_int64, val)
+    def write_uint64(self, val): return self._write_num(_uint64, val)
 
     def read_compact_size(self):
         try:
             size = self.input[self.read_cursor]
             self.read_cursor += 1
             if size == 253:
-                size = self._read_num('<H')
+                size = self._read_num(_uint16)
             elif size == 254:
-                size = self._read_num('<I')
+                size = self._read_num(_uint32)
             elif size == 255:
-                size = self._read_num('<Q')
+                size = self._read_num(_uint64)
             return size
         except IndexError:
             raise SerializationError("attempt to read past end of buffer")
@@ -137,29 +158,20 @@ class BCDataStream(object):
     def write_compact_size(self, size):
         if size < 0:
             raise SerializationError("attempt to write size < 0")
-        elif size < 253:
-            self.write(bytes([size]))
-        elif size < 2**16:
-            self.write(b'\xfd')
-            self._write_num('<H', size)
-        elif size < 2**32:
-            self.write(b'\xfe')
-            self._write_num('<I', size)
         elif size < 2**64:
-            self.write(b'\xff')
-            self._write_num('<Q', size)
+            self.write(compact_size(size))
 
-    def _read_num(self, format):
+    def _read_num(self, st):
+        ''' st is one of the precompiled struct.Struct objects above '''
         try:
-            (i,) = struct.unpack_from(format, self.input, self.read_cursor)
-            self.read_cursor += struct.calcsize(format)
+            (i,) = st.unpack_from(self.input, self.read_cursor)
+            self.read_cursor += st.size
         except Exception as e:
             raise SerializationError(e)
         return i
 
-    def _write_num(self, format, num):
-        s = struct.pack(format, num)
-        self.write(s)
+    def _write_num(self, st, num):
+        self.write(st.pack(num))
 
 
 # This function comes from bitcointools, bct-LICENSE.txt.
@@ -341,8 +353,11 @@ def parse_output(vds, i):
 
 
 def deserialize(raw):
+    ''' raw may be hex or bytes. '''
     vds = BCDataStream()
-    vds.write(bfh(raw))
+    # parse straight out of the (immutable) bytes: every field read is then a
+    # single slice or unpack_from, without copying the tx into a bytearray
+    vds.input = bytes(raw) if isinstance(raw, (bytes, bytearray)) else bfh(raw)
     d = {}
     start = vds.read_cursor
     d['version'] = vds.read_int32()
@@ -396,6 +411,10 @@ class Transaction:
         self.locktime = 0
         self.version = 1
         self._sign_schnorr = sign_schnorr
+        self._sign_workers = 1
+        # (hashPrevouts, hashSequence, hashOutputs) as used by the sighash of
+        # every input; see _calc_common_sighash
+        self._cached_sighash_tup = None
 
         # attribute used by HW wallets to tell the hw keystore about any outputs
         # in the tx that are to self (change), etc. See wallet.py add_hw_info
@@ -419,9 +438,18 @@ class Transaction:
     def set_sign_schnorr(self, b):
         self._sign_schnorr = b
 
+    def set_sign_workers(self, n):
+        ''' With n > 1, sign() spreads the signing of the inputs over a pool
+        of n threads.  The result is identical to signing serially
+        (signatures are deterministic).  It only pays off with libsecp256k1,
+        which releases the GIL while signing and verifying, and for
+        transactions with many inputs. '''
+        self._sign_workers = max(1, int(n))
+
     def update(self, raw):
         self.raw = raw
         self._inputs = None
+        self.invalidate_common_sighash_cache()
         self.deserialize()
 
     def inputs(self):
@@ -471,6 +499,7 @@ class Transaction:
             raise Exception('API changed: update_signatures expects a list.')
         if len(self.inputs()) != len(signatures):
             raise Exception('expected {} signatures; got {}'.format(len(self.inputs()), len(signatures)))
+        self.invalidate_common_sighash_cache()
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             sig = signatures[i]
@@ -481,7 +510,7 @@ class Transaction:
             if sig_final in txin.get('signatures'):
                 # skip if we already have this signature
                 continue
-            pre_hash = Hash(bfh(self.serialize_preimage(i)))
+            pre_hash = Hash(self._serialize_preimage_bytes(i, use_cache=True))
             sig_bytes = bfh(sig)
             added = False
             reason = []
@@ -495,6 +524,7 @@ class Transaction:
                 resn = ', '.join(reversed(reason)) if reason else ''
                 print_error("failed to add signature {} for any pubkey for reason(s): '{}' ; pubkey(s) / sig / pre_hash = ".format(i, resn),
                             pubkeys, '/', sig, '/', bh2u(pre_hash))
+        self.invalidate_common_sighash_cache()
         # redo raw
         self.raw = self.serialize()
 
@@ -516,6 +546,7 @@ class Transaction:
         if self._inputs is not None:
             return
         d = deserialize(self.raw)
+        self.invalidate_common_sighash_cache()
         self._inputs = d['inputs']
         self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
         assert all(isinstance(output[1], (PublicKey, Address, ScriptOutput))
@@ -641,36 +672,49 @@ class Transaction:
         else:
             raise RuntimeError('Unknown txin type', _type)
 
+    @staticmethod
+    def _serialize_outpoint_bytes(txin):
+        return bytes.fromhex(txin['prevout_hash'])[::-1] + _uint32.pack(txin['prevout_n'])
+
     @classmethod
     def serialize_outpoint(self, txin):
-        return bh2u(bfh(txin['prevout_hash'])[::-1]) + int_to_hex(txin['prevout_n'], 4)
+        return self._serialize_outpoint_bytes(txin).hex()
 
     @classmethod
-    def serialize_input(self, txin, script, estimate_size=False):
-        # Prev hash and index
-        s = self.serialize_outpoint(txin)
-        # Script length, script, sequence
-        s += var_int(len(script)//2)
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
+    def _serialize_input_bytes(self, txin, script, estimate_size=False):
+        ''' Like serialize_input, but takes and returns bytes. '''
+        parts = [
+            # Prev hash and index
+            self._serialize_outpoint_bytes(txin),
+            # Script length, script, sequence
+            compact_size(len(script)),
+            script,
+            _uint32.pack(txin.get('sequence', 0xffffffff - 1)),
+        ]
         # offline signing needs to know the input value
         if ('value' in txin   # Legacy txs
             and not (estimate_size or self.is_txin_complete(txin))):
-            s += int_to_hex(txin['value'], 8)
-        return s
+            parts.append(_uint64.pack(txin['value']))
+        return b''.join(parts)
+
+    @classmethod
+    def serialize_input(self, txin, script, estimate_size=False):
+        return self._serialize_input_bytes(txin, bfh(script), estimate_size).hex()
 
     def BIP_LI01_sort(self):
         # See https://github.com/kristovatlas/rfc/blob/master/bips/bip-li01.mediawiki
         self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
         self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[1])))
+        self.invalidate_common_sighash_cache()
 
-    def serialize_output(self, output):
+    @staticmethod
+    def _serialize_output_bytes(output):
         output_type, addr, amount = output
-        s = int_to_hex(amount, 8)
-        script = self.pay_script(addr)
-        s += var_int(len(script)//2)
-        s += script
-        return s
+        script = addr.to_script()
+        return _int64.pack(amount) + compact_size(len(script)) + script
+
+    def serialize_output(self, output):
+        return self._serialize_output_bytes(output).hex()
 
     @classmethod
     def nHashType(cls):
@@ -678,39 +722,85 @@ class Transaction:
         warnings.warn("warning: deprecated tx.nHashType()", FutureWarning, stacklevel=2)
         return 0x01 | (cls.SIGHASH_FORKID + (cls.FORKID << 8))
 
-    def serialize_preimage(self, i, nHashType=0x00000041):
+    def invalidate_common_sighash_cache(self):
+        ''' Call this to invalidate the cached common sighash (computed by
+        `_calc_common_sighash` below).
+
+        The signing methods of this class call it themselves when they start
+        and finish; callers that pass use_cache=True to serialize_preimage
+        and then modify the inputs or outputs directly should call it too. '''
+        self._cached_sighash_tup = None
+
+    def _calc_common_sighash(self, use_cache=False):
+        ''' Returns the (hashPrevouts, hashSequence, hashOutputs) triple of
+        the BIP143-style sighash, which is the same for every input.  These
+        are O(N) to compute, so signing N inputs without caching them is
+        O(N^2).
+
+        With use_cache=True the result is kept until the inputs or outputs
+        are changed through this class (add_inputs, add_outputs,
+        BIP_LI01_sort, update, deserialize) or a signing method returns.
+        Callers that mutate self._inputs / self._outputs directly must either
+        not use the cache or call invalidate_common_sighash_cache(). '''
+        if use_cache and self._cached_sighash_tup is not None:
+            return self._cached_sighash_tup
+        inputs = self.inputs()
+        outputs = self.outputs()
+        hashPrevouts = Hash(b''.join(self._serialize_outpoint_bytes(txin) for txin in inputs))
+        hashSequence = Hash(b''.join(_uint32.pack(txin.get('sequence', 0xffffffff - 1))
+                                     for txin in inputs))
+        hashOutputs = Hash(b''.join(self._serialize_output_bytes(o) for o in outputs))
+        tup = hashPrevouts, hashSequence, hashOutputs
+        if use_cache:
+            self._cached_sighash_tup = tup
+        return tup
+
+    def _serialize_preimage_bytes(self, i, nHashType=0x00000041, use_cache=False):
         if (nHashType & 0xff) != 0x41:
             raise ValueError("other hashtypes not supported; submit a PR to fix this!")
 
-        nVersion = int_to_hex(self.version, 4)
-        nHashType = int_to_hex(nHashType, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
-        inputs = self.inputs()
-        outputs = self.outputs()
-        txin = inputs[i]
-
-        hashPrevouts = bh2u(Hash(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))
-        hashSequence = bh2u(Hash(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))
-        hashOutputs = bh2u(Hash(bfh(''.join(self.serialize_output(o) for o in outputs))))
-        outpoint = self.serialize_outpoint(txin)
-        preimage_script = self.get_preimage_script(txin)
-        scriptCode = var_int(len(preimage_script) // 2) + preimage_script
+        txin = self.inputs()[i]
+        hashPrevouts, hashSequence, hashOutputs = self._calc_common_sighash(use_cache)
+        preimage_script = bfh(self.get_preimage_script(txin))
         try:
-            amount = int_to_hex(txin['value'], 8)
+            amount = txin['value']
         except KeyError:
             raise InputValueMissing
-        nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-        preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
-        return preimage
+        nSequence = txin.get('sequence', 0xffffffff - 1)
+        return b''.join((
+            _int32.pack(self.version),
+            hashPrevouts,
+            hashSequence,
+            self._serialize_outpoint_bytes(txin),
+            compact_size(len(preimage_script)),
+            preimage_script,
+            _int64.pack(amount),
+            _uint32.pack(nSequence),
+            hashOutputs,
+            _uint32.pack(self.locktime),
+            _uint32.pack(nHashType),
+        ))
+
+    def serialize_preimage(self, i, nHashType=0x00000041, use_cache=False):
+        ''' Returns the hex preimage that input i's signature commits to.
+        See _calc_common_sighash regarding use_cache. '''
+        return self._serialize_preimage_bytes(i, nHashType, use_cache).hex()
+
+    def serialize_bytes(self, estimate_size=False):
+        ''' The serialized transaction as bytes; serialize() is its hex. '''
+        inputs = self.inputs()  # deserializes, which sets version & locktime
+        outputs = self.outputs()
+        parts = [_int32.pack(self.version), compact_size(len(inputs))]
+        for txin in inputs:
+            script = bfh(self.input_script(txin, estimate_size, self._sign_schnorr))
+            parts.append(self._serialize_input_bytes(txin, script, estimate_size))
+        parts.append(compact_size(len(outputs)))
+        parts.extend(self._serialize_output_bytes(o) for o in outputs)
+        parts.append(_uint32.pack(self.locktime))
+        return b''.join(parts)
 
     def serialize(self, estimate_size=False):
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
-        inputs = self.inputs()
-        outputs = self.outputs()
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.input_script(txin, estimate_size, self._sign_schnorr), estimate_size) for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-        return nVersion + txins + txouts + nLocktime
+        return self.serialize_bytes(estimate_size).hex()
 
     def hash(self):
         warnings.warn("warning: deprecated tx.hash()", FutureWarning, stacklevel=2)
@@ -719,8 +809,7 @@ class Transaction:
     def txid(self):
         if not self.is_complete():
             return None
-        ser = self.serialize()
-        return self._txid(ser)
+        return Hash(self.serialize_bytes())[::-1].hex()
 
     def txid_fast(self):
         ''' Returns the txid by immediately calculating it from self.raw,
@@ -741,12 +830,14 @@ class Transaction:
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
         self.raw = None
+        self.invalidate_common_sighash_cache()
 
     def add_outputs(self, outputs):
         assert all(isinstance(output[1], (PublicKey, Address, ScriptOutput))
                    for output in outputs)
         self._outputs.extend(outputs)
         self.raw = None
+        self.invalidate_common_sighash_cache()
 
     def input_value(self):
         return sum(x['value'] for x in (self.fetched_inputs() or self.inputs()))
@@ -760,14 +851,25 @@ class Transaction:
     @profiler
     def estimated_size(self):
         '''Return an estimated tx size in bytes.'''
-        return (len(self.serialize(True)) // 2 if not self.is_complete() or self.raw is None
+        return (len(self.serialize_bytes(True)) if not self.is_complete() or self.raw is None
                 else len(self.raw) // 2)  # ASCII hex string
 
     @classmethod
     def estimated_input_size(self, txin, sign_schnorr=False):
         '''Return an estimated of serialized input size in bytes.'''
-        script = self.input_script(txin, True, sign_schnorr=sign_schnorr)
-        return len(self.serialize_input(txin, script, True)) // 2  # ASCII hex string
+        script = bfh(self.input_script(txin, True, sign_schnorr=sign_schnorr))
+        return len(self._serialize_input_bytes(txin, script, True))
+
+    @classmethod
+    def estimated_input_size_key(cls, txin, sign_schnorr=False):
+        '''Return a key such that inputs with equal keys have the same
+        estimated_input_size(), or None for inputs whose size depends on their
+        own script.'''
+        if txin['type'] not in ('p2pkh', 'p2pk', 'p2sh'):
+            return None
+        return (txin['type'], txin.get('num_sig', 1),
+                len(txin.get('x_pubkeys', [None])),
+                cls.estimate_pubkey_size_for_txin(txin), bool(sign_schnorr))
 
     def signature_count(self):
         r = 0
@@ -839,7 +941,37 @@ class Transaction:
         return sig
 
 
+    @classmethod
+    def _sign_hash(cls, sec, compressed, pre_hash, sign_schnorr):
+        ''' Signs pre_hash and checks the result. Returns
+        (pubkey, sig or None, reason). '''
+        if not sign_schnorr and ecc_fast.is_using_fast_ecc():
+            # all in libsecp256k1, which lets other signing threads run
+            pubkey, sig = ecc_fast.sign_digest(sec, pre_hash, compressed)
+            reason = [] if sig else ['libsecp256k1 could not verify its signature']
+            return bh2u(pubkey), sig, reason
+        pubkey = public_key_from_private_key(sec, compressed)
+        if sign_schnorr:
+            sig = cls._schnorr_sign(pubkey, sec, pre_hash)
+        else:
+            sig = cls._ecdsa_sign(sec, pre_hash)
+        reason = []
+        if not cls.verify_signature(bfh(pubkey), sig, pre_hash, reason=reason):
+            sig = None
+        return pubkey, sig, reason
+
     def sign(self, keypairs):
+        # the common sighash is cached for the duration of this call only
+        self.invalidate_common_sighash_cache()
+        if self._sign_workers > 1:
+            self._sign_parallel(keypairs)
+        else:
+            self._sign_serial(keypairs)
+        self.invalidate_common_sighash_cache()
+        print_error("is_complete", self.is_complete())
+        self.raw = self.serialize()
+
+    def _sign_serial(self, keypairs):
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             for j, (pubkey, x_pubkey) in enumerate(zip(pubkeys, x_pubkeys)):
@@ -857,21 +989,17 @@ class Transaction:
                 print_error(f"adding signature for input#{i} sig#{j}; {kname}: {_pubkey} schnorr: {self._sign_schnorr}")
                 sec, compressed = keypairs.get(_pubkey)
                 self._sign_txin(i, j, sec, compressed)
-        print_error("is_complete", self.is_complete())
-        self.raw = self.serialize()
 
     def _sign_txin(self, i, j, sec, compressed):
         '''Note: precondition is self._inputs is valid (ie: tx is already deserialized)'''
-        pubkey = public_key_from_private_key(sec, compressed)
         # add signature
         nHashType = 0x00000041 # hardcoded, perhaps should be taken from unsigned input dict
-        pre_hash = Hash(bfh(self.serialize_preimage(i, nHashType)))
-        if self._sign_schnorr:
-            sig = self._schnorr_sign(pubkey, sec, pre_hash)
-        else:
-            sig = self._ecdsa_sign(sec, pre_hash)
-        reason = []
-        if not self.verify_signature(bfh(pubkey), sig, pre_hash, reason=reason):
+        pre_hash = Hash(self._serialize_preimage_bytes(i, nHashType, use_cache=True))
+        pubkey, sig, reason = self._sign_hash(sec, compressed, pre_hash, self._sign_schnorr)
+        return self._add_txin_sig(i, j, pubkey, sig, reason, nHashType)
+
+    def _add_txin_sig(self, i, j, pubkey, sig, reason, nHashType=0x00000041):
+        if sig is None:
             print_error(f"Signature verification failed for input#{i} sig#{j}, reason: {str(reason)}")
             return None
         txin = self._inputs[i]
@@ -879,6 +1007,39 @@ class Transaction:
         txin['pubkeys'][j] = pubkey # needed for fd keys
         return txin
 
+    def _sign_parallel(self, keypairs):
+        ''' sign() for set_sign_workers(n > 1). Works out up front which
+        (input, key) pairs the serial loop would sign, hashes their preimages
+        here, and has a thread pool do the signing and checking.  Threads,
+        not processes, so that private keys never leave this process and
+        nothing is forked from the daemon or the GUI.  The threads only run
+        in parallel while in libsecp256k1: ECDSA with it (see
+        ecc_fast.sign_digest), or Schnorr with its Schnorr module. '''
+        jobs = []
+        for i, txin in enumerate(self.inputs()):
+            if self.is_txin_complete(txin):
+                continue
+            pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            have = len(list(filter(None, txin['signatures'])))
+            for j, (pubkey, x_pubkey) in enumerate(zip(pubkeys, x_pubkeys)):
+                if have >= txin.get('num_sig', 1):
+                    break
+                key = pubkey if pubkey in keypairs else x_pubkey if x_pubkey in keypairs else None
+                if key is None:
+                    continue
+                if not txin['signatures'][j]:
+                    have += 1
+                sec, compressed = keypairs[key]
+                pre_hash = Hash(self._serialize_preimage_bytes(i, use_cache=True))
+                jobs.append((i, j, sec, compressed, pre_hash, self._sign_schnorr))
+        print_error(f"signing {len(jobs)} inputs with {self._sign_workers} threads, schnorr: {self._sign_schnorr}")
+        if not jobs:
+            return
+        with ThreadPoolExecutor(max_workers=self._sign_workers) as pool:
+            results = list(pool.map(lambda job: self._sign_hash(*job[2:]), jobs))
+        for (i, j, *_), (pubkey, sig, reason) in zip(jobs, results):
+            self._add_txin_sig(i, j, pubkey, sig, reason)
+
     def get_outputs(self):
         """convert pubkeys to addresses"""
         o = []
@@ -694,13 +694,18 @@ class SocketPipe(PrintError):
         ''' Raised by get() if max_message_bytes is set and the message size
         limit was exceeded. '''
 
+    # read size per recv() call; large responses arrive in few calls
+    recv_size = 65536
+
     def __init__(self, socket, *, max_message_bytes=0):
         ''' A max_message_bytes of <= 0 means unlimited, otherwise a positive
         value indicates this many bytes to limit the message size by. This is
         used by get(), which will raise MessageSizeExceeded if the message size
         received is larger than max_message_bytes. '''
         self.socket = socket
-        self.message = b''
+        self.message = bytearray()
+        # self.message[:self._scan_pos] is known to contain no newline
+        self._scan_pos = 0
         self.set_timeout(0.1)
         self.recv_time = time.time()
         self.max_message_bytes = max_message_bytes
@@ -713,15 +718,35 @@ class SocketPipe(PrintError):
 
     def clean_up(self):
         ''' Clears the receive buffer to make sure no garbage data remains '''
-        self.message = b''
+        self.message = bytearray()
+        self._scan_pos = 0
+
+    def _pop_message(self):
+        ''' Returns the next complete newline-delimited JSON message in the
+        receive buffer, or None. Lines that are not valid JSON are dropped.
+        Only bytes that arrived since the last call are scanned. '''
+        while True:
+            n = self.message.find(b'\n', self._scan_pos)
+            if n == -1:
+                self._scan_pos = len(self.message)
+                return None
+            line = self.message[:n]
+            # deleting from the front of a bytearray does not move the rest
+            del self.message[:n+1]
+            self._scan_pos = 0
+            try:
+                # decoding first spares json the encoding detection
+                return json.loads(line.decode('utf8'))
+            except ValueError:
+                pass
 
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
+            response = self._pop_message()
             if response is not None:
                 return response
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(self.recv_size)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -758,6 +783,7 @@ class SocketPipe(PrintError):
         self._send(out)
 
     def _send(self, out):
+        out = memoryview(out)
         while out:
             sent = self.socket.send(out)
             out = out[sent:]
@@ -82,6 +82,15 @@ class SPVDelegate(ABC):
     def diagnostic_name(self):
         ''' Make sure delegate classes have this method (PrintError interface). '''
 
+    def get_spv_proof(self, tx_hash : str) -> tuple:
+        ''' Optional. Return the (tx_height: int, pos: int, merkle_root: str)
+        of an earlier successful verification of tx_hash, or None.
+
+        If the header at tx_height still has that merkle root the verifier
+        re-verifies the tx locally, without asking the server for its merkle
+        branch again (eg after switching back to a chain). '''
+        return None
+
 class SPV(ThreadJob):
     """ Simple Payment Verification """
 
@@ -136,7 +145,13 @@ class SPV(ThreadJob):
 
         local_height = self.network.get_local_height()
         unverified = self.wallet.get_unverified_txs()
-        for tx_hash, tx_height in unverified.items():
+        # Keep as many merkle requests in flight as the interface lets
+        # through promptly, so verifying a big wallet is not paced by RTT
+        max_qlen = max(10, getattr(interface, 'window', 10))
+        # Go through the txs by height so each header is read (and each
+        # missing chunk requested) just once per block
+        last_height, header, chunks, n_local = None, None, set(), 0
+        for tx_hash, tx_height in sorted(unverified.items(), key=lambda x: x[1]):
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
                 continue
@@ -145,19 +160,32 @@ class SPV(ThreadJob):
                 continue
 
             # if it's in the checkpoint region, we still might not have the header
-            header = blockchain.read_header(tx_height)
+            if tx_height != last_height:
+                last_height = tx_height
+                header = blockchain.read_header(tx_height)
             if header is None:
                 if tx_height <= networks.net.VERIFICATION_BLOCK_HEIGHT:
                     # Per-header requests might be a lot heavier.
                     # Also, they're not supported as header requests are
                     # currently designed for catching up post-checkpoint headers.
                     index = tx_height // 2016
-                    if self.network.request_chunk(interface, index):
+                    if index not in chunks and self.network.request_chunk(interface, index):
                         interface.print_error("verifier requesting chunk {} for height {}".format(index, tx_height))
+                    chunks.add(index)
+                continue
+            # a proof we kept from before that still matches this chain
+            # needs no round trip
+            proof = self.wallet.get_spv_proof(tx_hash)
+            if proof and proof[0] == tx_height and proof[2] == header.get('merkle_root'):
+                self.merkle_roots[tx_hash] = proof[2]
+                self.print_error("verified from stored proof", tx_hash)
+                self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), proof[1]), header)
+                n_local += 1
                 continue
             # enqueue request
             msg_id = self.network.get_merkle_for_transaction(tx_hash, tx_height,
-                                                             self.verify_merkle)
+                                                             self.verify_merkle,
+                                                             max_qlen=max_qlen)
             self.qbusy = msg_id is None
             if self.qbusy:
                 # interface queue busy, will try again later
@@ -165,6 +193,10 @@ class SPV(ThreadJob):
             self.print_error('requested merkle', tx_hash)
             self.requested_merkle.add(tx_hash)
 
+        if n_local and self.is_up_to_date() and self.wallet.is_up_to_date() and not self.qbusy:
+            self.wallet.save_verified_tx(write=True)
+            self.network.trigger_callback('wallet_updated', self.wallet)
+
         if self.network.blockchain() != self.blockchain:
             self.blockchain = self.network.blockchain()
             self.undo_verifications()
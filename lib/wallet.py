@@ -29,13 +29,16 @@
 
 
 import os
+import bisect
 import threading
 import random
 import time
 import json
 import copy
 import errno
-from collections import defaultdict
+import itertools
+from collections import defaultdict, OrderedDict
+from collections.abc import MutableMapping, Sequence
 from decimal import Decimal as PyDecimal  # Qt 5.12 also exports Decimal
 from functools import partial
 
@@ -163,6 +166,250 @@ def sweep(privkeys, network, config, recipient, fee=None, imax=100, sign_schnorr
     return tx
 
 
+class TxStore(MutableMapping):
+    ''' The dict-like tx_hash -> Transaction mapping used for
+    Abstract_Wallet.transactions.
+
+    Only the raw (hex) transactions are stored. Transaction instances are
+    created on access, and the `maxlen' most recently used ones are kept in an
+    LRU so that repeated access to hot tx's is cheap and keeps their
+    deserialized state, while the memory used by deserialized tx's stays
+    bounded no matter how many tx's the wallet has. Callers should not rely on
+    getting back the same Transaction instance across calls. '''
+
+    def __init__(self, raw_txs=None, *, maxlen=10000):
+        assert maxlen > 0
+        self.maxlen = maxlen
+        self._raw = dict(raw_txs) if raw_txs else {}
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()  # the LRU is reordered on reads
+
+    def _lru_put(self, tx_hash, tx):
+        self._lru[tx_hash] = tx
+        self._lru.move_to_end(tx_hash)
+        while len(self._lru) > self.maxlen:
+            self._lru.popitem(last=False)
+
+    def __getitem__(self, tx_hash):
+        with self._lock:
+            tx = self._lru.get(tx_hash)
+            if tx is not None:
+                self._lru.move_to_end(tx_hash)
+                return tx
+            tx = Transaction(self._raw[tx_hash])
+            self._lru_put(tx_hash, tx)
+            return tx
+
+    def __setitem__(self, tx_hash, tx):
+        with self._lock:
+            self._raw[tx_hash] = str(tx)
+            self._lru_put(tx_hash, tx)
+
+    def __delitem__(self, tx_hash):
+        with self._lock:
+            del self._raw[tx_hash]
+            self._lru.pop(tx_hash, None)
+
+    _no_default = object()
+
+    def pop(self, tx_hash, default=_no_default):
+        ''' Reimplemented to not needlessly create a Transaction. '''
+        with self._lock:
+            tx = self._lru.pop(tx_hash, None)
+            raw = self._raw.pop(tx_hash, None)
+        if raw is None:
+            if default is self._no_default:
+                raise KeyError(tx_hash)
+            return default
+        return tx or Transaction(raw)
+
+    def clear(self):
+        with self._lock:
+            self._raw.clear()
+            self._lru.clear()
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def get_raw(self, tx_hash):
+        ''' Returns the raw hex of tx_hash (or None), without creating a
+        Transaction. '''
+        return self._raw.get(tx_hash)
+
+    def raw_dict(self):
+        ''' Returns a shallow copy of the tx_hash -> raw hex dict, suitable for
+        saving to storage. '''
+        with self._lock:
+            return self._raw.copy()
+
+
+class HistoryView(Sequence):
+    ''' What Abstract_Wallet.get_history() returns: a read-only snapshot of
+    a history, as a sequence of
+
+        (tx_hash, height, conf, timestamp, delta, balance)
+
+    tuples. The tuples are made as they are read, the confirmations from the
+    local height at the time of the get_history() call. Slicing returns a
+    list. '''
+
+    __slots__ = ('_rows', '_local_height', '_balance', '_total', '_nones', '_reverse')
+
+    def __init__(self, rows, local_height, balance, reverse=False):
+        self._rows = rows
+        self._local_height = local_height
+        self._balance = balance
+        # the running sums of the newest row, see _HistoryCache
+        self._total, self._nones = rows[-1][5:] if rows else (0, 0)
+        self._reverse = reverse
+
+    def _make_item(self, row):
+        (txpos, tx_hash), height, timestamp, verified, delta, total, nones = row
+        conf = max(self._local_height - height + 1, 0) if verified else 0
+        if nones == self._nones:
+            balance = self._balance - (self._total - total)
+        else:
+            # a newer tx has an unknown delta
+            balance = None
+        return tx_hash, height, conf, timestamp, delta, balance
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        n = len(self._rows)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('history index out of range')
+        return self._make_item(self._rows[n - 1 - i if self._reverse else i])
+
+    def __iter__(self):
+        return map(self._make_item, reversed(self._rows) if self._reverse else self._rows)
+
+    def __reversed__(self):
+        return map(self._make_item, self._rows if self._reverse else reversed(self._rows))
+
+
+class _HistoryCache:
+    ''' The history of the addresses in `domain` (a frozenset, or None for
+    the whole wallet), as a list of rows sorted oldest first:
+
+        ((txpos, tx_hash), height, timestamp, verified, delta, total, nones)
+
+    `total` is the sum of the known deltas of the row and all older rows, and
+    `nones` the number of unknown (None) deltas among them. HistoryView works
+    out each running balance from these and the current balance of the
+    domain, which is kept up to date with the deltas.
+
+    Tx's put into `dirty` are taken out and put back in at their bisect
+    position by update(), and only the rows from the oldest change on get new
+    running sums. A new tx at the end of the history therefore costs
+    O(log N). Rows are never changed in place, and the list is copied before
+    it is changed if a HistoryView holds it. '''
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.rows = None  # built on the first update()
+        self.keys = {}  # tx_hash -> (txpos, tx_hash), of the tx's in rows
+        self.dirty = set()
+        self.balance = 0
+        self.shared = False
+
+    def _get_item(self, wallet, tx_hash):
+        ''' Returns the row for tx_hash without the running sums, or None if
+        tx_hash is not in the history of the domain. '''
+        addrs = wallet.tx_addr_hist.get(tx_hash)
+        if addrs and self.domain is not None:
+            addrs = addrs & self.domain
+        if not addrs:
+            return None
+        delta = 0
+        for addr in addrs:
+            d = wallet.get_tx_delta(tx_hash, addr)
+            if d is None:
+                delta = None
+                break
+            delta += d
+        info = wallet.verified_tx.get(tx_hash)
+        if info is not None:
+            height, timestamp = info[0], info[1]
+        else:
+            height, timestamp = wallet.unverified_tx.get(tx_hash, 0), 0
+        return (wallet.get_txpos(tx_hash), tx_hash), height, timestamp, info is not None, delta
+
+    def _get_balance(self, wallet):
+        return sum(wallet.get_balance(None if self.domain is None else list(self.domain)))
+
+    def update(self, wallet):
+        ''' Brings the rows up to date. Caller must hold wallet.lock. '''
+        if self.rows is None:
+            self.dirty.clear()
+            items = (self._get_item(wallet, tx_hash) for tx_hash in list(wallet.tx_addr_hist))
+            self.rows = sorted(item + (0, 0) for item in items if item is not None)
+            self.keys = {row[0][1]: row[0] for row in self.rows}
+            self._update_sums(0)
+            self.balance = self._get_balance(wallet)
+            return
+        if not self.dirty:
+            return
+        if self.shared:
+            self.rows = self.rows[:]
+            self.shared = False
+        rows, keys = self.rows, self.keys
+        first = len(rows)
+        balance_known = True
+        while self.dirty:
+            tx_hash = self.dirty.pop()
+            item = self._get_item(wallet, tx_hash)
+            old_delta = new_delta = 0
+            key = keys.pop(tx_hash, None)
+            if key is not None:
+                i = bisect.bisect_left(rows, (key,))
+                if rows[i][:5] == item:
+                    # unchanged, but an unknown delta may hide a change of
+                    # the balance
+                    keys[tx_hash] = key
+                    if item[4] is None:
+                        balance_known = False
+                    continue
+                old_delta = rows[i][4]
+                del rows[i]
+                first = min(first, i)
+            if item is not None:
+                i = bisect.bisect_left(rows, (item[0],))
+                rows.insert(i, item + (0, 0))
+                keys[tx_hash] = item[0]
+                new_delta = item[4]
+                first = min(first, i)
+            if old_delta is None or new_delta is None:
+                balance_known = False
+            elif balance_known:
+                self.balance += new_delta - old_delta
+        self._update_sums(first)
+        if not balance_known:
+            self.balance = self._get_balance(wallet)
+
+    def _update_sums(self, first):
+        rows = self.rows
+        total, nones = rows[first - 1][5:] if first else (0, 0)
+        for i in range(first, len(rows)):
+            row = rows[i]
+            if row[4] is None:
+                nones += 1
+            else:
+                total += row[4]
+            rows[i] = row[:5] + (total, nones)
+
+
 class Abstract_Wallet(PrintError, SPVDelegate):
     """
     Wallet classes are created to handle various address generation methods.
@@ -197,6 +444,23 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         # Python's GIL makes thread-safe implicitly).
         self._addr_bal_cache = {}
 
+        # Index of the wallet's coins, maintained incrementally as history
+        # and txi/txo change. Maps Address -> (received, sent, utxos), where
+        # received and sent are as get_addr_io returns them and utxos is a
+        # dict of "prevout_hash:n" -> coin dict (sans the dynamic
+        # 'is_frozen_coin' flag). Only addresses that have ever seen a coin
+        # are present. Addresses whose history/txi/txo changed are put into
+        # self._utxo_dirty and their index entries are recomputed (with
+        # self.lock held) on the next query. See _get_addr_utxo_entry.
+        self._utxo_index = {}
+        self._utxo_dirty = set()
+
+        # Caches for get_history(), one per domain asked for; see
+        # _HistoryCache. Tx's whose delta or position in the history may
+        # have changed are flagged with _hist_touch() and are re-inserted
+        # into the caches on the next get_history() call.
+        self.invalidate_history_cache()
+
         # We keep a set of the wallet and receiving addresses so that is_mine()
         # checks are O(logN) rather than O(N). This creates/resets that cache.
         self.invalidate_address_set_cache()
@@ -215,8 +479,16 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         # BOTH levels of freezing.
         self.frozen_coins = set(storage.get('frozen_coins', []))
         # address -> list(txid, height)
-        history = storage.get('addr_history',{})
+        history = storage.get('addr_history', {}, copy=False)
         self._history = self.to_Address_dict(history)
+        # address -> electrum status hash of its history, as last confirmed by
+        # the server (see Synchronizer.get_status). Saved along with the
+        # history; missing entries are computed on demand.
+        addr_status = self.to_Address_dict(storage.get('addr_status', {}, copy=False))
+        self._addr_status = {addr: status for addr, status in addr_status.items()
+                             if self._history.get(addr)}
+        # the utxo index gets (lazily) built for all addresses on first use
+        self._utxo_dirty.update(self._history)
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
@@ -244,6 +516,10 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
         self.verified_tx = storage.get('verified_tx3', {})
+        # Merkle roots the verified txs were proven against.  Each value is a
+        # (height, block_pos, merkle_root) tuple, kept across reorgs so that
+        # the verifier can re-verify locally.  Access with self.lock.
+        self.spv_proofs = storage.get('spv_proofs', {})
 
         # save wallet type the first time
         if self.storage.get('wallet_type') is None:
@@ -291,20 +567,25 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     @profiler
     def load_transactions(self):
-        txi = self.storage.get('txi', {})
+        # These are only read from, to build our own dicts, so they need not be
+        # copied out of storage. The leaf lists end up shared with the
+        # storage, so they are never modified in place: add_transaction and
+        # remove_transaction replace them with new lists.
+        txi = self.storage.get('txi', {}, copy=False)
         self.txi = {tx_hash: self.to_Address_dict(value)
                     for tx_hash, value in txi.items()}
-        txo = self.storage.get('txo', {})
+        self.build_txi_spenders()
+        txo = self.storage.get('txo', {}, copy=False)
         self.txo = {tx_hash: self.to_Address_dict(value)
                     for tx_hash, value in txo.items()}
         self.tx_fees = self.storage.get('tx_fees', {})
         self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+        self.build_pruned_txo_values()
+        tx_list = self.storage.get('transactions', {}, copy=False)
+        # Transaction instances are created lazily on access, see TxStore
+        self.transactions = TxStore(tx_list)
+        for tx_hash in tx_list:
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo_values):
                 self.print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
                 self.cashacct.remove_transaction_hook(tx_hash)
@@ -312,26 +593,26 @@ class Abstract_Wallet(PrintError, SPVDelegate):
     @profiler
     def save_transactions(self, write=False):
         with self.lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
+            # the dicts built here are handed over to the storage, no copies
+            self.storage.put('transactions', self.transactions.raw_dict(), copy=False)
             txi = {tx_hash: self.from_Address_dict(value)
                    for tx_hash, value in self.txi.items()}
             txo = {tx_hash: self.from_Address_dict(value)
                    for tx_hash, value in self.txo.items()}
-            self.storage.put('txi', txi)
-            self.storage.put('txo', txo)
+            self.storage.put('txi', txi, copy=False)
+            self.storage.put('txo', txo, copy=False)
             self.storage.put('tx_fees', self.tx_fees)
             self.storage.put('pruned_txo', self.pruned_txo)
             history = self.from_Address_dict(self._history)
-            self.storage.put('addr_history', history)
+            self.storage.put('addr_history', history, copy=False)
+            self.storage.put('addr_status', self.from_Address_dict(self._addr_status), copy=False)
             if write:
                 self.storage.write()
 
     def save_verified_tx(self, write=False):
         with self.lock:
             self.storage.put('verified_tx3', self.verified_tx)
+            self.storage.put('spv_proofs', self.spv_proofs)
             self.cashacct.save()
             if write:
                 self.storage.write()
@@ -339,15 +620,61 @@ class Abstract_Wallet(PrintError, SPVDelegate):
     def clear_history(self):
         with self.lock:
             self.txi = {}
+            self._txi_spenders = {}
             self.txo = {}
             self.tx_fees = {}
             self.pruned_txo = {}
+            self.pruned_txo_values = {}
             self.save_transactions()
             self._addr_bal_cache = {}
+            self._utxo_index = {}
+            self._utxo_dirty = set()
+            self.invalidate_history_cache()
             self._history = {}
+            self._addr_status = {}
             self.tx_addr_hist = defaultdict(set)
             self.cashacct.on_clear_history()
 
+    def build_txi_spenders(self):
+        ''' Builds self._txi_spenders: a dict of tx_hash -> set of the
+        tx_hashes whose self.txi entries spend outputs of tx_hash. This allows
+        remove_transaction to find the spends of a tx without walking every
+        entry in self.txi. It is kept in sync by add_transaction and
+        remove_transaction. '''
+        self._txi_spenders = {}
+        for tx_hash, d in self.txi.items():
+            for l in d.values():
+                for ser, v in l:
+                    prevout_hash = ser.split(':', 1)[0]
+                    self._txi_spenders.setdefault(prevout_hash, set()).add(tx_hash)
+
+    def build_pruned_txo_values(self):
+        ''' Builds the reverse of self.pruned_txo: a dict of
+        spending tx_hash -> set of pruned "prevout_hash:n" strings, so that
+        `tx_hash in self.pruned_txo_values` is O(1). It is kept in sync by
+        _add_pruned_txo and _pop_pruned_txo. '''
+        self.pruned_txo_values = {}
+        for ser, tx_hash in self.pruned_txo.items():
+            self.pruned_txo_values.setdefault(tx_hash, set()).add(ser)
+
+    def _add_pruned_txo(self, ser, tx_hash):
+        ''' Caller must hold self.lock. '''
+        self._pop_pruned_txo(ser)
+        self.pruned_txo[ser] = tx_hash
+        self.pruned_txo_values.setdefault(tx_hash, set()).add(ser)
+
+    def _pop_pruned_txo(self, ser):
+        ''' Removes ser from self.pruned_txo, returning the tx_hash of the tx
+        that spends it (or None). Caller must hold self.lock. '''
+        tx_hash = self.pruned_txo.pop(ser, None)
+        if tx_hash is not None:
+            sers = self.pruned_txo_values.get(tx_hash)
+            if sers is not None:
+                sers.discard(ser)
+                if not sers:
+                    self.pruned_txo_values.pop(tx_hash)
+        return tx_hash
+
     @profiler
     def build_reverse_history(self):
         self.tx_addr_hist = defaultdict(set)
@@ -362,13 +689,14 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
         for addr in set(self._history) - set(my_addrs):
             self._history.pop(addr)
+            self._addr_status.pop(addr, None)
             save = True
 
         for addr in my_addrs:
             hist = self._history[addr]
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in self.pruned_txo_values or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
@@ -419,26 +747,33 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     def set_label(self, name, text = None):
         with self.lock:
-            if isinstance(name, Address):
-                name = name.to_storage_string()
-            changed = False
-            old_text = self.labels.get(name)
-            if text:
-                text = text.replace("\n", " ")
-                if old_text != text:
-                    self.labels[name] = text
-                    changed = True
-            else:
-                if old_text:
-                    self.labels.pop(name)
-                    changed = True
-
+            changed = self._set_label(name, text)
             if changed:
-                run_hook('set_label', self, name, text)
                 self.storage.put('labels', self.labels)
-
             return changed
 
+    def _set_label(self, name, text):
+        ''' set_label() without saving the labels, for callers that set many
+        at once. Call with self.lock held. '''
+        if isinstance(name, Address):
+            name = name.to_storage_string()
+        changed = False
+        old_text = self.labels.get(name)
+        if text:
+            text = text.replace("\n", " ")
+            if old_text != text:
+                self.labels[name] = text
+                changed = True
+        else:
+            if old_text:
+                self.labels.pop(name)
+                changed = True
+
+        if changed:
+            run_hook('set_label', self, name, text)
+
+        return changed
+
     def invalidate_address_set_cache(self):
         ''' This should be called from functions that add/remove addresses
         from the wallet to ensure the address set caches are empty, in
@@ -448,6 +783,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         address sets only grow and never shrink and thus the length check
         of is_mine below is sufficient.'''
         self._recv_address_set_cached, self._change_address_set_cached = frozenset(), frozenset()
+        self._address_index_cached = {}
 
     def is_mine(self, address):
         ''' Note this method assumes that the entire address set is
@@ -484,14 +820,17 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         return address in self._change_address_set_cached
 
     def get_address_index(self, address):
-        try:
-            return False, self.receiving_addresses.index(address)
-        except ValueError:
-            pass
-        try:
-            return True, self.change_addresses.index(address)
-        except ValueError:
-            pass
+        ra, ca = self.receiving_addresses, self.change_addresses
+        # Same length-check scheme as the is_mine() sets: the address -> index
+        # map is rebuilt if the lists grew or shrank behind our back.
+        # create_new_addresses() keeps it up to date incrementally.
+        if len(self._address_index_cached) != len(ra) + len(ca):
+            d = {addr: (True, i) for i, addr in enumerate(ca)}
+            d.update((addr, (False, i)) for i, addr in enumerate(ra))
+            self._address_index_cached = d
+        index = self._address_index_cached.get(address)
+        if index is not None:
+            return index
         assert not isinstance(address, str)
         raise Exception("Address {} not found".format(address))
 
@@ -516,6 +855,8 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
             # tx will be verified only if height > 0
             if tx_hash not in self.verified_tx:
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self._hist_touch((tx_hash,))
                 self.unverified_tx[tx_hash] = tx_height
                 self.cashacct.add_unverified_tx_hook(tx_hash, tx_height)
 
@@ -524,6 +865,9 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            if header:
+                self.spv_proofs[tx_hash] = (info[0], info[2], header.get('merkle_root'))
+            self._hist_touch((tx_hash,))
             height, conf, timestamp = self.get_tx_height(tx_hash)
             self.cashacct.add_verified_tx_hook(tx_hash, info, header)
         self.network.trigger_callback('verified2', self, tx_hash, height, conf, timestamp)
@@ -538,6 +882,10 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         with self.lock:
             return self.unverified_tx.copy()
 
+    def get_spv_proof(self, tx_hash):
+        with self.lock:
+            return self.spv_proofs.get(tx_hash)
+
     def get_unverified_tx_pending_count(self):
         ''' Returns the number of unverified tx's that are confirmed and are
         still in process and should be verified soon.'''
@@ -552,13 +900,22 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 tx_height, timestamp, pos = item
                 if tx_height >= height:
                     header = blockchain.read_header(tx_height)
-                    # fixme: use block hash, not timestamp
-                    if not header or header.get('timestamp') != timestamp:
+                    proof = self.spv_proofs.get(tx_hash)
+                    if proof:
+                        # the proof stays around in case we come back to
+                        # a chain with this block
+                        ok = header and header.get('merkle_root') == proof[2]
+                    else:
+                        ok = header and header.get('timestamp') == timestamp
+                    if not ok:
                         self.verified_tx.pop(tx_hash, None)
                         txs.add(tx_hash)
+            self._hist_touch(txs)
             if txs: self.cashacct.undo_verifications_hook(txs)
         if txs:
             self._addr_bal_cache = {}  # this is probably not necessary -- as the receive_history_callback will invalidate bad cache items -- but just to be paranoid we clear the whole balance cache on reorg anyway as a safety measure
+            if self.network:
+                self.network.trigger_callback('verifications_undone', self, txs)
         return txs
 
     def get_local_height(self):
@@ -620,7 +977,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         assert isinstance(address, Address)
         "effect of tx on address"
         # pruned
-        if tx_hash in self.pruned_txo.values():
+        if tx_hash in self.pruned_txo_values:
             return None
         delta = 0
         # substract the value of coins sent from address
@@ -733,7 +1090,11 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
         return tx_hash, status, label, can_broadcast, amount, fee, height, conf, timestamp, exp_n
 
-    def get_addr_io(self, address):
+    _empty_utxo_entry = ({}, {}, {})
+
+    def _build_addr_utxo_entry(self, address):
+        ''' Computes the (received, sent, utxos) utxo index entry for address
+        by walking its history. Caller must hold self.lock. '''
         h = self.get_address_history(address)
         received = {}
         sent = {}
@@ -745,33 +1106,59 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             l = self.txi.get(tx_hash, {}).get(address, [])
             for txi, v in l:
                 sent[txi] = height
-        return received, sent
-
-    def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-            # cleanup/detect if the 'frozen coin' was spent and remove it from the frozen coin set
-            self.frozen_coins.discard(txi)
-        out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
+        utxos = {}
+        for txo, (tx_height, value, is_cb) in received.items():
+            if txo in sent:
+                # cleanup/detect if the 'frozen coin' was spent and remove it from the frozen coin set
+                self.frozen_coins.discard(txo)
+                continue
             prevout_hash, prevout_n = txo.split(':')
-            x = {
+            utxos[txo] = {
                 'address':address,
                 'value':value,
                 'prevout_n':int(prevout_n),
                 'prevout_hash':prevout_hash,
                 'height':tx_height,
                 'coinbase':is_cb,
-                'is_frozen_coin':txo in self.frozen_coins
             }
-            out[txo] = x
-        return out
+        return received, sent, utxos
+
+    def _update_utxo_index(self):
+        ''' Recomputes the utxo index entries of all the addresses that were
+        flagged as dirty since the last call. '''
+        with self.lock:
+            while self._utxo_dirty:
+                addr = self._utxo_dirty.pop()
+                received, sent, utxos = entry = self._build_addr_utxo_entry(addr)
+                if received or sent:
+                    self._utxo_index[addr] = entry
+                else:
+                    self._utxo_index.pop(addr, None)
+
+    def _get_addr_utxo_entry(self, address):
+        if self._utxo_dirty:
+            self._update_utxo_index()
+        return self._utxo_index.get(address, self._empty_utxo_entry)
+
+    def get_addr_io(self, address):
+        ''' Returns copies of the (received, sent) dicts for address from the
+        utxo index, so that callers may modify them. '''
+        received, sent, utxos = self._get_addr_utxo_entry(address)
+        return dict(received), dict(sent)
+
+    def _make_utxo(self, txo, coin):
+        x = coin.copy()
+        x['is_frozen_coin'] = txo in self.frozen_coins
+        return x
+
+    def get_addr_utxo(self, address):
+        received, sent, utxos = self._get_addr_utxo_entry(address)
+        return {txo: self._make_utxo(txo, coin)
+                for txo, coin in utxos.items()}
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
+        received, sent, utxos = self._get_addr_utxo_entry(address)
         return sum([v for height, v, is_cb in received.values()])
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
@@ -782,7 +1169,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             cached = self._addr_bal_cache.get(address)
             if cached is not None:
                 return cached
-        received, sent = self.get_addr_io(address)
+        received, sent, utxos = self._get_addr_utxo_entry(address)
         c = u = x = 0
         had_cb = False
         for txo, (tx_height, v, is_cb) in received.items():
@@ -851,22 +1238,27 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         Optional kw-only arg `addr_set_out` specifies a set in which to add all
         addresses encountered in the utxos returned. '''
         with self.lock:
+            self._update_utxo_index()
             coins = []
             if domain is None:
-                domain = self.get_addresses()
+                # Only addresses that have ever seen a coin are in the index,
+                # so there is no need to look at the (possibly huge) rest.
+                domain = [addr for addr in self._utxo_index if self.is_mine(addr)]
             if exclude_frozen:
                 domain = set(domain) - self.frozen_addresses
+            local_height = self.get_local_height() if mature else 0
+            frozen_coins = self.frozen_coins
             for addr in domain:
-                utxos = self.get_addr_utxo(addr)
+                utxos = self._utxo_index.get(addr, self._empty_utxo_entry)[2]
                 len_before = len(coins)
-                for x in utxos.values():
-                    if exclude_frozen and x['is_frozen_coin']:
+                for txo, coin in utxos.items():
+                    if exclude_frozen and txo in frozen_coins:
                         continue
-                    if confirmed_only and x['height'] <= 0:
+                    if confirmed_only and coin['height'] <= 0:
                         continue
-                    if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                    if mature and coin['coinbase'] and coin['height'] + COINBASE_MATURITY > local_height:
                         continue
-                    coins.append(x)
+                    coins.append(self._make_utxo(txo, coin))
                 if addr_set_out is not None and len(coins) > len_before:
                     # add this address to the address set if it has results
                     addr_set_out.add(addr)
@@ -893,7 +1285,11 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     def get_balance(self, domain=None, exclude_frozen_coins=False, exclude_frozen_addresses=False):
         if domain is None:
-            domain = self.get_addresses()
+            # Addresses absent from the utxo index have a zero balance, so
+            # we only need to look at the ones in it.
+            with self.lock:
+                self._update_utxo_index()
+                domain = [addr for addr in self._utxo_index if self.is_mine(addr)]
         if exclude_frozen_addresses:
             domain = set(domain) - self.frozen_addresses
         cc = uu = xx = 0
@@ -908,6 +1304,18 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         assert isinstance(address, Address)
         return self._history.get(address, [])
 
+    def get_address_status(self, address):
+        ''' Returns the electrum status hash of the address's history (None
+        if it has none), without rehashing the history when it is known. '''
+        assert isinstance(address, Address)
+        with self.lock:
+            status = self._addr_status.get(address)
+            if status is None:
+                status = Synchronizer.get_status(self.get_address_history(address))
+                if status is not None:
+                    self._addr_status[address] = status
+            return status
+
     def add_transaction(self, tx_hash, tx):
         if not tx.inputs():
             # bad tx came in off the wire -- all 0's or something, see #987
@@ -915,6 +1323,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             return
         is_coinbase = tx.inputs()[0]['type'] == 'coinbase'
         with self.lock:
+            self._hist_touch((tx_hash,))
             # add inputs
             self.txi[tx_hash] = d = {}
             for txi in tx.inputs():
@@ -931,10 +1340,12 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                             if d.get(addr) is None:
                                 d[addr] = []
                             d[addr].append((ser, v))
+                            self._txi_spenders.setdefault(prevout_hash, set()).add(tx_hash)
                             break
                     else:
-                        self.pruned_txo[ser] = tx_hash
+                        self._add_pruned_txo(ser, tx_hash)
                     self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                    self._utxo_dirty.add(addr)
 
             # add outputs
             self.txo[tx_hash] = d = {}
@@ -960,14 +1371,17 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                         d[addr] = []
                     d[addr].append((n, v, is_coinbase))
                     self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                    self._utxo_dirty.add(addr)
                 # give v to txi that spends me
-                next_tx = self.pruned_txo.get(ser)
+                next_tx = self._pop_pruned_txo(ser)
                 if next_tx is not None:
-                    self.pruned_txo.pop(ser)
                     dd = self.txi.get(next_tx, {})
-                    if dd.get(addr) is None:
-                        dd[addr] = []
-                    dd[addr].append((ser, v))
+                    # a new list: the old one may be shared with the storage
+                    dd[addr] = dd.get(addr, []) + [(ser, v)]
+                    self._txi_spenders.setdefault(tx_hash, set()).add(next_tx)
+                    self._hist_touch((next_tx,))
+                    self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                    self._utxo_dirty.add(addr)
             # save
             self.transactions[tx_hash] = tx
 
@@ -981,30 +1395,47 @@ class Abstract_Wallet(PrintError, SPVDelegate):
     def remove_transaction(self, tx_hash):
         with self.lock:
             self.print_error("removing tx from history", tx_hash)
+            self._hist_touch((tx_hash,))
             #tx = self.transactions.pop(tx_hash, None)
-            for ser, hh in list(self.pruned_txo.items()):
-                if hh == tx_hash:
-                    self.pruned_txo.pop(ser)
+            for ser in list(self.pruned_txo_values.get(tx_hash, ())):
+                self._pop_pruned_txo(ser)
             # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
+            for next_tx in self._txi_spenders.pop(tx_hash, ()):
+                self._hist_touch((next_tx,))
+                dd = self.txi.get(next_tx, {})
                 for addr, l in list(dd.items()):
-                    ll = l[:]
-                    for item in ll:
+                    # build a new list: l may be shared with the storage
+                    kept = []
+                    for item in l:
                         ser, v = item
                         prev_hash, prev_n = ser.split(':')
                         if prev_hash == tx_hash:
                             self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
-                            l.remove(item)
-                            self.pruned_txo[ser] = next_tx
-                    if l == []:
+                            self._utxo_dirty.add(addr)
+                            self._add_pruned_txo(ser, next_tx)
+                        else:
+                            kept.append(item)
+                    if kept == []:
                         dd.pop(addr)
                     else:
-                        dd[addr] = l
+                        dd[addr] = kept
+            # this tx no longer spends anything
+            for l in self.txi.get(tx_hash, {}).values():
+                for ser, v in l:
+                    prev_hash = ser.split(':', 1)[0]
+                    spenders = self._txi_spenders.get(prev_hash)
+                    if spenders is not None:
+                        spenders.discard(tx_hash)
+                        if not spenders:
+                            self._txi_spenders.pop(prev_hash)
 
             # invalidate addr_bal_cache for outputs involving this tx
+            for addr in self.txi.get(tx_hash, {}):
+                self._utxo_dirty.add(addr)
             d = self.txo.get(tx_hash, {})
             for addr in d:
                 self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                self._utxo_dirty.add(addr)
 
             try: self.txi.pop(tx_hash)
             except KeyError: self.print_error("tx was not in input history", tx_hash)
@@ -1019,9 +1450,15 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         self.add_transaction(tx_hash, tx)
         self.add_unverified_tx(tx_hash, tx_height)
 
-    def receive_history_callback(self, addr, hist, tx_fees):
+    def receive_history_callback(self, addr, hist, tx_fees, status=None):
+        ''' Sets the history of addr. `status` is its status hash, if
+        the caller already knows it. '''
         with self.lock:
             old_hist = self.get_address_history(addr)
+            # the deltas of these change as addr joins or leaves their
+            # history; add_unverified_tx flags the ones whose height changed
+            self._hist_touch({tx_hash for tx_hash, height in old_hist}
+                             ^ {tx_hash for tx_hash, height in hist})
             for tx_hash, height in old_hist:
                 if (tx_hash, height) not in hist:
                     s = self.tx_addr_hist.get(tx_hash)
@@ -1038,7 +1475,12 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                         # and self.txo dicts
                         self.remove_transaction(tx_hash)
             self._addr_bal_cache.pop(addr, None)  # unconditionally invalidate cache entry
+            self._utxo_dirty.add(addr)
             self._history[addr] = hist
+            if status is not None and hist:
+                self._addr_status[addr] = status
+            else:
+                self._addr_status.pop(addr, None)
 
             for tx_hash, tx_height in hist:
                 # add it in case it was previously unconfirmed
@@ -1056,44 +1498,47 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         if self.network:
             self.network.trigger_callback('on_history', self)
 
-    def get_history(self, domain=None, *, reverse=False):
-        # get domain
-        if domain is None:
-            domain = self.get_addresses()
-        # 1. Get the history of each address in the domain, maintain the
-        #    delta of a tx as the sum of its deltas on domain addresses
-        tx_deltas = defaultdict(int)
-        for addr in domain:
-            h = self.get_address_history(addr)
-            for tx_hash, height in h:
-                delta = self.get_tx_delta(tx_hash, addr)
-                if delta is None or tx_deltas[tx_hash] is None:
-                    tx_deltas[tx_hash] = None
-                else:
-                    tx_deltas[tx_hash] += delta
+    # how many get_history() domains besides the whole wallet are cached
+    HISTORY_CACHES = 8
+
+    def invalidate_history_cache(self):
+        ''' Forces the next get_history() calls to rebuild their caches from
+        scratch. '''
+        # domain (None, or a frozenset of addresses) -> _HistoryCache, least
+        # recently used first
+        self._hist_caches = OrderedDict()
+
+    def _hist_touch(self, tx_hashes):
+        ''' Flags tx's whose delta or position in the history may have
+        changed. Caller must hold self.lock. '''
+        caches = list(self._hist_caches.values())
+        if len(caches) == 1:
+            caches[0].dirty.update(tx_hashes)
+        elif caches:
+            tx_hashes = list(tx_hashes)
+            for cache in caches:
+                cache.dirty.update(tx_hashes)
 
-        # 2. create sorted history
-        history = []
-        for tx_hash in tx_deltas:
-            delta = tx_deltas[tx_hash]
-            height, conf, timestamp = self.get_tx_height(tx_hash)
-            history.append((tx_hash, height, conf, timestamp, delta))
-        history.sort(key = lambda x: self.get_txpos(x[0]), reverse=True)
-
-        # 3. add balance
-        c, u, x = self.get_balance(domain)
-        balance = c + u + x
-        h2 = []
-        for tx_hash, height, conf, timestamp, delta in history:
-            h2.append((tx_hash, height, conf, timestamp, delta, balance))
-            if balance is None or delta is None:
-                balance = None
+    def get_history(self, domain=None, *, reverse=False):
+        ''' Returns the history of the addresses in domain, or of the whole
+        wallet if None, as a HistoryView: a read-only sequence of (tx_hash,
+        height, conf, timestamp, delta, balance) tuples, oldest first (or
+        newest first if `reverse`). The histories of the whole wallet and of
+        the last few domains asked for are cached, and the caches are updated
+        incrementally as tx's come in and get verified. '''
+        key = None if domain is None else frozenset(domain)
+        with self.lock:
+            cache = self._hist_caches.get(key)
+            if cache is None:
+                cache = self._hist_caches[key] = _HistoryCache(key)
+                domains = [k for k in self._hist_caches if k is not None]
+                for k in domains[:max(0, len(domains) - self.HISTORY_CACHES)]:
+                    del self._hist_caches[k]
             else:
-                balance -= delta
-        if not reverse:
-            h2.reverse()
-
-        return h2
+                self._hist_caches.move_to_end(key)
+            cache.update(self)
+            cache.shared = True
+            return HistoryView(cache.rows, self.get_local_height(), cache.balance, reverse)
 
     def export_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None,
                        show_addresses=False, decimal_point=8):
@@ -1264,7 +1709,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         if i_max is None:
             # Let the coin chooser select the coins to spend
             max_change = self.max_change_outputs if self.multiple_change else 1
-            coin_chooser = coinchooser.CoinChooserPrivacy()
+            coin_chooser = coinchooser.get_coin_chooser(config)
             tx = coin_chooser.make_tx(inputs, outputs, change_addrs[:max_change],
                                       fee_estimator, self.dust_threshold(), sign_schnorr=sign_schnorr)
         else:
@@ -1370,6 +1815,9 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         # if we are on a pruning server, remove unverified transactions
         with self.lock:
             vr = list(self.verified_tx.keys()) + list(self.unverified_tx.keys())
+            # and proofs of transactions that left the history
+            for tx_hash in set(self.spv_proofs).difference(vr):
+                self.spv_proofs.pop(tx_hash)
         for tx_hash in list(self.transactions):
             if tx_hash not in vr:
                 self.print_error("removing transaction", tx_hash)
@@ -1486,7 +1934,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         if self.is_mine(address):
             txin['type'] = self.get_txin_type(address)
             # Bitcoin Cash needs value to sign
-            received, spent = self.get_addr_io(address)
+            received, spent, utxos = self._get_addr_utxo_entry(address)
             item = received.get(txin['prevout_hash']+':%d'%txin['prevout_n'])
             tx_height, value, is_cb = item
             txin['value'] = value
@@ -1592,7 +2040,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     def get_payment_status(self, address, amount):
         local_height = self.get_local_height()
-        received, sent = self.get_addr_io(address)
+        received, sent, utxos = self._get_addr_utxo_entry(address)
         l = []
         for txo, x in received.items():
             h, v, is_cb = x
@@ -1728,33 +2176,47 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         self.save_payment_requests()
 
     def add_payment_request(self, req, config, set_address_label=True):
-        addr = req['address']
-        addr_text = addr.to_storage_string()
-        amount = req['amount']
-        message = req['memo']
-        self.receive_requests[addr] = req
-        self.save_payment_requests()
-        if set_address_label:
-            self.set_label(addr_text, message) # should be a default label
+        self.add_payment_requests([req], config, set_address_label)
+
+    def add_payment_requests(self, reqs, config, set_address_label=True):
+        ''' Adds a list of payment requests, saving the requests (and the
+        labels) once for all of them. '''
+        with self.lock:
+            labels_changed = False
+            for req in reqs:
+                self.receive_requests[req['address']] = req
+                if set_address_label:
+                    # should be a default label
+                    labels_changed |= self._set_label(req['address'], req['memo'])
+            if labels_changed:
+                self.storage.put('labels', self.labels)
+            self.save_payment_requests()
 
         rdir = config.get('requests_dir')
-        if rdir and amount is not None:
-            key = req.get('id', addr_text)
-            pr = paymentrequest.make_request(config, req)
-            path = os.path.join(rdir, 'req', key[0], key[1], key)
-            if not os.path.exists(path):
-                try:
-                    os.makedirs(path)
-                except OSError as exc:
-                    if exc.errno != errno.EEXIST:
-                        raise
-            with open(os.path.join(path, key), 'wb') as f:
-                f.write(pr.SerializeToString())
-            # reload
-            req = self.get_payment_request(addr, config)
-            req['address'] = req['address'].to_ui_string()
-            with open(os.path.join(path, key + '.json'), 'w', encoding='utf-8') as f:
-                f.write(json.dumps(req))
+        if rdir:
+            for req in reqs:
+                if req['amount'] is not None:
+                    self._write_payment_request_files(req, config, rdir)
+
+    def _write_payment_request_files(self, req, config, rdir):
+        addr = req['address']
+        addr_text = addr.to_storage_string()
+        key = req.get('id', addr_text)
+        pr = paymentrequest.make_request(config, req)
+        path = os.path.join(rdir, 'req', key[0], key[1], key)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        with open(os.path.join(path, key), 'wb') as f:
+            f.write(pr.SerializeToString())
+        # reload
+        req = self.get_payment_request(addr, config)
+        req['address'] = req['address'].to_ui_string()
+        with open(os.path.join(path, key + '.json'), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(req))
 
     def remove_payment_request(self, addr, config, clear_address_label_if_no_tx=True):
         if isinstance(addr, str):
@@ -1778,24 +2240,33 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         self.save_payment_requests()
         return True
 
-    def get_sorted_requests(self, config):
-        m = map(lambda x: self.get_payment_request(x, config), self.receive_requests.keys())
-        try:
-            def f(x):
+    def get_sorted_requests(self, config, *, status=None, offset=0, count=None):
+        ''' Returns the payment requests sorted by address index. With status,
+        only the requests in that state are returned. offset and count select
+        a page of the result; only the requests up to the end of that page
+        are looked at, so paging through many requests stays cheap. '''
+        with self.lock:
+            keys = list(self.receive_requests.keys())
+            def f(addr):
                 try:
-                    addr = x['address']
                     return self.get_address_index(addr) or addr
                 except:
                     return addr
-            return sorted(m, key=f)
-        except TypeError:
-            # See issue #1231 -- can get inhomogenous results in the above
-            # sorting function due to the 'or addr' possible return.
-            # This can happen if addresses for some reason drop out of wallet
-            # while, say, the history rescan is running and it can't yet find
-            # an address index for an address.  In that case we will
-            # return an unsorted list to the caller.
-            return list(m)
+            try:
+                keys.sort(key=f)
+            except TypeError:
+                # See issue #1231 -- can get inhomogenous results in the above
+                # sorting function due to the 'or addr' possible return.
+                # This can happen if addresses for some reason drop out of wallet
+                # while, say, the history rescan is running and it can't yet find
+                # an address index for an address.  In that case we will
+                # return an unsorted list to the caller.
+                pass
+            reqs = (self.get_payment_request(addr, config) for addr in keys)
+            if status is not None:
+                reqs = (r for r in reqs if r.get('status') == status)
+            stop = None if count is None else offset + count
+            return list(itertools.islice(reqs, offset, stop))
 
     def get_fingerprint(self):
         raise NotImplementedError()
@@ -1819,9 +2290,11 @@ class Abstract_Wallet(PrintError, SPVDelegate):
     def add_address(self, address):
         assert isinstance(address, Address)
         self._addr_bal_cache.pop(address, None)  # paranoia, not really necessary -- just want to maintain the invariant that when we modify address history below we invalidate cache.
+        self._utxo_dirty.add(address)
         self.invalidate_address_set_cache()
         if address not in self._history:
             self._history[address] = []
+            self._addr_status.pop(address, None)
         if self.synchronizer:
             self.synchronizer.add(address)
         self.cashacct.on_address_addition(address)
@@ -1854,6 +2327,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         do_addr_save = False
         with self.lock:
             self.transactions.clear(); self.unverified_tx.clear(); self.verified_tx.clear()
+            self.spv_proofs.clear()
             self.clear_history()
             if isinstance(self, Standard_Wallet):
                 # reset the address list to default too, just in case. New synchronizer will pick up the addresses again.
@@ -2003,14 +2477,18 @@ class ImportedWalletBase(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self._history.pop(address, None)
+            self._addr_status.pop(address, None)
+            self.invalidate_history_cache()
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
                 self.tx_fees.pop(tx_hash, None)
                 self.verified_tx.pop(tx_hash, None)
+                self.spv_proofs.pop(tx_hash, None)
                 self.unverified_tx.pop(tx_hash, None)
                 self.transactions.pop(tx_hash, None)
                 self._addr_bal_cache.pop(address, None)  # not strictly necessary, above calls also have this side-effect. but here to be safe. :)
+                self._utxo_dirty.add(address)
                 if self.verifier:
                     # TX is now gone. Toss its SPV proof in case we have it
                     # in memory. This allows user to re-add PK again and it
@@ -2020,6 +2498,7 @@ class ImportedWalletBase(Simple_Wallet):
                 # FIXME: what about pruned_txo?
 
             self.storage.put('verified_tx3', self.verified_tx)
+            self.storage.put('spv_proofs', self.spv_proofs)
 
         self.save_transactions()
 
@@ -2265,28 +2744,41 @@ class Deterministic_Wallet(Abstract_Wallet):
         return nmax + 1
 
     def create_new_address(self, for_change=False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change=False, count=1):
+        ''' Derives the next `count` addresses of the receiving or change
+        branch, and saves the address lists once for all of them. '''
         for_change = bool(for_change)
         with self.lock:
             addr_list = self.change_addresses if for_change else self.receiving_addresses
             n = len(addr_list)
-            x = self.derive_pubkeys(for_change, n)
-            address = self.pubkeys_to_address(x)
-            addr_list.append(address)
+            addresses = [self.pubkeys_to_address(x)
+                         for x in self.derive_pubkey_range(for_change, n, count)]
+            index = self._address_index_cached
+            if len(index) == len(self.receiving_addresses) + len(self.change_addresses):
+                index.update((addr, (for_change, i))
+                             for i, addr in enumerate(addresses, n))
+            addr_list.extend(addresses)
             self.save_addresses()
-            self.add_address(address)
-            return address
+            for address in addresses:
+                self.add_address(address)
+            return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change)
-                continue
-            if all(map(lambda a: not self.address_is_old(a), addresses[-limit:] )):
+            # The last `limit` addresses must all be unused; work out how
+            # many that takes and derive them in one batch.
+            wanted = limit
+            for i in range(len(addresses) - 1, max(len(addresses) - limit, 0) - 1, -1):
+                if self.address_is_old(addresses[i]):
+                    wanted = i + 1 + limit
+                    break
+            if len(addresses) >= wanted:
                 break
-            else:
-                self.create_new_address(for_change)
+            self.create_new_addresses(for_change, wanted - len(addresses))
 
     def synchronize(self):
         with self.lock:
@@ -2358,6 +2850,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_pubkey_range(self, c, start, count):
+        return self.keystore.derive_pubkey_range(c, start, count)
+
 
 
 
@@ -2393,6 +2888,10 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_pubkey_range(self, c, start, count):
+        ranges = [k.derive_pubkey_range(c, start, count) for k in self.get_keystores()]
+        return [list(pubkeys) for pubkeys in zip(*ranges)]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -150,7 +150,7 @@ class CoinUtils(PrintError):
             pubkey = txin['pubkeys'][0]
             if pubkey in inputs:
                 tx_num = transaction.inputs().index(txin)
-                pre_hash = Hash(bfh(transaction.serialize_preimage(tx_num)))
+                pre_hash = Hash(bfh(transaction.serialize_preimage(tx_num, use_cache=True)))
                 private_key = MySigningKey.from_secret_exponent(secret_keys[pubkey].secret, curve=SECP256k1)
                 public_key = private_key.get_verifying_key()
                 sig = private_key.sign_digest_deterministic(pre_hash,
@@ -289,7 +289,7 @@ class CoinUtils(PrintError):
             # verification_key / utxo combo not found in tx inputs, bail
             return False
         # calculate sighash digest (implicitly this is for sighash 0x41)
-        pre_hash = Hash(bfh(transaction.serialize_preimage(tx_num)))
+        pre_hash = Hash(bfh(transaction.serialize_preimage(tx_num, use_cache=True)))
         order = generator_secp256k1.order()
         try:
             sigbytes = bfh(signature.decode())